@@ -6,10 +6,11 @@ WSGI application that renders /root/Changelog
 import calendar
 import datetime
 import io
+import json
 import os
 import re
-import socket
 import textwrap
+from email.utils import formatdate, mktime_tz, parsedate_tz
 from functools import partial
 from mimetypes import guess_type
 
@@ -25,15 +26,21 @@ except ImportError:
 import mako.template
 import mako.lookup
 
-from .utils import ansi2html, mako_error_handler
+from .host_identity import get_fqdn
+from .utils import (
+    CACHE_DIR,
+    LazyTemplate,
+    ansi2html,
+    compile_template,
+    mako_error_handler,
+)
 
 
 __author__ = 'Marius Gedminas <marius@gedmin.as>'
-__version__ = '0.9.1'
+__version__ = '0.10.0'
 __date__ = '2021-03-29'
 
 
-HOSTNAME = socket.gethostname()
 CHANGELOG_FILE = '/root/Changelog'
 MOTD_FILE = '/etc/motd'
 
@@ -125,6 +132,19 @@ class Entry(TextObject):
                 year=self.year, month=self.month, day=self.day,
                 hour=self.hour, minute=self.minute, timezone=self.timezone)
 
+    def isoformat(self):
+        # Atom wants RFC 3339 timestamps, which must have a timezone; entries
+        # that don't specify one are assumed to be in UTC
+        template = u'{year:04d}-{month:02d}-{day:02d}T{hour:02d}:{minute:02d}:00'
+        if self.timezone is not None:
+            template += u'{timezone[0]}{timezone[1]}{timezone[2]}:{timezone[3]}{timezone[4]}'
+        else:
+            template += u'Z'
+        return template.format(
+                year=self.year, month=self.month, day=self.day,
+                hour=self.hour or 0, minute=self.minute or 0,
+                timezone=self.timezone)
+
     def title(self):
         return u'{timestamp} {user}'.format(timestamp=self.timestamp(), user=self.user)
 
@@ -200,6 +220,10 @@ class Changelog(object):
         return [entry for entry in reversed(self.entries)
                 if entry.search(query)]
 
+    def newer_than(self, id):
+        # Entry ids are sequential, starting from 1
+        return self.entries[max(id, 0):]
+
     def read(self, filename):
         with io.open(filename, encoding='UTF-8', errors='replace') as fp:
             self.mtime = os.fstat(fp.fileno()).st_mtime
@@ -308,7 +332,7 @@ def get_changelog(filename, _cache={}):
 
 
 def get_hostname(environ):
-    return environ.get('HOSTNAME') or os.getenv('HOSTNAME') or HOSTNAME
+    return environ.get('HOSTNAME') or os.getenv('HOSTNAME') or get_fqdn()
 
 
 def get_changelog_filename(environ):
@@ -324,6 +348,30 @@ def get_motd(filename):
     return Motd(filename)
 
 
+def get_validators(filename):
+    """Compute (ETag, Last-Modified) for a file without reading it."""
+    st = os.stat(filename)
+    etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+    last_modified = formatdate(int(st.st_mtime), usegmt=True)
+    return etag, last_modified
+
+
+def is_not_modified(environ, etag, last_modified):
+    """Check the request's conditional GET headers."""
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+        return (if_none_match.strip() == '*' or
+                etag in [tag.strip() for tag in if_none_match.split(',')])
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since:
+        since = parsedate_tz(if_modified_since)
+        if since is not None:
+            modified = parsedate_tz(last_modified)
+            return mktime_tz(modified) <= mktime_tz(since)
+    return False
+
+
 #
 # And now let's invent our own web microframework
 # (because we were minimizing dependencies to those packages available in
@@ -355,6 +403,14 @@ def not_found(environ):
     return Response('<h1>404 Not Found</h1>', status='404 Not Found')
 
 
+def bad_request(environ):
+    return Response('<h1>400 Bad Request</h1>', status='400 Bad Request')
+
+
+def not_modified(environ, headers):
+    return Response('', status='304 Not Modified', headers=headers)
+
+
 def dispatch(environ):
     path_info = environ['PATH_INFO'] or '/'
     for pattern, rx, view, kwargs in PATHS:
@@ -369,11 +425,30 @@ def get_prefix(environ):
     return script_name.rstrip('/')
 
 
-TEMPLATES = mako.lookup.TemplateLookup()
+class TemplateLookup(mako.lookup.TemplateLookup):
+    """Template lookup that knows about LazyTemplates.
+
+    A WSGI process that only ever serves the Atom feed has no need to
+    compile the HTML templates.
+    """
+
+    def __init__(self, *args, **kw):
+        super(TemplateLookup, self).__init__(*args, **kw)
+        self.lazy_templates = {}
+
+    def get_template(self, uri):
+        if uri in self.lazy_templates:
+            return self.lazy_templates[uri].template
+        return super(TemplateLookup, self).get_template(uri)
+
+
+TEMPLATES = TemplateLookup()
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_DIR, 'changelog2html') if CACHE_DIR else None
 
 
 def Template(*args, **kw):
-    template = mako.template.Template(
+    template = compile_template(
+        cache_dir=TEMPLATE_CACHE_DIR,
         error_handler=mako_error_handler,
         strict_undefined=True,
         default_filters=['unicode', 'h'],
@@ -383,12 +458,17 @@ def Template(*args, **kw):
     return template
 
 
+def lazy_template(uri, text):
+    template = TEMPLATES.lazy_templates[uri] = LazyTemplate(Template, uri, text)
+    return template
+
+
 #
 # Views
 #
 
 
-page_template = Template(uri="page.html", text=textwrap.dedent('''
+page_template = lazy_template(uri="page.html", text=textwrap.dedent('''
     <!DOCTYPE html>
     <html lang="en">
       <head>
@@ -530,7 +610,7 @@ def static(environ, pathname):
         return Response(f.read(), content_type=content_type)
 
 
-main_template = Template(uri="main.html", text=textwrap.dedent('''
+main_template = lazy_template(uri="main.html", text=textwrap.dedent('''
     <%inherit file="page.html" />
     <%def name="title()">/root/Changelog on ${hostname}</%def>
 
@@ -608,7 +688,7 @@ def raw_page(environ, content_disposition='inline'):
                     headers=headers)
 
 
-all_template = Template(uri="all.html", text=textwrap.dedent('''
+all_template = lazy_template(uri="all.html", text=textwrap.dedent('''
     <%inherit file="page.html" />
     <%def name="title()">All entries - /root/Changelog on ${hostname}</%def>
 
@@ -641,7 +721,7 @@ def all_page(environ):
         hostname=hostname, changelog=changelog, prefix=prefix)
 
 
-year_template = Template(uri="year.html", text=textwrap.dedent('''
+year_template = lazy_template(uri="year.html", text=textwrap.dedent('''
     <%inherit file="page.html" />
     <%def name="title()">${date} - /root/Changelog on ${hostname}</%def>
 
@@ -738,7 +818,7 @@ def year_header(year, prefix, prev_url=None, next_url=None):
             '</thead>'.format(prev=prev, next=next, title=title))
 
 
-month_template = Template(uri="month.html", text=textwrap.dedent('''
+month_template = lazy_template(uri="month.html", text=textwrap.dedent('''
     <%inherit file="page.html" />
     <%def name="title()">${date} - /root/Changelog on ${hostname}</%def>
 
@@ -848,7 +928,7 @@ def html_table(matrix, css_class, header=''):
                  for row in matrix]))
 
 
-day_template = Template(textwrap.dedent('''
+day_template = lazy_template(uri="day.html", text=textwrap.dedent('''
     <%inherit file="page.html" />
     <%def name="title()">${date} - /root/Changelog on ${hostname}</%def>
 
@@ -912,7 +992,7 @@ def day_page(environ, year, month, day):
         prefix=prefix)
 
 
-search_template = Template(textwrap.dedent('''
+search_template = lazy_template(uri="search.html", text=textwrap.dedent('''
     <%inherit file="page.html" />
     <%def name="title()">${query} - /root/Changelog on ${hostname}</%def>
 
@@ -948,6 +1028,95 @@ def search_page(environ):
         hostname=hostname, query=query, entries=entries, prefix=prefix)
 
 
+feed_template = lazy_template(uri="feed.atom", text=textwrap.dedent('''
+    <?xml version="1.0" encoding="UTF-8"?>
+    <feed xmlns="http://www.w3.org/2005/Atom">
+      <title>/root/Changelog on ${hostname}</title>
+      <id>tag:${hostname},2000:changelog</id>
+      <link rel="alternate" type="text/html" href="${prefix}/"/>
+      <link rel="self" href="${prefix}/feed.atom"/>
+    % if entries:
+      <updated>${entries[0].isoformat()}</updated>
+    % else:
+      <updated>1970-01-01T00:00:00Z</updated>
+    % endif
+    % for entry in entries:
+      <entry>
+        <title>${entry.title()}</title>
+        <id>tag:${hostname},2000:changelog/${entry.anchor}</id>
+        <link rel="alternate" type="text/html" href="${entry.url(prefix)}"/>
+        <updated>${entry.isoformat()}</updated>
+        <author><name>${entry.user or 'unknown'}</name></author>
+        <content type="html">${entry.pre(slice(1, None))}</content>
+      </entry>
+    % endfor
+    </feed>
+''').lstrip())
+
+
+FEED_SIZE = 20
+
+
+@path(r'/feed\.atom')
+def feed_page(environ):
+    filename = get_changelog_filename(environ)
+    try:
+        etag, last_modified = get_validators(filename)
+    except OSError:
+        return not_found(environ)
+    headers = {'ETag': etag, 'Last-Modified': last_modified}
+    if is_not_modified(environ, etag, last_modified):
+        return not_modified(environ, headers)
+    try:
+        changelog = get_changelog(filename)
+    except OSError:
+        return not_found(environ)
+    body = feed_template.render_unicode(
+        hostname=get_hostname(environ), prefix=get_prefix(environ),
+        entries=changelog.entries[:-FEED_SIZE-1:-1])
+    return Response(body, content_type='application/atom+xml; charset=UTF-8',
+                    headers=headers)
+
+
+@path(r'/entries\.json')
+def entries_page(environ):
+    form = parse_qs(environ.get('QUERY_STRING', ''))
+    try:
+        since = int(form.get('since', ['0'])[0])
+    except ValueError:
+        return bad_request(environ)
+    filename = get_changelog_filename(environ)
+    try:
+        etag, last_modified = get_validators(filename)
+    except OSError:
+        return not_found(environ)
+    headers = {'ETag': etag, 'Last-Modified': last_modified}
+    if is_not_modified(environ, etag, last_modified):
+        return not_modified(environ, headers)
+    try:
+        changelog = get_changelog(filename)
+    except OSError:
+        return not_found(environ)
+    prefix = get_prefix(environ)
+    entries = changelog.newer_than(since)
+    body = json.dumps({
+        'last_id': len(changelog.entries),
+        'entries': [
+            {
+                'id': entry.id,
+                'timestamp': entry.isoformat(),
+                'user': entry.user,
+                'title': entry.title(),
+                'url': entry.url(prefix),
+                'text': u''.join(entry.text[1:]),
+            }
+            for entry in entries
+        ],
+    }, indent=2, sort_keys=True)
+    return Response(body, content_type='application/json',
+                    headers=headers)
+
+
 def wsgi_app(environ, start_response):
     view = dispatch(environ)
     response = view()
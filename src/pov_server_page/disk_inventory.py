@@ -14,11 +14,16 @@ Written by Marius Gedminas <marius@pov.lt>
 from __future__ import print_function
 
 import collections
+import errno
 import functools
+import json
 import optparse
 import os
+import re
+import subprocess
 import sys
-from xml.etree import ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
 try:
     from html import escape
@@ -27,7 +32,7 @@ except ImportError:
 
 
 __author__ = 'Marius Gedminas <marius@gedmin.as>'
-__version__ = '1.6.5'
+__version__ = '1.7.0'
 __date__ = '2025-03-19'
 
 
@@ -46,6 +51,27 @@ DMName = collections.namedtuple('LVInfo', 'name number')
 
 KVMInfo = collections.namedtuple('KVMInfo', 'name device')
 
+LVMReport = collections.namedtuple('LVMReport', 'vgs pvs lvs')
+
+CommandResult = collections.namedtuple('CommandResult', 'output error')
+
+SysBlockDevice = collections.namedtuple(
+    'SysBlockDevice', 'name size_sectors start_sectors holders')
+
+SysDisk = collections.namedtuple(
+    'SysDisk',
+    'name size_sectors model firmware_rev serial rotational partitions')
+
+
+TIMEOUT = 30  # seconds, for each external command
+
+# Names of /sys/block entries that are actual disks
+PHYSICAL_DISK_PREFIXES = ('sd', 'cciss', 'xvd', 'vd', 'nvme')
+# XXX: maybe also list mmcblk in case somebody runs this on a
+# Raspberry Pi or something
+# XXX: maybe I should filter out non-disk devices like loop and dm and md
+# instead of recognizing actual drives
+
 
 class once(object):
     """Property that is computed once, on 1st access, and then cached."""
@@ -71,11 +97,228 @@ def cache(fn):
     return wrapper
 
 
+def timed_out(result):
+    """Did the command of this CommandResult time out?"""
+    return bool(result.error) and result.error.startswith('timed out after ')
+
+
+def run_command(command, timeout=TIMEOUT):
+    """Run a command and return a CommandResult.
+
+    ``error`` is None if the command succeeded, otherwise it's a short
+    description of what went wrong.  A missing command is not an error, it
+    just produces no output.
+    """
+    try:
+        p = subprocess.Popen(command.split(), stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return CommandResult('', None)
+        return CommandResult('', str(e))
+    try:
+        output, errors = p.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        try:
+            output, errors = p.communicate(timeout=1)
+        except subprocess.TimeoutExpired:  # nocover: stuck in the kernel
+            output = ''
+        return CommandResult(
+            output, 'timed out after {} seconds'.format(timeout))
+    if p.returncode != 0:
+        lines = errors.strip().splitlines()
+        return CommandResult(output, lines[-1].strip() if lines else
+                             'exit status {}'.format(p.returncode))
+    return CommandResult(output, None)
+
+
+def _read_sysfs(filename, mode='r'):
+    try:
+        with open(filename, mode) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _read_sysfs_string(filename):
+    value = _read_sysfs(filename)
+    return value.strip() if value is not None else None
+
+
+def _read_sysfs_int(filename):
+    try:
+        return int(_read_sysfs_string(filename))
+    except (TypeError, ValueError):
+        return None
+
+
+def _listdir(dirname):
+    try:
+        return sorted(os.listdir(dirname))
+    except OSError:
+        return []
+
+
+class SysfsSnapshot(object):
+    """The parts of /sys/block that disk-inventory needs, read in one pass.
+
+    ``disks`` maps physical disk names (sda) to SysDisk tuples, ``devices``
+    maps all block device and partition names (sda, sda1, dm-0, md0) to
+    SysBlockDevice tuples.  Sizes and offsets are in 512-byte sectors.
+    Values that could not be read are None.
+    """
+
+    def __init__(self, disks, devices):
+        self.disks = MappingProxyType(disks)
+        self.devices = MappingProxyType(devices)
+
+    @classmethod
+    def read(cls, sys_block='/sys/block',
+             disk_prefixes=PHYSICAL_DISK_PREFIXES):
+        disks = {}
+        devices = {}
+        for name in _listdir(sys_block):
+            sysdir = os.path.join(sys_block, name)
+            devices[name] = cls._read_device(name, sysdir)
+            if not name.startswith(disk_prefixes):
+                continue
+            partitions = tuple(p for p in _listdir(sysdir)
+                               if p.startswith(name))
+            for partition in partitions:
+                devices[partition] = cls._read_device(
+                    partition, os.path.join(sysdir, partition))
+            rotational = _read_sysfs_string(sysdir + '/queue/rotational')
+            disks[name] = SysDisk(
+                name=name,
+                size_sectors=devices[name].size_sectors,
+                model=_read_sysfs_string(sysdir + '/device/model'),
+                firmware_rev=(
+                    _read_sysfs_string(sysdir + '/device/firmware_rev') or
+                    _read_sysfs_string(sysdir + '/device/rev')),
+                serial=cls._read_serial(sysdir),
+                rotational=rotational != '0' if rotational else None,
+                partitions=partitions,
+            )
+        return cls(disks, devices)
+
+    @staticmethod
+    def _read_device(name, sysdir):
+        return SysBlockDevice(
+            name=name,
+            size_sectors=_read_sysfs_int(sysdir + '/size'),
+            start_sectors=_read_sysfs_int(sysdir + '/start'),
+            holders=tuple(_listdir(sysdir + '/holders')),
+        )
+
+    @staticmethod
+    def _read_serial(sysdir):
+        serial = _read_sysfs_string(sysdir + '/device/serial')
+        if serial is not None:
+            return serial
+        vpd_pg80 = _read_sysfs(sysdir + '/device/vpd_pg80', 'rb')
+        if vpd_pg80 is not None:
+            # Google gave me a PDF that describes the format of the Unit Serial
+            # Number VPD Page (80h) as follows:
+            # +------+--------------------------------------------------------+
+            # |      | Bit 7 |    6 |    5 |    4 |    3 |    2 |    1 |    0 |
+            # | Byte |       |      |      |      |      |      |      |      |
+            # +------+--------------------------------------------------------+
+            # |    0 | PERIPHERAL QUALIFIER| PERIPHERAL DEVICE TYPE           |
+            # +------+--------------------------------------------------------+
+            # |    1 | PAGE CODE (80h)                                        |
+            # +------+--------------------------------------------------------+
+            # |    2 | (MSB) PAGE LENGTH (14h)                                |
+            # |    3 |                                                  (LSB) |
+            # +------+--------------------------------------------------------+
+            # |    4 | (MSB)                                                  |
+            # |  ... |       PRODUCT SERIAL NUMBER                            |
+            # |   11 |                                                  (LSB) |
+            # +------+--------------------------------------------------------+
+            # |   12 | (MSB)                                                  |
+            # |  ... |       PRINTED CIRCUIT BOARD SERIAL NUMBER              |
+            # |   23 |                                                  (LSB) |
+            # +------+--------------------------------------------------------+
+            # "The PRODUCT SERIAL NUMBER field contains right-aligned ASCII
+            # data that is vendor-assigned serial number.  If the product
+            # serial number is not available, the target shall return ASCII
+            # spaces (20h) in this field."
+            # The description for the PRINTED CIRCUIT BOARD SERIAL NUMBER is
+            # identical.
+            # Experiments show that these are just two halves of the full serial
+            # number shown by other tools and should be concatenated.
+            # Source: https://www.seagate.com/files/staticfiles/support/docs/manual/Interface%20manuals/100293068k.pdf
+            # That PDF also documents the Device Identification VPD page (83h),
+            # which is harder to parse.
+            return vpd_pg80[4:24].decode('ascii', 'replace').strip()
+        return None
+
+
 class LinuxDiskInfo(object):
 
+    # External commands that report() needs, so start_commands() can run
+    # them all at once.
+    DF = 'df -P --local --print-type -x debugfs'
+    DMSETUP = 'dmsetup -c --noheadings info'
+    VGDISPLAY = 'vgdisplay -c'
+    PVDISPLAY = 'pvdisplay -c'
+    LV_COLUMNS = ('lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,'
+                  'metadata_devices,lv_device_open')
+    LVS = ('lvs --separator=: --units=b --nosuffix --noheadings -o'
+           ' {} --all'.format(LV_COLUMNS))
+    # Each LVM command scans all the PVs, which can take seconds, so we try
+    # to get everything in one go.  The segment report is the one that
+    # knows which devices an LV is located on.
+    LVM_FULLREPORT = (
+        'lvm fullreport --reportformat json --units b --nosuffix --all'
+        ' --configreport vg -o vg_name,vg_size,vg_free'
+        ' --configreport pv -o pv_name,vg_name,pv_free'
+        ' --configreport lv -o lv_name'
+        ' --configreport pvseg -o pvseg_start'
+        ' --configreport seg -o {}'.format(LV_COLUMNS))
+    # These need root; we warn about that once instead of once per command
+    ROOT_COMMANDS = (DMSETUP, LVM_FULLREPORT, VGDISPLAY, PVDISPLAY, LVS)
+
+    timeout = TIMEOUT
+
+    @once
+    def _executor(self):
+        return ThreadPoolExecutor(max_workers=len(self.ROOT_COMMANDS) + 1)
+
+    @once
+    def _running(self):
+        return {}
+
+    def start_commands(self):
+        """Start all the external commands in the background."""
+        for command in (self.DF, self.DMSETUP, self.LVM_FULLREPORT):
+            self._start(command)
+
+    def _start(self, command):
+        if command not in self._running:
+            self._running[command] = self._executor.submit(
+                run_command, command, self.timeout)
+        return self._running[command]
+
+    def _run(self, command):
+        """Return the output lines of an external command.
+
+        Waits for the command to finish if it was already started by
+        start_commands().
+        """
+        result = self._start(command).result()
+        self._warn_about(command, result)
+        return result.output.splitlines()
+
+    def _warn_about(self, command, result):
+        if result.error and (command not in self.ROOT_COMMANDS
+                             or os.getuid() == 0):
+            self.warn("disk-inventory: {}: {}".format(
+                command.split()[0], result.error))
+
     @once
     def _swap_devices(self):
-        return self.list_swap_devices()
+        return set(self.list_swap_devices())
 
     @once
     def _filesystems(self):
@@ -101,22 +344,52 @@ class LinuxDiskInfo(object):
     def _dms(self):
         return {dm.name: dm for dm in self.list_device_mapper()}
 
-    @property
+    @once
     def _dm_names(self):
         return {dm.number: dm.name for dm in self.list_device_mapper_names()}
 
-    def _read_string(self, filename):
-        with open(filename) as f:
-            return f.read().strip()
+    @once
+    def _canonical_names(self):
+        return {}
 
-    def _read_bytes(self, filename):
-        with open(filename, 'rb') as f:
-            return f.read()
+    @once
+    def _partition_devices_cache(self):
+        return {}
+
+    @once
+    def _sysfs(self):
+        return SysfsSnapshot.read()
+
+    def _sys_disk(self, disk_name):
+        disk = self._sysfs.disks.get(disk_name)
+        if disk is None:
+            disk = SysDisk(disk_name, None, None, None, None, None, ())
+        return disk
 
-    def _read_int(self, filename):
-        return int(self._read_string(filename))
+    def _sys_device(self, partition_name):
+        """Look up a partition or a device-mapper device in /sys/block.
+
+        Returns a SysBlockDevice, or None.
+        """
+        if partition_name.startswith('mapper/'):
+            name = partition_name[len('mapper/'):]
+            try:
+                partition_name = self.get_dm_for(name)
+            except KeyError:
+                # /dev/mapper/vgname-lvname for inactive LVs is not known
+                # to dmsetup
+                return None
+        return self._sysfs.devices.get(partition_name)
 
     def _canonical_device_name(self, device):
+        try:
+            return self._canonical_names[device]
+        except KeyError:
+            name = self._canonical_names[device] = (
+                self._compute_canonical_device_name(device))
+            return name
+
+    def _compute_canonical_device_name(self, device):
         if not device.startswith('/dev/'):
             return None
         name = device[len('/dev/'):]
@@ -134,8 +407,14 @@ class LinuxDiskInfo(object):
                     name = self._dm_names.get(target[len('../'):], name)
         return name
 
+    @once
+    def warnings(self):
+        return []
+
     def warn(self, message):
-        print(message, file=sys.stderr)
+        # Collected so that report() can show them every time, even when
+        # the command that caused them doesn't run again.
+        self.warnings.append(message)
 
     @cache
     def list_swap_devices(self):
@@ -154,13 +433,11 @@ class LinuxDiskInfo(object):
     def list_filesystems(self):
         """Return a list of FilesystemInfo tuples."""
         res = []
-        with os.popen('df -P --local --print-type -x debugfs') as f:
-            f.readline() # skip header
-            for line in f:
-                device, fstype, size_kb, used_kb, avail_kb, use_percent, mountpoint = line.split()
-                name = self._canonical_device_name(device)
-                if name:
-                    res.append(FilesystemInfo(name, mountpoint, fstype, int(size_kb), int(used_kb), int(avail_kb)))
+        for line in self._run(self.DF)[1:]:  # skip header
+            device, fstype, size_kb, used_kb, avail_kb, use_percent, mountpoint = line.split()
+            name = self._canonical_device_name(device)
+            if name:
+                res.append(FilesystemInfo(name, mountpoint, fstype, int(size_kb), int(used_kb), int(avail_kb)))
         return res
 
     @cache
@@ -170,12 +447,7 @@ class LinuxDiskInfo(object):
         Limitations: only handles ATA/SATA/SCSI disks; no RAID or whatnot.
         """
         if os.path.exists('/sys/block'):
-            return sorted(name for name in os.listdir('/sys/block')
-                          if name.startswith(('sd', 'cciss', 'xvd', 'vd', 'nvme')))
-            # XXX: maybe also list mmcblk in case somebody runs this on a
-            # Raspberry Pi or something
-            # XXX: maybe I should filter out non-disk devices like loop and dm and md
-            # instead of recognizing actual drives
+            return sorted(self._sysfs.disks)
         elif os.path.exists('/dev/simfs'):
             # OpenVZ container
             return ['simfs']
@@ -187,11 +459,10 @@ class LinuxDiskInfo(object):
     def list_device_mapper(self):
         """Return a list of DMInfo tuples."""
         res = []
-        with os.popen('dmsetup -c --noheadings info') as f:
-            for line in f:
-                # name, major, minor, attr, open, segments,  events,  uuid.
-                name, major, minor, _, _, _, _, _ = line.split(':')
-                res.append(DMInfo(name, int(major), int(minor)))
+        for line in self._run(self.DMSETUP):
+            # name, major, minor, attr, open, segments,  events,  uuid.
+            name, major, minor, _, _, _, _, _ = line.split(':')
+            res.append(DMInfo(name, int(major), int(minor)))
         return res
 
     @cache
@@ -210,77 +481,128 @@ class LinuxDiskInfo(object):
             pass
         return res
 
+    @cache
+    def _lvm_report(self):
+        """Query VGs, PVs and LVs with a single LVM command.
+
+        Returns an LVMReport, or None if lvm fullreport is not supported (it
+        appeared in LVM 2.02.158), in which case we start the three separate
+        commands that list_lvm_*() fall back to.
+
+        If lvm fullreport times out, the separate commands would only time
+        out too, so we report no LVM devices at all.
+        """
+        result = self._start(self.LVM_FULLREPORT).result()
+        if timed_out(result):
+            self._warn_about(self.LVM_FULLREPORT, result)
+            return LVMReport([], [], [])
+        try:
+            if result.error:
+                raise ValueError(result.error)
+            return self._parse_lvm_fullreport(result.output)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            for command in (self.VGDISPLAY, self.PVDISPLAY, self.LVS):
+                self._start(command)
+            return None
+
+    def _parse_lvm_fullreport(self, output):
+        vgs, pvs, lvs = [], [], []
+        for report in json.loads(output)['report']:
+            for vg in report.get('vg', []):
+                size_kb = int(vg['vg_size']) // 1024
+                free_kb = int(vg['vg_free']) // 1024
+                vgs.append(VGInfo(vg['vg_name'], size_kb, size_kb - free_kb,
+                                  free_kb))
+            for pv in report.get('pv', []):
+                # PVs that don't belong to any VG have no vg_name
+                if pv['vg_name'] and pv['pv_name'].startswith('/dev/'):
+                    pvs.append(PVInfo(pv['pv_name'][len('/dev/'):],
+                                      pv['vg_name'],
+                                      int(pv['pv_free']) // 1024))
+            for seg in report.get('seg', []):
+                lvs.append(self._lvinfo(
+                    *[seg[column] for column in self.LV_COLUMNS.split(',')]))
+        return LVMReport(vgs, pvs, lvs)
+
+    def _lvinfo(self, lvname, vgname, lv_size_bytes, lv_dm_path, lv_role,
+                devices, meta_devices, device_open):
+        assert lv_dm_path.startswith('/dev/mapper/')
+        device = lv_dm_path[len('/dev/'):]
+        located_on = {d.partition('(')[0] for d in devices.split(',') + meta_devices.split(',') if d}
+        return LVInfo(lvname, vgname, int(lv_size_bytes), device, lv_role, located_on, bool(device_open))
+
     @cache
     def list_lvm_volume_groups(self):
-        """Return volume groups names."""
-        res = []
+        """Return a list of VGInfo tuples."""
         if os.getuid() != 0:
             self.warn("disk-inventory: cannot list LVM devices: running as non-root")
-        with os.popen('vgdisplay -c 2>/dev/null') as f:
-            for line in f:
-                # columns:
-                # 1  volume group name
-                # 2  volume group access
-                # 3  volume group status
-                # 4  internal volume group number
-                # 5  maximum number of logical volumes
-                # 6  current number of logical volumes
-                # 7  open count of all logical volumes in this volume group
-                # 8  maximum logical volume size
-                # 9  maximum number of physical volumes
-                # 10 current number of physical volumes
-                # 11 actual number of physical volumes
-                # 12 size of volume group in kilobytes
-                # 13 physical extent size
-                # 14 total number of physical extents for this volume group
-                # 15 allocated number of physical extents for this volume group
-                # 16 free number of physical extents for this volume group
-                # 17 uuid of volume group
-                (vgname, _, _, _, _, _, _, _, _, _, _, size_kb, extent_size_kb,
-                 n_extents, used_extents, free_extents,
-                 uuid) = line.strip().split(':')
-                res.append(VGInfo(vgname, int(size_kb),
-                                  int(used_extents) * int(extent_size_kb),
-                                  int(free_extents) * int(extent_size_kb)))
+        report = self._lvm_report()
+        if report is not None:
+            return report.vgs
+        res = []
+        for line in self._run(self.VGDISPLAY):
+            # columns:
+            # 1  volume group name
+            # 2  volume group access
+            # 3  volume group status
+            # 4  internal volume group number
+            # 5  maximum number of logical volumes
+            # 6  current number of logical volumes
+            # 7  open count of all logical volumes in this volume group
+            # 8  maximum logical volume size
+            # 9  maximum number of physical volumes
+            # 10 current number of physical volumes
+            # 11 actual number of physical volumes
+            # 12 size of volume group in kilobytes
+            # 13 physical extent size
+            # 14 total number of physical extents for this volume group
+            # 15 allocated number of physical extents for this volume group
+            # 16 free number of physical extents for this volume group
+            # 17 uuid of volume group
+            (vgname, _, _, _, _, _, _, _, _, _, _, size_kb, extent_size_kb,
+             n_extents, used_extents, free_extents,
+             uuid) = line.strip().split(':')
+            res.append(VGInfo(vgname, int(size_kb),
+                              int(used_extents) * int(extent_size_kb),
+                              int(free_extents) * int(extent_size_kb)))
         return res
 
     @cache
     def list_lvm_physical_volumes(self):
         """Return a list of PVInfo tuples."""
+        report = self._lvm_report()
+        if report is not None:
+            return report.pvs
         res = []
-        with os.popen('pvdisplay -c 2>/dev/null') as f:
-            for line in f:
-                # the "wtf" column is "physical volume (not) allocatable"
-                # the _ column is "internal physical volume number (obsolete)"
-                try:
-                    (device, vgname, size_kb, _, status, wtf, n_volumes,
-                     extent_size_kb, n_extents, free_extents,
-                     used_extents, uuid) = line.strip().split(':')
-                    extent_size_kb = int(extent_size_kb)
-                    free_extents = int(free_extents)
-                except ValueError:
-                    # Could be something like a
-                    #    "/dev/sdc2" is a new physical volume of "231.95 GiB"
-                    # which shows up when you pvcreate but don't vgextend.
-                    pass
-                else:
-                    if device.startswith('/dev/'):
-                        res.append(PVInfo(device[len('/dev/'):], vgname,
-                                          free_extents * extent_size_kb))
+        for line in self._run(self.PVDISPLAY):
+            # the "wtf" column is "physical volume (not) allocatable"
+            # the _ column is "internal physical volume number (obsolete)"
+            try:
+                (device, vgname, size_kb, _, status, wtf, n_volumes,
+                 extent_size_kb, n_extents, free_extents,
+                 used_extents, uuid) = line.strip().split(':')
+                extent_size_kb = int(extent_size_kb)
+                free_extents = int(free_extents)
+            except ValueError:
+                # Could be something like a
+                #    "/dev/sdc2" is a new physical volume of "231.95 GiB"
+                # which shows up when you pvcreate but don't vgextend.
+                pass
+            else:
+                if device.startswith('/dev/'):
+                    res.append(PVInfo(device[len('/dev/'):], vgname,
+                                      free_extents * extent_size_kb))
         return res
 
     @cache
     def list_lvm_all_logical_volumes(self):
+        """Return a list of LVInfo tuples, including hidden LVs."""
+        report = self._lvm_report()
+        if report is not None:
+            return report.lvs
         res = []
-        columns = 'lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open'
-        with os.popen('lvs --separator=: --units=b --nosuffix --noheadings -o {} --all 2>/dev/null'.format(columns)) as f:
-            for line in f:
-                (lvname, vgname, lv_size_bytes, lv_dm_path, lv_role, devices,
-                 meta_devices, device_open) = line.strip().split(':')
-                assert lv_dm_path.startswith('/dev/mapper/')
-                device = lv_dm_path[len('/dev/'):]
-                located_on = {d.partition('(')[0] for d in devices.split(',') + meta_devices.split(',') if d}
-                res.append(LVInfo(lvname, vgname, int(lv_size_bytes), device, lv_role, located_on, bool(device_open)))
+        for line in self._run(self.LVS):
+            res.append(self._lvinfo(*line.strip().split(':')))
         return res
 
     @cache
@@ -293,6 +615,7 @@ class LinuxDiskInfo(object):
         libvirt_dir = '/etc/libvirt/qemu'
         if not os.path.exists(libvirt_dir):
             return []
+        from xml.etree import ElementTree as ET
         res = []
         for filename in os.listdir(libvirt_dir):
             if filename.endswith('.xml'):
@@ -311,7 +634,7 @@ class LinuxDiskInfo(object):
         return res
 
     def get_disk_size_sectors(self, disk_name):
-        return self._read_int('/sys/block/%s/size' % disk_name)
+        return self._sys_disk(disk_name).size_sectors or 0
 
     def get_disk_size_bytes(self, disk_name):
         if disk_name == 'simfs':
@@ -330,69 +653,22 @@ class LinuxDiskInfo(object):
             return 'KVM virtual disk'
         if disk_name == 'simfs':
             return 'OpenVZ virtual filesystem'
-        return self._read_string('/sys/block/%s/device/model' % disk_name)
+        return self._sys_disk(disk_name).model or 'N/A'
 
     def get_disk_firmware_rev(self, disk_name):
         if disk_name.startswith(('xvd', 'vd', 'simfs')):
             return 'N/A'
-        filename = '/sys/block/%s/device/firmware_rev' % disk_name
-        if not os.path.exists(filename):
-            filename = '/sys/block/%s/device/rev' % disk_name
-        return self._read_string(filename)
+        return self._sys_disk(disk_name).firmware_rev or 'N/A'
 
     def get_disk_serial(self, disk_name):
         if disk_name.startswith(('xvd', 'vd', 'simfs')):
             return 'N/A'
-        filename = '/sys/block/%s/device/serial' % disk_name
-        if os.path.exists(filename):
-            return self._read_string(filename)
-        filename = '/sys/block/%s/device/vpd_pg80' % disk_name
-        if os.path.exists(filename):
-            vpd_pg80 = self._read_bytes(filename)
-            # Google gave me a PDF that describes the format of the Unit Serial
-            # Number VPD Page (80h) as follows:
-            # +------+--------------------------------------------------------+
-            # |      | Bit 7 |    6 |    5 |    4 |    3 |    2 |    1 |    0 |
-            # | Byte |       |      |      |      |      |      |      |      |
-            # +------+--------------------------------------------------------+
-            # |    0 | PERIPHERAL QUALIFIER| PERIPHERAL DEVICE TYPE           |
-            # +------+--------------------------------------------------------+
-            # |    1 | PAGE CODE (80h)                                        |
-            # +------+--------------------------------------------------------+
-            # |    2 | (MSB) PAGE LENGTH (14h)                                |
-            # |    3 |                                                  (LSB) |
-            # +------+--------------------------------------------------------+
-            # |    4 | (MSB)                                                  |
-            # |  ... |       PRODUCT SERIAL NUMBER                            |
-            # |   11 |                                                  (LSB) |
-            # +------+--------------------------------------------------------+
-            # |   12 | (MSB)                                                  |
-            # |  ... |       PRINTED CIRCUIT BOARD SERIAL NUMBER              |
-            # |   23 |                                                  (LSB) |
-            # +------+--------------------------------------------------------+
-            # "The PRODUCT SERIAL NUMBER field contains right-aligned ASCII
-            # data that is vendor-assigned serial number.  If the product
-            # serial number is not available, the target shall return ASCII
-            # spaces (20h) in this field."
-            # The description for the PRINTED CIRCUIT BOARD SERIAL NUMBER is
-            # identical.
-            # Experiments show that these are just two halves of the full serial
-            # number shown by other tools and should be concatenated.
-            # Source: https://www.seagate.com/files/staticfiles/support/docs/manual/Interface%20manuals/100293068k.pdf
-            # That PDF also documents the Device Identification VPD page (83h),
-            # which is harder to parse.
-            return vpd_pg80[4:24].decode('ascii', 'replace').strip()
-        return 'N/A'
+        return self._sys_disk(disk_name).serial or 'N/A'
 
     def is_disk_an_ssd(self, disk_name):
-        if disk_name == 'simfs':
-            return False
-        try:
-            rot = self._read_string('/sys/block/%s/queue/rotational' % disk_name)
-        except IOError:
-            # could be a devmapper thing, e.g. dm-crypt
-            return False
-        return rot.strip() == '0'
+        # devmapper things (e.g. dm-crypt) and OpenVZ containers are not
+        # in the snapshot
+        return self._sys_disk(disk_name).rotational is False
 
     def list_partitions(self, disk_name):
         """Return partition names such as ['sda1', ...].
@@ -402,8 +678,7 @@ class LinuxDiskInfo(object):
         if disk_name == 'simfs':
             # OpenVZ container
             return ['simfs']
-        return sorted(name for name in os.listdir('/sys/block/%s' % disk_name)
-                      if name.startswith(disk_name))
+        return list(self._sys_disk(disk_name).partitions)
 
     def get_dm_for(self, name):
         """Find device mapper with a given name."""
@@ -420,8 +695,8 @@ class LinuxDiskInfo(object):
         return '/sys/block/%s/%s' % (disk_name, partition_name)
 
     def get_partition_size_sectors(self, partition_name):
-        sysdir = self.get_sys_dir_for_partition(partition_name)
-        return self._read_int(sysdir + '/size')
+        device = self._sys_device(partition_name)
+        return (device.size_sectors or 0) if device else 0
 
     def get_partition_size_bytes(self, partition_name):
         if partition_name == 'simfs':
@@ -431,22 +706,15 @@ class LinuxDiskInfo(object):
     def get_partition_offset_sectors(self, partition_name):
         if partition_name == 'simfs':
             return 0
-        sysdir = self.get_sys_dir_for_partition(partition_name)
-        return self._read_int(sysdir + '/start')
+        device = self._sys_device(partition_name)
+        return (device.start_sectors or 0) if device else 0
 
     def get_partition_offset_bytes(self, partition_name):
         return self.get_partition_offset_sectors(partition_name) * 512
 
     def list_partition_holders(self, partition_name):
-        if partition_name == 'simfs':
-            return []
-        try:
-            sysdir = self.get_sys_dir_for_partition(partition_name)
-        except KeyError:
-            # /dev/mapper/vgname-lvname for inactive LVs will raise a KeyError
-            # from get_dm_for().
-            return []
-        return sorted(os.listdir(sysdir + '/holders'))
+        device = self._sys_device(partition_name)
+        return list(device.holders) if device else []
 
     def partition_raid_devices(self, partition_name):
         holders = self.list_partition_holders(partition_name)
@@ -458,28 +726,37 @@ class LinuxDiskInfo(object):
         return [self._dm_names.get(d, d)
                 for d in holders if d.startswith('dm-')]
 
+    def _partition_devices(self, partition_name):
+        """Return the partition and the devices that sit directly on it.
+
+        That's the partition itself, followed by any RAID and device mapper
+        devices that hold it.
+        """
+        try:
+            return self._partition_devices_cache[partition_name]
+        except KeyError:
+            devices = self._partition_devices_cache[partition_name] = tuple(
+                [partition_name] +
+                self.partition_raid_devices(partition_name) +
+                self.partition_dm_devices(partition_name))
+            return devices
+
     def get_partition_fsinfo(self, partition_name):
-        raid_devices = self.partition_raid_devices(partition_name)
-        dm_devices = self.partition_dm_devices(partition_name)
-        for dev in [partition_name] + raid_devices + dm_devices:
+        for dev in self._partition_devices(partition_name):
             fsinfo = self._filesystems_by_device.get(dev)
             if fsinfo is not None:
                 return fsinfo
         return None
 
     def get_partition_lvm_pv(self, partition_name):
-        raid_devices = self.partition_raid_devices(partition_name)
-        dm_devices = self.partition_dm_devices(partition_name)
-        for dev in [partition_name] + raid_devices + dm_devices:
+        for dev in self._partition_devices(partition_name):
             pv = self._lvm_pvs.get(dev)
             if pv:
                 return pv
         return None
 
     def get_partition_kvm_vm(self, partition_name):
-        raid_devices = self.partition_raid_devices(partition_name)
-        dm_devices = self.partition_dm_devices(partition_name)
-        for dev in [partition_name] + raid_devices + dm_devices:
+        for dev in self._partition_devices(partition_name):
             vm = self._kvm_vms.get(dev)
             if vm:
                 return vm
@@ -759,21 +1036,32 @@ class HtmlReporter(Reporter):
                        is_used=lv.is_open, is_ssd=is_ssd)
 
 
+def print_warning(message):
+    print(message, file=sys.stderr)
+
+
 def report(info=None, verbose=1, name_width=8, usage_width=30,
-           fmt_size=fmt_size_decimal, print=print, warn=None,
+           fmt_size=fmt_size_decimal, print=print, warn=print_warning,
            show_used_instead_of_free=False, reporter_class=TextReporter):
+    """Report on the disks of this machine.
+
+    You can pass in a LinuxDiskInfo that has already been used for another
+    report, to avoid querying everything again.
+    """
     if info is None:
         info = LinuxDiskInfo()
-    if warn is not None:
-        info.warn = warn
+    info.start_commands()
     for disk in info.list_physical_disks():
         for partition in info.list_partitions(disk):
             name_width = max(name_width, len(partition) + 1)
             usage_width = max(usage_width, len(info.get_partition_usage(partition)))
-    for vgroup in info.list_lvm_volume_groups():
+    if info.list_lvm_volume_groups():
         for lv in info.list_lvm_logical_volumes():
             name_width = max(name_width, len(lv.name) + 1)
             usage_width = max(usage_width, len(info.get_partition_usage(lv.device)))
+    # by now we've asked all the questions that could produce warnings
+    for message in info.warnings:
+        warn(message)
     reporter = reporter_class(
         verbose=verbose, fmt_size=fmt_size, print=print,
         name_width=name_width, usage_width=usage_width,
@@ -821,6 +1109,59 @@ def report(info=None, verbose=1, name_width=8, usage_width=30,
     reporter.end_report()
 
 
+def unescape_mount_path(path):
+    # /proc/mounts uses octal escapes for spaces and other special characters
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+
+def fingerprint():
+    """Return a value that changes whenever report() output would change.
+
+    Doesn't run any of the external commands report() needs.  Free space is
+    included with the precision we display it at.
+    """
+    result = []
+    for filename in ['/proc/partitions', '/proc/swaps', '/proc/self/mounts']:
+        try:
+            with open(filename) as f:
+                result.append(f.read())
+        except IOError:
+            result.append(None)
+    for dirname in ['/dev/mapper']:
+        try:
+            names = sorted(os.listdir(dirname))
+        except OSError:
+            names = []
+        for name in names:
+            pathname = os.path.join(dirname, name)
+            if os.path.islink(pathname):
+                result.append((pathname, os.readlink(pathname)))
+            else:
+                result.append(pathname)
+    for dirname in ['/etc/lvm/backup', '/etc/libvirt/qemu']:
+        try:
+            names = sorted(os.listdir(dirname))
+        except OSError:
+            names = []
+        for name in names:
+            pathname = os.path.join(dirname, name)
+            try:
+                result.append((pathname, os.stat(pathname).st_mtime))
+            except OSError:
+                pass
+    for line in (result[2] or '').splitlines():
+        parts = line.split()
+        if len(parts) < 2 or not parts[0].startswith('/dev/'):
+            continue
+        mountpoint = unescape_mount_path(parts[1])
+        try:
+            st = os.statvfs(mountpoint)
+        except OSError:
+            continue
+        result.append((mountpoint, fmt_size_decimal(st.f_bavail * st.f_frsize)))
+    return result
+
+
 def report_text(**kw):
     text = []
     report(print=text.append, warn=text.append, **kw)
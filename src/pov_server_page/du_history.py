@@ -0,0 +1,278 @@
+"""
+Per-path size history across disk usage snapshots.
+
+Answering "how did /var/lib/postgresql grow over the last two months?" from
+the snapshots themselves means decompressing and parsing every one of them.
+SizeHistory keeps the same numbers in a columnar layout instead::
+
+    history/paths               every path seen, one per line
+    history/paths.index         (offset in paths, path number) pairs, sorted
+                                by path, as an array of 64-bit integers
+    history/2015-11-01.sizes    the size of every path in du-2015-11-01.gz,
+                                as an array of 64-bit integers (ABSENT if the
+                                path didn't exist back then)
+
+The path dictionary only grows (until it's compacted), so the columns of
+older snapshots stay valid when new paths show up.  Looking up a path means
+a binary search in the index, and then reading 8 bytes from each column.
+
+The history is derived data: if anything goes wrong, delete the history
+directory and the next update will rebuild it from the snapshots.
+"""
+
+import array
+import bisect
+import glob
+import gzip
+import os
+import shutil
+
+
+HISTORY_DIR = 'history'
+
+# Size of a path in a snapshot that doesn't have it
+ABSENT = -1
+
+# Rewrite the path dictionary when it has this many times more paths than
+# the biggest column has sizes
+COMPACT_RATIO = 2
+
+
+def snapshot_date(snapshot):
+    """du-2015-11-01.gz -> 2015-11-01"""
+    return os.path.basename(snapshot)[len('du-'):-len('.gz')]
+
+
+def new_column(size=0):
+    return array.array('q', [ABSENT]) * size
+
+
+ITEM_SIZE = new_column().itemsize
+
+
+class SortedPaths(object):
+    """The path dictionary in sorted order, read from disk as needed.
+
+    Supports len() and indexing, so bisect can search it.
+    """
+
+    def __init__(self, index, paths):
+        self.index = index
+        self.paths = paths
+        self.index.seek(0, os.SEEK_END)
+        self.size = self.index.tell() // (2 * ITEM_SIZE)
+
+    def __len__(self):
+        return self.size
+
+    def entry(self, k):
+        """Return (offset, path number) of the k-th path in sorted order."""
+        entry = new_column()
+        self.index.seek(k * 2 * ITEM_SIZE)
+        entry.frombytes(self.index.read(2 * ITEM_SIZE))
+        return entry[0], entry[1]
+
+    def __getitem__(self, k):
+        offset, n = self.entry(k)
+        self.paths.seek(offset)
+        return self.paths.readline().rstrip(b'\n')
+
+
+class SizeHistory(object):
+    """Sizes of every directory in every snapshot of one location."""
+
+    compact_ratio = COMPACT_RATIO
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.dirname = os.path.join(datadir, HISTORY_DIR)
+
+    @property
+    def paths_file(self):
+        return os.path.join(self.dirname, 'paths')
+
+    @property
+    def index_file(self):
+        return self.paths_file + '.index'
+
+    def column_filename(self, date, dirname=None):
+        return os.path.join(dirname or self.dirname, '%s.sizes' % date)
+
+    def dates(self):
+        """Return the dates of snapshots that have columns, oldest first."""
+        return sorted(
+            os.path.basename(fn)[:-len('.sizes')]
+            for fn in glob.glob(self.column_filename('????-??-??')))
+
+    def load_paths(self):
+        try:
+            with open(self.paths_file, 'rb') as f:
+                return [line.rstrip(b'\n') for line in f]
+        except IOError:
+            return []
+
+    def load_column(self, date):
+        column = new_column()
+        with open(self.column_filename(date), 'rb') as f:
+            column.frombytes(f.read())
+        return column
+
+    @staticmethod
+    def save(filename, data):
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(filename + '.tmp', filename)
+
+    def save_paths(self, paths, dirname=None):
+        """Save the path dictionary and its sorted index.
+
+        Readers that see the new dictionary with the old index are fine:
+        the dictionary only grows, so the old offsets still work.
+        """
+        dirname = dirname or self.dirname
+        offsets = []
+        offset = 0
+        for path in paths:
+            offsets.append(offset)
+            offset += len(path) + 1
+        index = new_column()
+        for n in sorted(range(len(paths)), key=paths.__getitem__):
+            index.append(offsets[n])
+            index.append(n)
+        self.save(os.path.join(dirname, 'paths'),
+                  b''.join(path + b'\n' for path in paths))
+        self.save(os.path.join(dirname, 'paths.index'), index.tobytes())
+
+    def update(self, snapshots, verbose=False):
+        """Make the columns match the set of snapshot files.
+
+        Adds columns for new snapshots, and drops (and eventually compacts
+        away) the columns of snapshots that were deleted.
+        """
+        wanted = dict((snapshot_date(fn), fn) for fn in snapshots)
+        have = self.dates()
+        stale = [date for date in have if date not in wanted]
+        if stale:
+            self.prune(stale, verbose=verbose)
+        missing = sorted(date for date in wanted if date not in have)
+        if not missing:
+            return
+        if not os.path.isdir(self.dirname):
+            os.mkdir(self.dirname)
+        paths = self.load_paths()
+        index = dict((path, n) for n, path in enumerate(paths))
+        for date in missing:
+            if verbose:
+                print("Adding %s to %s" % (wanted[date], self.dirname))
+            old_size = len(paths)
+            column = self.read_snapshot(wanted[date], paths, index)
+            if column is None:
+                continue
+            # The dictionary goes first, so a column never refers to paths
+            # that aren't there
+            if len(paths) > old_size:
+                self.save_paths(paths)
+            self.save(self.column_filename(date), column.tobytes())
+
+    @staticmethod
+    def read_snapshot(snapshot, paths, index):
+        """Read a snapshot into a column.
+
+        New paths are appended to ``paths`` and ``index``.  Returns None if
+        the snapshot cannot be read.
+        """
+        sizes = {}
+        try:
+            with gzip.open(snapshot) as f:
+                for line in f:
+                    size, _, path = line.rstrip(b'\n').partition(b'\t')
+                    if path:
+                        sizes[path] = int(size)
+        except (IOError, OSError, EOFError, ValueError):
+            return None
+        for path in sorted(set(sizes).difference(index)):
+            index[path] = len(paths)
+            paths.append(path)
+        column = new_column(len(paths))
+        for path, size in sizes.items():
+            column[index[path]] = size
+        return column
+
+    def prune(self, dates, verbose=False):
+        """Drop the columns of these snapshots."""
+        for date in dates:
+            if verbose:
+                print("Removing %s from %s" % (date, self.dirname))
+            os.unlink(self.column_filename(date))
+        n_paths = len(self.load_paths())
+        biggest = max([len(column) - column.count(ABSENT)
+                       for column in map(self.load_column, self.dates())] or [0])
+        if n_paths > biggest * self.compact_ratio:
+            self.compact(verbose=verbose)
+
+    def compact(self, verbose=False):
+        """Rewrite the dictionary without the paths no column refers to."""
+        if verbose:
+            print("Compacting %s" % self.dirname)
+        paths = self.load_paths()
+        dates = self.dates()
+        used = bytearray(len(paths))
+        for date in dates:
+            for n, size in enumerate(self.load_column(date)):
+                if size != ABSENT:
+                    used[n] = 1
+        keep = [n for n, flag in enumerate(used) if flag]
+        # Write a new history directory and swap it in, so readers never
+        # see a dictionary that doesn't match the columns
+        new_dirname = self.dirname + '.new'
+        old_dirname = self.dirname + '.old'
+        shutil.rmtree(new_dirname, ignore_errors=True)
+        os.mkdir(new_dirname)
+        self.save_paths([paths[n] for n in keep], new_dirname)
+        for date in dates:
+            column = self.load_column(date)
+            self.save(self.column_filename(date, new_dirname),
+                      array.array('q', [column[n] if n < len(column) else ABSENT
+                                        for n in keep]).tobytes())
+        shutil.rmtree(old_dirname, ignore_errors=True)
+        os.rename(self.dirname, old_dirname)
+        os.rename(new_dirname, self.dirname)
+        shutil.rmtree(old_dirname)
+
+    def find_path(self, path):
+        """Return the number of a path in the dictionary, or None."""
+        try:
+            with open(self.index_file, 'rb') as index:
+                with open(self.paths_file, 'rb') as paths:
+                    sorted_paths = SortedPaths(index, paths)
+                    k = bisect.bisect_left(sorted_paths, path)
+                    if k < len(sorted_paths) and sorted_paths[k] == path:
+                        return sorted_paths.entry(k)[1]
+        except IOError:
+            pass
+        return None
+
+    def lookup(self, path):
+        """Return [(date, size)] for a path, oldest first.
+
+        ``path`` is bytes.  Sizes are in kibibytes, like du reports them, or
+        None for snapshots that don't have the path.  Returns None if the
+        path was never seen.
+        """
+        n = self.find_path(path)
+        if n is None:
+            return None
+        history = []
+        for date in self.dates():
+            value = new_column()
+            try:
+                with open(self.column_filename(date), 'rb') as f:
+                    f.seek(n * ITEM_SIZE)
+                    value.frombytes(f.read(ITEM_SIZE))
+            except (IOError, ValueError):
+                # deleted while we were looking, or written by an older
+                # update that didn't know this path yet
+                pass
+            size = value[0] if value else ABSENT
+            history.append((date, size if size != ABSENT else None))
+        return history
@@ -0,0 +1,553 @@
+"""
+Resumable disk usage scans.
+
+``du -x /home`` can take hours on a large partition, and if it gets killed
+(reboot, OOM) halfway through, all that work is lost.  DuScan walks the
+top-level subdirectories one by one instead, and saves a checkpoint every
+time one of them is done, so the next run can pick up where the last one
+left off.
+
+The result is the same as ``du -x location | gzip``, except that the
+lines of the top-level subdirectories come in sorted order, and the file
+has one gzip member per checkpoint (which zcat and gzip.open() don't mind).
+
+The walk itself is done by find, which tells us the type and the size of
+every file in one pass; we add up the directory sizes the way du would.
+While find is running, IOThrottle pauses it whenever other processes are
+waiting for the disks.
+
+Since we see every file anyway, we also keep track of the largest files and
+the largest directories (not counting their subdirectories).  When the scan is done, we compare it with the previous
+snapshot to find the directories that grew the most.  These lists end up in
+the snapshot metadata (see load_metadata()).
+"""
+
+import errno
+import gzip
+import heapq
+import json
+import os
+import signal
+import stat
+import subprocess
+import threading
+import time
+
+
+# Don't resume scans older than this: we'd be mixing data from different
+# weeks into one snapshot
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600  # seconds
+
+PSI_FILE = '/proc/pressure/io'
+
+# file type, device, inode, link count, size in 512-byte blocks, path
+FIND_FORMAT = '%y\t%D\t%i\t%n\t%b\t%p\n'
+
+
+class ScanError(Exception):
+    """The scan failed; whatever was checkpointed so far can be resumed."""
+
+
+def read_io_pressure(filename=PSI_FILE):
+    """Return the total time (in microseconds) some task was stalled on I/O.
+
+    Returns None if the kernel doesn't provide pressure stall information.
+    """
+    try:
+        with open(filename) as f:
+            for line in f:
+                if line.startswith('some '):
+                    return int(line.rpartition('total=')[2])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def metadata_filename(snapshot):
+    """du-2015-11-01.gz -> du-2015-11-01.json"""
+    return os.path.splitext(snapshot)[0] + '.json'
+
+
+def load_metadata(snapshot):
+    """Load the metadata of a snapshot (how long the scan took etc.).
+
+    Returns {} for snapshots made by older versions.
+    """
+    try:
+        with open(metadata_filename(snapshot)) as f:
+            metadata = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+
+# Lists of (size, path) kept in the snapshot metadata
+TOP_LISTS = ('largest_files', 'largest_dirs', 'fastest_growing')
+
+
+class Largest(object):
+    """Keep the n largest (size, path) pairs seen so far."""
+
+    def __init__(self, n, items=()):
+        self.n = n
+        self.heap = [tuple(item) for item in items]
+        heapq.heapify(self.heap)
+
+    def add(self, size, path):
+        """Add an item, unless it's smaller than the n we already have.
+
+        ``path`` is bytes, and is decoded only if it makes the list.
+        """
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (size, path.decode('UTF-8', 'replace')))
+        elif size > self.heap[0][0]:
+            heapq.heapreplace(self.heap,
+                              (size, path.decode('UTF-8', 'replace')))
+
+    def items(self):
+        return [list(item) for item in sorted(self.heap, reverse=True)]
+
+
+class ExclusiveSizes(object):
+    """Compute directory sizes not counting their subdirectories.
+
+    Relies on du listing every directory after all of its subdirectories,
+    so it only needs to remember one number per directory that's still
+    being scanned.
+    """
+
+    def __init__(self):
+        self.children = {}
+
+    def add(self, size, path):
+        """Add a directory from du output, return its exclusive size."""
+        exclusive = size - self.children.pop(path, 0)
+        parent = os.path.dirname(path)
+        self.children[parent] = self.children.get(parent, 0) + size
+        return exclusive
+
+
+def kib(blocks):
+    """Convert 512-byte blocks to KiB, rounding up like du does."""
+    return (blocks + 1) // 2
+
+
+class DirectorySizes(object):
+    """Add up directory sizes from a find -depth listing.
+
+    find -depth lists every directory after everything inside it, so we
+    only need to remember two numbers per directory that's still being
+    scanned.  Sizes are in 512-byte blocks.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.subdirectories = {}
+
+    def add_file(self, blocks, path):
+        parent = os.path.dirname(path)
+        self.files[parent] = self.files.get(parent, 0) + blocks
+
+    def add_directory(self, blocks, path):
+        """Add a directory, return its (total, exclusive) size.
+
+        The exclusive size doesn't count subdirectories.
+        """
+        exclusive = blocks + self.files.pop(path, 0)
+        total = exclusive + self.subdirectories.pop(path, 0)
+        parent = os.path.dirname(path)
+        self.subdirectories[parent] = (
+            self.subdirectories.get(parent, 0) + total)
+        return total, exclusive
+
+
+def sorted_exclusive_sizes(snapshot):
+    """Yield (path, size not counting subdirectories) from a snapshot.
+
+    The paths come in sorted order.  sort(1) does the sorting (spilling to
+    temporary files if it has to), so this needs constant memory no matter
+    how big the snapshot is.
+    """
+    p = subprocess.Popen(['sort', '-t', '\t', '-k', '2'],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         env=dict(os.environ, LC_ALL='C'))
+    try:
+        try:
+            exclusive = ExclusiveSizes()
+            with gzip.open(snapshot) as f:
+                for line in f:
+                    size, _, path = line.rstrip(b'\n').partition(b'\t')
+                    if path:
+                        size = exclusive.add(int(size), path)
+                        p.stdin.write(b'%d\t%s\n' % (size, path))
+        finally:
+            p.stdin.close()
+        for line in p.stdout:
+            size, _, path = line.rstrip(b'\n').partition(b'\t')
+            yield path, int(size)
+    finally:
+        p.stdout.close()
+        p.wait()
+
+
+def snapshot_growth(old, new):
+    """Compare two snapshots, yield (growth, path) for directories that grew.
+
+    Compares directory sizes not counting subdirectories.  Directories that
+    are not in the ``old`` snapshot grew from 0.  Both snapshots are sorted
+    and compared side by side, so this needs constant memory.
+    """
+    old_sizes = sorted_exclusive_sizes(old)
+    try:
+        old_path, old_size = next(old_sizes, (None, 0))
+        for path, size in sorted_exclusive_sizes(new):
+            while old_path is not None and old_path < path:
+                old_path, old_size = next(old_sizes, (None, 0))
+            growth = size - old_size if old_path == path else size
+            if growth > 0:
+                yield growth, path
+    finally:
+        old_sizes.close()
+
+
+class IOThrottle(object):
+    """Pause a process while other processes are waiting for the disks.
+
+    ``ionice -c3`` is ignored by I/O schedulers like mq-deadline or none,
+    so instead every ``interval`` seconds we stop the process with SIGSTOP
+    and watch the I/O pressure for a second.  If other tasks are still
+    stalled on I/O, we keep it stopped until they're done (or until
+    ``max_pause`` seconds pass) and check again sooner next time; if the
+    system is idle, we check less and less often.
+
+    Keeps counters in ``stats``: how many times we checked, how many times
+    we had to pause, the total number of seconds the process spent stopped
+    for the checks themselves, and the total number of seconds it spent
+    stopped because the disks were busy.
+    """
+
+    threshold = 0.1  # fraction of time some task was stalled on I/O
+    probe_time = 1  # seconds
+    min_interval = 1  # seconds
+    max_interval = 60  # seconds
+    max_pause = 60  # seconds
+
+    def __init__(self, pid, stats=None, pressure=read_io_pressure,
+                 kill=os.kill):
+        self.pid = pid
+        self.stats = stats if stats is not None else {}
+        for name in ('probes', 'pauses', 'probing', 'paused'):
+            self.stats.setdefault(name, 0)
+        self.pressure = pressure
+        self.kill = kill
+        self.interval = self.min_interval
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.pressure() is None:
+            return
+        self.thread = threading.Thread(target=self.run, name='IOThrottle')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.step()
+
+    def send(self, signum):
+        try:
+            self.kill(self.pid, signum)
+        except OSError:
+            self.done.set()  # it's gone
+
+    def busy(self):
+        """Watch the I/O pressure for probe_time seconds."""
+        before = self.pressure()
+        self.done.wait(self.probe_time)
+        after = self.pressure()
+        if before is None or after is None:
+            return False
+        return (after - before) / 1e6 / self.probe_time > self.threshold
+
+    def step(self):
+        self.send(signal.SIGSTOP)
+        started = time.time()
+        busy = False
+        try:
+            self.stats['probes'] += 1
+            busy = not self.done.is_set() and self.busy()
+            probed = time.time()
+            while (busy and not self.done.is_set()
+                   and time.time() - started < self.max_pause
+                   and self.busy()):
+                pass
+        finally:
+            self.send(signal.SIGCONT)
+            stopped = time.time()
+            # The first probe happens whether the disks are busy or not;
+            # only the time after it is a pause on account of other programs
+            if busy:
+                self.stats['probing'] += probed - started
+                self.stats['paused'] += stopped - probed
+            else:
+                self.stats['probing'] += stopped - started
+        if busy:
+            self.stats['pauses'] += 1
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+
+
+class DuScan(object):
+    """A disk usage scan of ``location``, written to ``output``.
+
+    ``command_prefix`` is prepended to the find command line (e.g. to run
+    it with nice and ionice).  With ``throttle`` find is paused whenever
+    other processes are waiting for I/O (see IOThrottle).
+
+    Progress is kept in du-partial.gz and du-partial.json next to
+    ``output``.  If find fails, run() raises ScanError and leaves them there
+    for the next run.  When the scan is done, its metadata (how long it
+    took, how long it was paused, the ``top`` largest files etc., compared
+    with the ``previous`` snapshot) is saved next to the snapshot (see
+    load_metadata()).
+    """
+
+    def __init__(self, location, output, command_prefix=(), throttle=True,
+                 previous=None, top=20):
+        self.location = location
+        self.output = output
+        self.command_prefix = list(command_prefix)
+        self.throttle = throttle
+        self.previous = previous
+        self.top = top
+        self.largest = {}
+        dirname = os.path.dirname(output)
+        self.partial_file = os.path.join(dirname, 'du-partial.gz')
+        self.checkpoint_file = os.path.join(dirname, 'du-partial.json')
+
+    def entries(self):
+        """List (name, stat) of top-level entries on the same filesystem."""
+        try:
+            dev = os.lstat(self.location).st_dev
+            names = sorted(os.listdir(self.location))
+        except OSError as e:
+            raise ScanError('Cannot scan %s: %s' % (self.location, e.strerror))
+        result = []
+        for name in names:
+            try:
+                st = os.lstat(os.path.join(self.location, name))
+            except OSError:
+                continue  # deleted while we were looking
+            if st.st_dev == dev:
+                result.append((name, st))
+        return result
+
+    def subdirectories(self):
+        """List the top-level subdirectories that du -x would descend into.
+
+        Skips symlinks and mount points.
+        """
+        return [name for name, st in self.entries()
+                if stat.S_ISDIR(st.st_mode)]
+
+    def top_level_files(self):
+        """List (size, path) of top-level files, with sizes in KiB like du."""
+        return [(kib(st.st_blocks),
+                 os.fsencode(os.path.join(self.location, name)))
+                for name, st in self.entries()
+                if not stat.S_ISDIR(st.st_mode)]
+
+    def own_size(self):
+        """Return the size of the location without subdirectories, in KiB."""
+        try:
+            blocks = os.lstat(self.location).st_blocks
+        except OSError as e:
+            raise ScanError('Cannot scan %s: %s' % (self.location, e.strerror))
+        return kib(blocks + sum(st.st_blocks for name, st in self.entries()
+                                if not stat.S_ISDIR(st.st_mode)))
+
+    def load_checkpoint(self, now=None):
+        """Load the checkpoint of an interrupted scan of this location.
+
+        Returns None if there's nothing to resume.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            size = os.path.getsize(self.partial_file)
+        except (IOError, OSError, ValueError):
+            return None
+        if (not isinstance(checkpoint, dict)
+                or checkpoint.get('location') != self.location
+                or not 0 <= now - checkpoint.get('started', 0) < CHECKPOINT_MAX_AGE
+                or not 0 <= checkpoint.get('offset', -1) <= size
+                or not isinstance(checkpoint.get('done'), dict)):
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        with open(self.checkpoint_file + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+    def find(self, *paths):
+        return subprocess.Popen(
+            self.command_prefix + ['find'] + list(paths)
+            + ['-xdev', '-depth', '-printf', FIND_FORMAT],
+            stdout=subprocess.PIPE)
+
+    def run(self, verbose=False):
+        """Scan the disk usage, resuming an interrupted scan if possible.
+
+        Returns the metadata: a dict with the time the scan took in seconds
+        ('elapsed', including the time spent by any earlier interrupted
+        runs), the IOThrottle counters ('throttle'), and lists of
+        [size, path] for each of TOP_LISTS.
+        """
+        started = time.time()
+        checkpoint = self.load_checkpoint(started)
+        if checkpoint is None:
+            checkpoint = dict(location=self.location, started=started,
+                              elapsed=0, done={}, offset=0, throttle={},
+                              top={})
+        elif verbose:
+            print('Resuming the scan of %s (%d directories done)'
+                  % (self.location, len(checkpoint['done'])))
+        elapsed = checkpoint['elapsed']
+        checkpoint.setdefault('throttle', {})
+        top = checkpoint.setdefault('top', {})
+        self.largest = dict((name, Largest(self.top, top.get(name, ())))
+                            for name in TOP_LISTS)
+        with open(self.partial_file, 'ab') as f:
+            f.truncate(checkpoint['offset'])
+        todo = [name for name in self.subdirectories()
+                if name not in checkpoint['done']]
+        if todo:
+            self.scan_subdirectories(todo, checkpoint, started)
+        # The location itself, without subdirectories
+        own_size = self.own_size()
+        total = own_size + sum(checkpoint['done'].values())
+        with gzip.open(self.partial_file, 'ab') as f:
+            f.write(b'%d\t%s\n' % (total, os.fsencode(self.location)))
+        self.add_directory(own_size, os.fsencode(self.location))
+        for size, path in self.top_level_files():
+            self.largest['largest_files'].add(size, path)
+        self.largest['fastest_growing'] = self.fastest_growing()
+        metadata = dict(location=self.location,
+                        elapsed=elapsed + time.time() - started,
+                        throttle=checkpoint['throttle'])
+        for name in TOP_LISTS:
+            metadata[name] = self.largest[name].items()
+        with open(metadata_filename(self.output), 'w') as f:
+            json.dump(metadata, f)
+        os.rename(self.partial_file, self.output)
+        try:
+            os.unlink(self.checkpoint_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return metadata
+
+    def add_directory(self, exclusive_size, path):
+        self.largest['largest_dirs'].add(exclusive_size, path)
+
+    def fastest_growing(self):
+        """Compare the finished scan with the previous snapshot."""
+        growing = Largest(self.top)
+        if not self.previous:
+            return growing
+        try:
+            for growth, path in snapshot_growth(self.previous,
+                                                self.partial_file):
+                growing.add(growth, path)
+        except (IOError, OSError, EOFError, ValueError):
+            # the previous snapshot is unreadable
+            return Largest(self.top)
+        return growing
+
+    def scan_subdirectories(self, todo, checkpoint, started):
+        try:
+            dev = os.lstat(self.location).st_dev
+        except OSError as e:
+            raise ScanError('Cannot scan %s: %s' % (self.location, e.strerror))
+        paths = dict((os.fsencode(os.path.join(self.location, name)), name)
+                     for name in todo)
+        p = self.find(*[os.path.join(self.location, name) for name in todo])
+        throttle = IOThrottle(p.pid, checkpoint['throttle'])
+        if self.throttle:
+            throttle.start()
+        sizes = DirectorySizes()
+        # inodes of files with more than one link that we've already seen:
+        # like du, we count them once
+        hardlinks = set()
+        out = None
+        finished = False
+        try:
+            for line in p.stdout:
+                try:
+                    kind, st_dev, ino, nlink, blocks, path = (
+                        line.rstrip(b'\n').split(b'\t', 5))
+                    st_dev, ino, nlink, blocks = map(
+                        int, (st_dev, ino, nlink, blocks))
+                except ValueError:
+                    continue  # the rest of a file name with a newline in it
+                if st_dev != dev:
+                    continue  # a mount point, which du -x leaves out
+                if kind != b'd':
+                    if nlink > 1:
+                        if ino in hardlinks:
+                            continue
+                        hardlinks.add(ino)
+                    sizes.add_file(blocks, path)
+                    self.largest['largest_files'].add(kib(blocks), path)
+                    continue
+                total, exclusive = sizes.add_directory(blocks, path)
+                size = kib(total)
+                if out is None:
+                    out = gzip.open(self.partial_file, 'ab')
+                out.write(b'%d\t%s\n' % (size, path))
+                self.add_directory(kib(exclusive), path)
+                if path in paths:
+                    out.close()
+                    checkpoint['done'][paths[path]] = size
+                    checkpoint['offset'] = os.path.getsize(self.partial_file)
+                    checkpoint['elapsed'] += time.time() - started
+                    checkpoint['top'] = dict(
+                        (name, self.largest[name].items())
+                        for name in TOP_LISTS)
+                    started = time.time()
+                    self.save_checkpoint(checkpoint)
+                    out = None
+            finished = True
+        finally:
+            throttle.stop()
+            if out is not None:
+                out.close()
+            p.stdout.close()
+            if not finished:
+                # We're bailing out with an exception.  Don't leave find
+                # running without us, or stopped forever if SIGSTOP from
+                # IOThrottle (or anyone else) was the last signal it got.
+                p.send_signal(signal.SIGCONT)
+                p.terminate()
+            p.wait()
+        if p.returncode not in (0, 1):
+            # Killed (OOM killer, reboot) or broken.  Directories find
+            # didn't finish are not done: keep the checkpoint, so the next
+            # run resumes instead of renaming an incomplete snapshot into
+            # place.
+            raise ScanError('find -xdev failed in %s (exit status %d)'
+                            % (self.location, p.returncode))
+        for name in todo:
+            # find complained about it (exit status 1): it vanished, or it's
+            # unreadable
+            checkpoint['done'].setdefault(name, 0)
@@ -1,20 +1,25 @@
 #!/usr/bin/python
 """
-WSGI application that renders du-diff output
+WSGI application that renders du-diff output and per-path size history
 """
 
+import json
 import os
 import re
 import textwrap
 
-import mako.template
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
 
-from .utils import mako_error_handler
+from .utils import CACHE_DIR, LazyTemplate, compile_template, mako_error_handler
 from .du_diff import du_diff, format_du_diff
+from .du_history import SizeHistory
 
 
 __author__ = 'Marius Gedminas <marius@gedmin.as>'
-__version__ = '0.5'
+__version__ = '0.6'
 __date__ = '2018-01-19'
 
 
@@ -45,6 +50,11 @@ def fmt(delta):
     return '{size:+,.1f} {unit}'.format(size=size, unit=unit)
 
 
+def fmt_size(size):
+    # like fmt(), but for sizes rather than deltas
+    return fmt(size).lstrip('+')
+
+
 class Response(object):
 
     def __init__(self, body='', content_type='text/html; charset=UTF-8',
@@ -59,8 +69,12 @@ def not_found():
     return Response('<h1>404 Not Found</h1>', status='404 Not Found')
 
 
+TEMPLATE_CACHE_DIR = os.path.join(CACHE_DIR, 'dudiff2html') if CACHE_DIR else None
+
+
 def Template(*args, **kw):
-    return mako.template.Template(
+    return compile_template(
+        cache_dir=TEMPLATE_CACHE_DIR,
         error_handler=mako_error_handler,
         strict_undefined=True,
         default_filters=['unicode', 'h'],
@@ -89,6 +103,21 @@ STYLESHEET = textwrap.dedent('''
     .du-diff th:hover {
         background: #f5f5f5;
     }
+
+    .sparkline polyline {
+        fill: none;
+        stroke: #337ab7;
+        stroke-width: 1.5;
+    }
+    .sparkline circle {
+        fill: #337ab7;
+    }
+    .du-history {
+        width: auto;
+    }
+    .du-history td + td {
+        text-align: right;
+    }
 '''.lstrip('\n'))
 
 
@@ -102,7 +131,7 @@ def bootstrap_stylesheet():
         return Response(f.read(), content_type='text/css')
 
 
-dudiff_template = Template(textwrap.dedent('''
+dudiff_template = LazyTemplate(Template, uri="dudiff.html", text=textwrap.dedent('''
     <!DOCTYPE html>
     <html lang="en">
       <head>
@@ -188,6 +217,126 @@ def render_du_diff(environ, location, old, new, format=None):
     return Response(html)
 
 
+SPARKLINE_WIDTH = 600
+SPARKLINE_HEIGHT = 80
+
+
+def sparkline(sizes, width=SPARKLINE_WIDTH, height=SPARKLINE_HEIGHT, margin=4):
+    """Compute SVG coordinates for a list of sizes.
+
+    Returns a list of lines, each a list of (x, y) points.  Missing sizes
+    (None) break the line.
+    """
+    known = [size for size in sizes if size is not None]
+    if not known:
+        return []
+    lo, hi = min(known), max(known)
+    step = (width - 2 * margin) / float(max(len(sizes) - 1, 1))
+    scale = (height - 2 * margin) / float(hi - lo) if hi > lo else 0
+    lines = []
+    line = None
+    for n, size in enumerate(sizes):
+        if size is None:
+            line = None
+            continue
+        if line is None:
+            line = []
+            lines.append(line)
+        x = margin + n * step
+        y = height - margin - (size - lo) * scale if scale else height / 2.0
+        line.append((round(x, 1), round(y, 1)))
+    return lines
+
+
+history_template = LazyTemplate(Template, uri="history.html", text=textwrap.dedent('''
+    <!DOCTYPE html>
+    <html lang="en">
+      <head>
+        <meta charset="UTF-8">
+        <meta http-equiv="X-UA-Compatible" content="IE=edge">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+
+        <title>Disk usage history of ${path}</title>
+
+        <link rel="stylesheet" href="/static/css/bootstrap.min.css">
+        <link rel="stylesheet" href="${prefix}/style.css">
+      </head>
+      <body>
+        <h1>Disk usage history of ${path} <small>${location}</small></h1>
+
+        <svg class="sparkline" width="${width}" height="${height}" viewBox="0 0 ${width} ${height}">
+    % for line in lines:
+          <polyline points="${' '.join('%s,%s' % point for point in line)}" />
+    %   for x, y in line:
+          <circle cx="${x}" cy="${y}" r="2" />
+    %   endfor
+    % endfor
+        </svg>
+
+        <table class="du-history table table-hover">
+          <thead>
+            <tr>
+              <th>Snapshot</th>
+              <th>Size</th>
+              <th>Change</th>
+            </tr>
+          </thead>
+          <tbody>
+    % for date, size, delta in rows:
+            <tr>
+              <td>${date}</td>
+              <td>${fmt_size(size) if size is not None else '-'}</td>
+              <td>${fmt(delta) if delta is not None else ''}</td>
+            </tr>
+    % endfor
+          </tbody>
+        </table>
+        <p><a href="?format=json">JSON</a></p>
+      </body>
+    </html>
+'''))
+
+
+def render_history(environ, location, path, format=None):
+    if '.' in location or '/' in location:
+        return not_found()
+    directory = os.path.join(get_directory(environ), location)
+    if not os.path.isdir(directory):
+        return not_found()
+    # PEP 3333: PATH_INFO holds the raw bytes of the path decoded as Latin-1,
+    # and du paths are raw bytes too
+    raw_path = path.encode('latin-1')
+    history = SizeHistory(directory).lookup(raw_path)
+    if not history:
+        return not_found()
+    path = raw_path.decode('UTF-8', 'replace')
+    dates = [date for date, size in history]
+    sizes = [size for date, size in history]
+    if format != 'html':
+        body = json.dumps(dict(
+            location=location, path=path, dates=dates,
+            # du reports sizes in kibibytes
+            sizes=[size * 1024 if size is not None else None
+                   for size in sizes]))
+        return Response(body, content_type='application/json')
+    rows = []
+    previous = None
+    for date, size in history:
+        if size is not None and previous is not None:
+            delta = size - previous
+        else:
+            delta = None
+        rows.append((date, size, delta))
+        if size is not None:
+            previous = size
+    html = history_template.render_unicode(
+        location=location, path=path,
+        rows=rows[::-1], fmt=fmt, fmt_size=fmt_size,
+        lines=sparkline(sizes), width=SPARKLINE_WIDTH, height=SPARKLINE_HEIGHT,
+        prefix=get_prefix(environ))
+    return Response(html)
+
+
 def dispatch(environ):
     path_info = environ['PATH_INFO'] or '/'
     if path_info == '/style.css':
@@ -195,6 +344,9 @@ def dispatch(environ):
     if path_info == '/static/css/bootstrap.min.css':
         # only used for debugging
         return bootstrap_stylesheet, ()
+    if environ.get('SCRIPT_NAME', '').endswith('/history'):
+        # WSGIScriptAlias /du/history points here too
+        path_info = '/history' + path_info
     components = path_info.strip('/').split('/')
     if len(components) == 2:
         location, dates = components
@@ -202,6 +354,12 @@ def dispatch(environ):
         if m:
             old, new, format = m.groups()
             return render_du_diff, (environ, location, old, new, format)
+    if len(components) >= 2 and components[0] == 'history':
+        location = components[1]
+        path = '/' + '/'.join(components[2:])
+        form = parse_qs(environ.get('QUERY_STRING', ''))
+        format = form.get('format', [None])[0]
+        return render_history, (environ, location, path, format)
     return not_found, ()
 
 
@@ -251,6 +409,7 @@ def main():
     httpd = make_server(host, opts.port, reloading_wsgi_app)
     print("Looking for files under subdirectories under %s" % get_directory({}))
     print("Serving http://%s:%d/<subdir>/<date1>..<date2>[.txt]" % (host, opts.port))
+    print("    and http://%s:%d/history/<subdir>/<path>[?format=html]" % (host, opts.port))
     print("Try http://%s:%d/root/%s..%s"
           % (host, opts.port, datetime.date.today() - datetime.timedelta(1), datetime.date.today()))
     try:
@@ -0,0 +1,121 @@
+"""
+Figure out the name of this machine.
+
+``hostname -f`` may have to ask DNS, which can be slow, or hang.  We ask it
+at most once per process, with a timeout, and remember the answer on disk
+for a while, so the hourly cron runs don't have to ask at all.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import time
+from collections import namedtuple
+
+from .utils import CACHE_DIR
+
+
+CACHE_FILE = os.path.join(CACHE_DIR, 'host-identity.json') if CACHE_DIR else None
+CACHE_TTL = 2 * 3600  # seconds
+TIMEOUT = 5  # seconds
+
+# Files that affect the answer; the on-disk cache is discarded if they change
+HOSTNAME_FILES = ['/etc/hostname', '/etc/hosts']
+
+# socket.getfqdn() and hostname -f return these on some Ubuntu versions
+BOGUS_FQDNS = ('localhost', 'localhost.localdomain', 'localhost6.localdomain6')
+
+
+HostIdentity = namedtuple('HostIdentity', 'nodename fqdn short_name collectd_hostname')
+
+
+def resolve_fqdn(timeout=TIMEOUT):
+    """Return the fully-qualified hostname, or None if we can't tell."""
+    # socket.getfqdn() likes to get confused on Ubuntu and return
+    # 'localhost6.localdomain' etc., and it cannot be interrupted.
+    try:
+        fqdn = subprocess.run(
+            ['hostname', '-f'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, timeout=timeout, check=True,
+            universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if not fqdn or fqdn in BOGUS_FQDNS:
+        return None
+    return fqdn
+
+
+def make_identity(nodename, fqdn):
+    return HostIdentity(
+        nodename=nodename,
+        fqdn=fqdn,
+        short_name=fqdn.partition('.')[0],
+        # collectd's FQDNLookup option defaults to true
+        collectd_hostname=fqdn,
+    )
+
+
+def cache_key(nodename):
+    key = [nodename]
+    for filename in HOSTNAME_FILES:
+        try:
+            key.append(os.stat(filename).st_mtime)
+        except OSError:
+            key.append(None)
+    return key
+
+
+def load_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def save_cache(cache_file, key, fqdn):
+    try:
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(dict(key=key, fqdn=fqdn, time=time.time()), f)
+        os.rename(cache_file + '.tmp', cache_file)
+    except (OSError, IOError):
+        pass  # we're not root; never mind
+
+
+def get_host_identity(cache_file=CACHE_FILE, timeout=TIMEOUT, _cache={}):
+    """Return a HostIdentity for this machine.
+
+    The answer is computed once per process.
+    """
+    if 'identity' not in _cache:
+        _cache['identity'] = compute_host_identity(cache_file, timeout)
+    return _cache['identity']
+
+
+def compute_host_identity(cache_file=CACHE_FILE, timeout=TIMEOUT):
+    nodename = socket.gethostname()
+    key = cache_key(nodename)
+    cached = load_cache(cache_file) if cache_file else None
+    if (isinstance(cached, dict) and cached.get('key') == key
+            and cached.get('fqdn')):
+        if 0 <= time.time() - cached.get('time', 0) < CACHE_TTL:
+            return make_identity(nodename, cached['fqdn'])
+    else:
+        cached = None
+    fqdn = resolve_fqdn(timeout)
+    if fqdn:
+        if cache_file:
+            save_cache(cache_file, key, fqdn)
+    elif cached:
+        # DNS is down?  Stale is better than wrong: the hostname determines
+        # where the website lives.
+        fqdn = cached['fqdn']
+    else:
+        fqdn = nodename
+    return make_identity(nodename, fqdn)
+
+
+def get_fqdn():
+    """Return the fully-qualified hostname."""
+    return get_host_identity().fqdn
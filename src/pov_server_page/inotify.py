@@ -0,0 +1,116 @@
+"""
+Minimal inotify(7) bindings using ctypes.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from collections import namedtuple
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Files being written, replaced, renamed or having their permissions changed
+IN_CHANGES = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+
+EVENT_HEADER = struct.Struct('=iIII')  # wd, mask, cookie, len
+
+
+Event = namedtuple('Event', 'path mask cookie name')
+
+
+def load_libc(_cache={}):
+    if 'libc' not in _cache:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported')
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _cache['libc'] = libc
+    return _cache['libc']
+
+
+def check_error(result, filename=None):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), filename)
+    return result
+
+
+class Inotify(object):
+    """An inotify instance.
+
+    Use add_watch() to watch files or directories, then read() to wait for
+    events.
+    """
+
+    def __init__(self, libc=None):
+        self.libc = libc if libc is not None else load_libc()
+        self.fd = check_error(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.watches = {}  # wd -> path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=IN_CHANGES):
+        wd = check_error(
+            self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask),
+            path)
+        self.watches[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """Wait up to ``timeout`` seconds for events.
+
+        Returns a list of Events, which will be empty if nothing happened.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        return list(self.parse_events(data))
+
+    def parse_events(self, data):
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            yield Event(self.watches.get(wd), mask, cookie, os.fsdecode(name))
@@ -6,17 +6,36 @@ Produce a machine summary table in ReStructuredText
 
 from __future__ import print_function
 
+import functools
+import json
 import optparse
 import os
 import socket
-from collections import Counter
+import struct
+from collections import Counter, namedtuple
+from contextlib import closing
+
+from .host_identity import get_fqdn
+from .netlink import netlink_dump, netlink_socket, unpack_payload
+from .utils import CACHE_DIR
 
 
 __author__ = 'Marius Gedminas <marius@gedmin.as>'
-__version__ = '0.8.2'
+__version__ = '0.9.0'
 __date__ = '2019-10-30'
 
 
+HARDWARE_CACHE_FILE = (os.path.join(CACHE_DIR, 'hardware-facts.json')
+                       if CACHE_DIR else None)
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+
+Summary = namedtuple(
+    'Summary', 'cpu ram disks network_devices ip_addresses os architecture')
+
+Link = namedtuple('Link', 'index name mac')
+
+
 def fmt_with_units(size, units):
     return ('%.1f %s' % (size, units)).replace('.0 ', ' ')
 
@@ -50,12 +69,7 @@ def round_binary(bytes):
 
 def get_hostname():
     """Return the (full) hostname"""
-    hostname = socket.getfqdn()
-    if hostname in ('localhost6.localdomain6', 'localhost.localdomain'):
-        # I'd like to return the full hostname, but socket.getfqdn() is buggy
-        # and returns 'localhost6.localdomain6' on some ubuntu versions
-        hostname = socket.gethostname()
-    return hostname
+    return get_fqdn()
 
 
 def read_file(filename):
@@ -95,7 +109,90 @@ def get_ram_info():
     return 'n/a'
 
 
-def get_disk_info(device):
+def listdir(dirname):
+    try:
+        return sorted(os.listdir(dirname))
+    except OSError:
+        return []
+
+
+class HardwareFacts(object):
+    """Facts that don't change until the next reboot.
+
+    Things like the CPU model, the amount of RAM, disk models and MAC
+    addresses are remembered in a cache file, which is discarded when the
+    machine reboots or when disks appear or disappear.
+
+    Network devices are not part of the cache key: on container hosts veth
+    interfaces come and go all the time.  MAC addresses are cached per
+    interface name instead, and forgotten when the interface goes away.
+    """
+
+    def __init__(self, cache_file=HARDWARE_CACHE_FILE):
+        self.cache_file = cache_file
+        self.key = self.cache_key()
+        self.facts = {}
+        self.changed = False
+        if self.cache_file and self.key:
+            try:
+                with open(self.cache_file) as f:
+                    cached = json.load(f)
+            except (OSError, IOError, ValueError):
+                cached = None
+            if isinstance(cached, dict) and cached.get('key') == self.key:
+                self.facts = cached.get('facts') or {}
+
+    @staticmethod
+    def cache_key():
+        try:
+            boot_id = read_file(BOOT_ID_FILE).strip()
+        except IOError:
+            return None
+        return [boot_id, listdir('/sys/block')]
+
+    def get(self, fn, *args):
+        """Return fn(*args), computing it only if it's not in the cache."""
+        name = ':'.join((fn.__name__, ) + args)
+        if name not in self.facts:
+            self.facts[name] = fn(*args)
+            self.changed = True
+        return self.facts[name]
+
+    def forget(self, fn, keep):
+        """Forget fn(arg) for every arg that's not in keep."""
+        prefix = fn.__name__ + ':'
+        keep = set(prefix + arg for arg in keep)
+        for name in list(self.facts):
+            if name.startswith(prefix) and name not in keep:
+                del self.facts[name]
+                self.changed = True
+
+    def save(self):
+        if not self.changed or not self.cache_file or not self.key:
+            return
+        try:
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump(dict(key=self.key, facts=self.facts), f)
+            os.rename(self.cache_file + '.tmp', self.cache_file)
+        except (OSError, IOError):
+            pass  # we're not root; never mind
+        self.changed = False
+
+
+def get_disk_model(device):
+    """Describe the disk model, or return None if we don't know it."""
+    if device.startswith('cciss'):
+        vendor = read_file('/sys/block/%s/device/vendor' % device).strip()
+        raid_level = read_file('/sys/block/%s/device/raid_level' % device).strip()
+        return '%s hardware %s' % (vendor, raid_level)
+    try:
+        model = read_file('/sys/block/%s/device/model' % device).strip()
+        return 'model %s' % model
+    except IOError:
+        return None
+
+
+def get_disk_info(device, hardware=None):
     if device in ('simfs', 'vzfs', '???'):
         # iv.lt VPSes have no /sys/block; they mount /dev/simfs on /
         # hostex.lt VPSes have no /sys/block either; they mount /dev/vzfs on /
@@ -110,17 +207,16 @@ def get_disk_info(device):
                 size += int(line.split()[2])
             return fmt_size_si(size * 1024)
 
+    # Virtual disks can be resized at runtime, so the size is not cached
     sectors = int(read_file('/sys/block/%s/size' % device))
     size = fmt_size_decimal(sectors * 512)
-    if device.startswith('cciss'):
-        vendor = read_file('/sys/block/%s/device/vendor' % device).strip()
-        raid_level = read_file('/sys/block/%s/device/raid_level' % device).strip()
-        return '%s (%s hardware %s)' % (size, vendor, raid_level)
-    try:
-        model = read_file('/sys/block/%s/device/model' % device).strip()
-        return '%s (model %s)' % (size, model)
-    except IOError:
-        return size
+    if hardware is not None:
+        model = hardware.get(get_disk_model, device)
+    else:
+        model = get_disk_model(device)
+    if model:
+        return '%s (%s)' % (size, model)
+    return size
 
 
 def enumerate_disks():
@@ -144,11 +240,15 @@ def enumerate_disks():
     return devices
 
 
-def get_disks_info():
-    disks = enumerate_disks()
+def get_disks(hardware=None):
+    """Return a list of (disk, description) tuples."""
+    return [(d, get_disk_info(d, hardware)) for d in enumerate_disks()]
+
+
+def get_disks_info(disks):
     return ',\n        '.join(
-        '%s - %s' % (d, get_disk_info(d))
-        for d in disks
+        '%s - %s' % (d, info)
+        for d, info in disks
     )
 
 
@@ -169,16 +269,23 @@ def is_bridge(name):
     return name.startswith('br')
 
 
-def get_network_devices():
-    devices = sorted(
-        (d, get_netdev_info(d)) for d in os.listdir('/sys/class/net')
-        if '.' not in d and is_interesting_netdev(d) and not is_bridge(d)
-    )
-    return devices
+def is_listed_netdev(name):
+    # VLAN interfaces are named like eth0.42
+    return '.' not in name and is_interesting_netdev(name) and not is_bridge(name)
 
 
-def get_network_info():
-    devices = get_network_devices()
+def get_network_devices(hardware=None):
+    names = sorted(d for d in os.listdir('/sys/class/net')
+                   if is_listed_netdev(d))
+    if hardware is not None:
+        hardware.forget(get_netdev_info, names)
+        info = functools.partial(hardware.get, get_netdev_info)
+    else:
+        info = get_netdev_info
+    return [(d, info(d)) for d in names]
+
+
+def get_network_info(devices):
     return ',\n        '.join(
         '%s - %s' % (d, info) if info else d
         for d, info in devices
@@ -199,6 +306,141 @@ def get_ip_addresses():
     return addresses
 
 
+# Constants from linux/rtnetlink.h, linux/if_link.h and linux/if_addr.h
+NETLINK_ROUTE = 0
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RT_SCOPE_UNIVERSE = 0
+
+IFINFOMSG = struct.Struct('=BxHiII')  # family, type, index, flags, change
+IFADDRMSG = struct.Struct('=BBBBi')  # family, prefixlen, flags, scope, index
+RTATTR = struct.Struct('=HH')  # len, type
+
+
+def parse_rtattrs(message, offset, wanted):
+    """Extract the route attributes we want from a netlink message.
+
+    Returns a dict mapping attribute types to raw values.  Other attributes
+    are skipped without looking at them.
+    """
+    attrs = {}
+    while offset + RTATTR.size <= len(message):
+        rta_len, rta_type = RTATTR.unpack_from(message, offset)
+        if rta_len < RTATTR.size:
+            break
+        if rta_type in wanted:
+            attrs[rta_type] = message[offset + RTATTR.size:offset + rta_len]
+        offset += (rta_len + 3) & ~3
+    return attrs
+
+
+def netlink_interfaces():
+    """List network devices and global IP addresses over rtnetlink.
+
+    Returns (links, addresses) where links is a list of Link tuples and
+    addresses is a list of (ipaddr, dev) tuples like get_ip_addresses()
+    returns, for the interesting network devices only.
+
+    Both dumps happen over one socket, and we skip the addresses we don't
+    show (link-local, loopback, boring devices) before looking at their
+    attributes, so thousands of container veth interfaces are cheap.
+
+    Raises OSError if rtnetlink is not available, or if its reply is
+    malformed.
+    """
+    links = []
+    names = {}
+    addresses = []
+    with closing(netlink_socket(NETLINK_ROUTE)) as sock:
+        request = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        for msgtype, message in netlink_dump(sock, RTM_GETLINK, request,
+                                             seq=1):
+            if msgtype != RTM_NEWLINK:
+                continue
+            index = unpack_payload(IFINFOMSG, message)[2]
+            attrs = parse_rtattrs(message, IFINFOMSG.size,
+                                  (IFLA_IFNAME, IFLA_ADDRESS))
+            name = attrs.get(IFLA_IFNAME, b'').rstrip(b'\0').decode(
+                'UTF-8', 'replace')
+            mac = ':'.join('%02x' % b for b in
+                           bytearray(attrs.get(IFLA_ADDRESS, b'')))
+            links.append(Link(index, name, mac))
+            names[index] = name
+        request = IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        for msgtype, message in netlink_dump(sock, RTM_GETADDR, request,
+                                             seq=2):
+            if msgtype != RTM_NEWADDR:
+                continue
+            family, _, _, scope, index = unpack_payload(IFADDRMSG, message)
+            if (scope != RT_SCOPE_UNIVERSE
+                    or family not in (socket.AF_INET, socket.AF_INET6)
+                    or not is_interesting_netdev(names.get(index, '???'))):
+                continue
+            attrs = parse_rtattrs(message, IFADDRMSG.size,
+                                  (IFA_LOCAL, IFA_ADDRESS))
+            # for point-to-point links IFA_ADDRESS is the peer address
+            raw = attrs.get(IFA_LOCAL) or attrs.get(IFA_ADDRESS)
+            if raw:
+                addresses.append((index, socket.inet_ntop(family, raw),
+                                  names.get(index, '???')))
+    # ip addr lists addresses grouped by device
+    addresses.sort(key=lambda a: a[0])
+    return links, [(ipaddr, dev) for index, ipaddr, dev in addresses]
+
+
+def get_interfaces(hardware=None):
+    """Return network devices and IP addresses.
+
+    Returns (network_devices, ip_addresses), the same things that
+    get_network_devices() and get_ip_addresses() return, but without
+    running ip addr if we can ask the kernel directly.
+    """
+    try:
+        links, addresses = netlink_interfaces()
+    except OSError:
+        return get_network_devices(hardware), get_ip_addresses()
+    devices = sorted(
+        (link.name, 'MAC: %s' % link.mac if link.mac else None)
+        for link in links if is_listed_netdev(link.name)
+    )
+    return devices, addresses
+
+
+def get_local_addresses():
+    """Return local IP addresses, without running ip(8).
+
+    Cheaper, but less informative than get_ip_addresses(): the IPv4
+    addresses come from /proc/net/fib_trie, which doesn't say which network
+    device they belong to.
+    """
+    addresses = set()
+    try:
+        with open('/proc/net/fib_trie') as f:
+            prev = None
+            for line in f:
+                line = line.strip()
+                if line == '/32 host LOCAL':
+                    addresses.add(prev)
+                prev = line.lstrip('|-+ ')
+    except IOError:
+        pass
+    try:
+        with open('/proc/net/if_inet6') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 6:
+                    addresses.add('%s %s' % (parts[0], parts[5]))
+    except IOError:
+        pass
+    return sorted(addresses)
+
+
 def get_os_info():
     """Return the OS name and version"""
     # bit of a hack that works on ubuntu and openwrt
@@ -218,19 +460,52 @@ def get_architecture():
     return os.uname()[4] # (kernel_name, node_name, kernel_release, kernel_version, cpu)
 
 
-def report(title=True, print=print):
+def get_summary(hardware_cache_file=HARDWARE_CACHE_FILE):
+    """Collect everything report() shows into a Summary tuple."""
+    hardware = HardwareFacts(hardware_cache_file)
+    network_devices, ip_addresses = get_interfaces(hardware)
+    summary = Summary(
+        cpu=hardware.get(get_cpu_info),
+        ram=hardware.get(get_ram_info),
+        disks=get_disks(hardware),
+        network_devices=network_devices,
+        ip_addresses=ip_addresses,
+        os=get_os_info(),
+        architecture=get_architecture(),
+    )
+    hardware.save()
+    return summary
+
+
+def report(title=True, print=print, summary=None):
+    if summary is None:
+        summary = get_summary()
     if title:
         hostname = get_hostname()
         print(hostname)
         print('=' * len(hostname))
         print("")
-    print(':CPU: %s' % get_cpu_info())
-    print(':RAM: %s' % get_ram_info())
-    print(':Disks: %s' % get_disks_info())
-    print(':Network: %s' % get_network_info())
-    for ipaddr, dev in get_ip_addresses():
+    print(':CPU: %s' % summary.cpu)
+    print(':RAM: %s' % summary.ram)
+    print(':Disks: %s' % get_disks_info(summary.disks))
+    print(':Network: %s' % get_network_info(summary.network_devices))
+    for ipaddr, dev in summary.ip_addresses:
         print(':IP: %s (%s)' % (ipaddr, dev))
-    print(':OS: %s (%s)' % (get_os_info(), get_architecture()))
+    print(':OS: %s (%s)' % (summary.os, summary.architecture))
+
+
+def fingerprint(hardware_cache_file=HARDWARE_CACHE_FILE):
+    """Return a value that changes whenever report() output would change.
+
+    Unlike report() this doesn't run any external programs.
+    """
+    hardware = HardwareFacts(hardware_cache_file)
+    result = [hardware.get(get_cpu_info), hardware.get(get_ram_info),
+              get_disks_info(get_disks(hardware)),
+              get_network_info(get_network_devices(hardware)),
+              get_local_addresses(), get_os_info(), get_architecture()]
+    hardware.save()
+    return result
 
 
 def report_text(**kw):
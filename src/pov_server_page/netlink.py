@@ -0,0 +1,72 @@
+"""
+Minimal netlink(7) dump requests, for asking the kernel about network
+devices and sockets without running ip(8) or ss(8).
+"""
+
+import errno
+import os
+import socket
+import struct
+
+
+# Constants from linux/netlink.h
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLMSGHDR = struct.Struct('=IHHII')  # len, type, flags, seq, pid
+NLMSGERR = struct.Struct('=i')  # error
+
+
+def netlink_socket(protocol):
+    """Open a netlink socket for the given netlink protocol.
+
+    Raises OSError if netlink is not available.
+    """
+    af_netlink = getattr(socket, 'AF_NETLINK', None)
+    if af_netlink is None:
+        raise OSError(errno.EAFNOSUPPORT, 'AF_NETLINK is not supported')
+    return socket.socket(af_netlink, socket.SOCK_RAW, protocol)
+
+
+def unpack_payload(fmt, payload):
+    """Unpack the start of a netlink message payload.
+
+    Raises OSError if the message is too short.
+    """
+    if len(payload) < fmt.size:
+        raise OSError(errno.EBADMSG, 'Truncated netlink message')
+    return fmt.unpack_from(payload)
+
+
+def netlink_dump(sock, msgtype, request, seq=1):
+    """Ask the kernel to dump all objects of some type.
+
+    ``sock`` is a netlink socket.  Yields (msgtype, message) tuples, where
+    message is the payload without the netlink header.
+
+    Raises OSError if the kernel reports an error, or if the reply is
+    malformed.
+    """
+    header = NLMSGHDR.pack(NLMSGHDR.size + len(request), msgtype,
+                           NLM_F_REQUEST | NLM_F_DUMP, seq, 0)
+    sock.sendto(header + request, (0, 0))
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            msglen, msgtype = NLMSGHDR.unpack_from(data, offset)[:2]
+            if msglen < NLMSGHDR.size or offset + msglen > len(data):
+                # we'd never get past it
+                raise OSError(errno.EBADMSG, 'Malformed netlink message')
+            payload = data[offset + NLMSGHDR.size:offset + msglen]
+            if msgtype == NLMSG_DONE:
+                return
+            if msgtype == NLMSG_ERROR:
+                error = -unpack_payload(NLMSGERR, payload)[0]
+                raise OSError(error, os.strerror(error))
+            yield msgtype, payload
+            offset += (msglen + 3) & ~3
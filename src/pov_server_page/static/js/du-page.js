@@ -1,4 +1,8 @@
 var map = document.getElementById('map');
 appendTreemap(map, tree);
 var footer = document.getElementById('footer');
-footer.innerHTML = 'Last updated on ' + last_updated + '.  Disk usage computed in ' + duration + ' seconds.';
+footer.innerHTML = 'Last updated on ' + last_updated + '.  Disk usage computed in ' + duration + ' seconds';
+if (typeof paused !== 'undefined' && paused !== '0') {
+  footer.innerHTML += ' (paused for ' + paused + ' seconds to let other programs use the disks)';
+}
+footer.innerHTML += '.';
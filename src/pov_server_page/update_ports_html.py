@@ -3,6 +3,7 @@
 Update TCP & UDP port assignments page in /var/www/HOSTNAME/ports/index.html.
 """
 
+import errno
 import io
 import logging
 import optparse
@@ -11,16 +12,21 @@ import pwd
 import re
 import socket
 import string
+import struct
 import subprocess
+import threading
 import time
 from collections import namedtuple, defaultdict
-from contextlib import contextmanager
+from contextlib import closing, contextmanager
 
 try:
     from html import escape
 except ImportError:
     from cgi import escape
 
+from .host_identity import get_fqdn
+from .netlink import netlink_dump, netlink_socket, unpack_payload
+
 
 __version__ = '0.11.0'
 __author__ = 'Marius Gedminas <marius@gedmin.as>'
@@ -29,8 +35,9 @@ __author__ = 'Marius Gedminas <marius@gedmin.as>'
 log = logging.getLogger(__name__)
 
 
-HOSTNAME = socket.getfqdn()
 OUTPUT = "/var/www/${hostname}/ports/index.html"
+PROC = '/proc'
+TIMEOUT = 30  # seconds, for each data source
 
 
 TEMPLATE = string.Template("""\
@@ -48,7 +55,7 @@ TEMPLATE = string.Template("""\
 </head>
 <body>
 <h1>Open TCP & UDP ports on ${hostname}</h1>
-
+${warnings}
 <table class="ports table table-hover">
 <thead>
   <tr>
@@ -64,12 +71,19 @@ TEMPLATE = string.Template("""\
 </tbody>
 </table>
 
-<footer>Last updated on ${date}.</footer>
+<footer>Last updated on <!-- volatile -->${date}<!-- /volatile -->.</footer>
 
 </body>
 </html>
 """)
 
+WARNING_TEMPLATE = string.Template("""\
+<div class="alert alert-warning">
+  <strong>Incomplete data:</strong> gave up on ${source} after ${elapsed}
+  seconds.
+</div>
+""")
+
 ROW_TEMPLATE = string.Template("""\
   <tr class="${tr_class}">
     <td class="${port_class}" title="${ips}">${proto}</td>
@@ -81,17 +95,119 @@ ROW_TEMPLATE = string.Template("""\
 """)
 
 
-class NetStatTuple(namedtuple('NetStatTuple', 'protocol ip port pid program')):
+class NetStatTuple(namedtuple('NetStatTuple', 'protocol ip port pid program uid',
+                              defaults=[None])):
     @property
     def proto(self):
         return self.protocol.rstrip('6')  # tcp6 -> tcp
 
 
+SourceStats = namedtuple('SourceStats', 'name count elapsed timed_out')
+
+
+_current = threading.local()
+
+
+class DataSource(object):
+    """Collect the items produced by ``fn()`` in a background thread.
+
+    If that takes longer than ``timeout`` seconds, subprocesses started
+    by the source (through pipe()) are killed and whatever was collected
+    until then is kept.
+    """
+
+    grace_period = 1  # seconds to wait for a cancelled source to wind down
+
+    def __init__(self, name, fn, timeout=TIMEOUT):
+        self.name = name
+        self.fn = fn
+        self.timeout = timeout
+        self.results = []
+        self.processes = []
+        self.error = None
+        self.cancelled = False
+        self.started = None
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+        return self
+
+    def run(self):
+        _current.source = self
+        try:
+            for item in self.fn():
+                self.results.append(item)
+        except Exception as e:
+            self.error = e
+
+    def add_process(self, process):
+        self.processes.append(process)
+        if self.cancelled:
+            self.kill(process)
+
+    def kill(self, process):
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    def cancel(self):
+        self.cancelled = True
+        for process in list(self.processes):
+            self.kill(process)
+
+    def wait(self):
+        deadline = self.started + self.timeout
+        self.thread.join(max(0, deadline - time.monotonic()))
+        if self.thread.is_alive():
+            self.cancel()
+            self.thread.join(self.grace_period)
+        elif self.error is not None:
+            raise self.error
+        results = list(self.results)
+        elapsed = time.monotonic() - self.started
+        return results, SourceStats(self.name, len(results), elapsed,
+                                    self.cancelled)
+
+
+def run_sources(sources, timeout=TIMEOUT, stats=None):
+    """Run (name, fn) data sources in parallel.
+
+    Returns a list of results, one list per source.  Appends a SourceStats
+    for each source to ``stats``.
+    """
+    running = [DataSource(name, fn, timeout).start() for name, fn in sources]
+    all_results = []
+    for source in running:
+        results, source_stats = source.wait()
+        if source_stats.timed_out:
+            log.warning('%s did not finish in %d seconds',
+                        source.name, source.timeout)
+        if stats is not None:
+            stats.append(source_stats)
+        all_results.append(results)
+    return all_results
+
+
+def format_stats(stats):
+    return ''.join(
+        '%s: %d entries in %.2fs%s\n' % (
+            s.name, s.count, s.elapsed, ' (timed out)' if s.timed_out else '')
+        for s in stats)
+
+
 @contextmanager
 def pipe(*command):
     with open('/dev/null', 'wb') as devnull:
-        with subprocess.Popen(command, stdout=subprocess.PIPE,
-                              stderr=devnull).stdout as f:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=devnull)
+        source = getattr(_current, 'source', None)
+        if source is not None:
+            source.add_process(process)
+        with process.stdout as f:
             if bytes is not str:  # pragma: PY3
                 f = io.TextIOWrapper(f, encoding='UTF-8', errors='replace')
             yield f
@@ -142,6 +258,196 @@ def netstat():
                     % ''.join([header] + failures))
 
 
+# Socket states from include/net/tcp_states.h
+TCP_LISTEN = '0A'
+TCP_CLOSE = '07'
+
+
+ProcNetSocket = namedtuple('ProcNetSocket', 'protocol ip port uid inode')
+
+
+def decode_proc_net_address(address):
+    """Decode an address from /proc/net/{tcp,udp}{,6}.
+
+    The IP address is in hex, in host byte order, one 32-bit word at a time.
+    The port number is in hex too.
+    """
+    ip, port = address.split(':')
+    if len(ip) == 8:
+        packed = struct.pack('=I', int(ip, 16))
+        family = socket.AF_INET
+    else:
+        packed = struct.pack('=4I', *[int(ip[i:i + 8], 16)
+                                      for i in range(0, 32, 8)])
+        family = socket.AF_INET6
+    return socket.inet_ntop(family, packed), int(port, 16)
+
+
+def read_proc_net(protocol, proc=PROC):
+    """List listening TCP or unconnected UDP sockets from /proc/net."""
+    try:
+        f = open(os.path.join(proc, 'net', protocol))
+    except IOError:
+        return
+    with f:
+        header = next(f, '')
+        failures = []
+        for line in f:
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+            # retrnsmt uid timeout inode ...
+            parts = line.split()
+            try:
+                ip, port = decode_proc_net_address(parts[1])
+                remote_ip, remote_port = decode_proc_net_address(parts[2])
+                state = parts[3]
+                uid = int(parts[7])
+                inode = int(parts[9])
+            except (IndexError, ValueError, struct.error):
+                failures.append(line)
+                continue
+            if protocol.startswith('tcp'):
+                if state != TCP_LISTEN:
+                    continue
+            elif state != TCP_CLOSE or remote_port != 0:
+                continue
+            yield ProcNetSocket(protocol, ip, port, uid, inode)
+    if failures:
+        log.warning('Failed to parse %s/net/%s:\n%s'
+                    % (proc, protocol, ''.join([header] + failures)))
+
+
+def find_socket_owners(inodes, proc=PROC):
+    """Map socket inodes to pids by looking at /proc/*/fd/*.
+
+    Only cares about the given inodes, and stops looking as soon as it finds
+    all of them.  When several processes share a socket, the lowest pid wins
+    (which is usually the parent).
+    """
+    wanted = dict(('socket:[%d]' % inode, inode) for inode in inodes if inode)
+    owners = {}
+    try:
+        pids = sorted(int(name) for name in os.listdir(proc) if name.isdigit())
+    except OSError:
+        return owners
+    for pid in pids:
+        if not wanted:
+            break
+        fddir = os.path.join(proc, str(pid), 'fd')
+        try:
+            fds = os.listdir(fddir)
+        except OSError:
+            # process is gone, or belongs to another user and we're not root
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(os.path.join(fddir, fd))
+            except OSError:
+                continue
+            inode = wanted.pop(target, None)
+            if inode is not None:
+                owners[inode] = pid
+                if not wanted:
+                    break
+    return owners
+
+
+def resolve_socket_owners(sockets, proc=PROC):
+    """Convert a list of ProcNetSocket tuples into NetStatTuples."""
+    owners = find_socket_owners([sock.inode for sock in sockets], proc)
+    programs = {}
+    for sock in sockets:
+        pid = owners.get(sock.inode)
+        if pid is None:
+            program = '-'
+        elif pid in programs:
+            program = programs[pid]
+        else:
+            program = programs[pid] = get_comm(pid, proc) or '-'
+        yield NetStatTuple(sock.protocol, sock.ip, sock.port, pid, program,
+                           sock.uid)
+
+
+def proc_net_sockets(proc=PROC):
+    """List listening sockets by reading /proc directly.
+
+    Produces the same data as netstat(), but without having to look at every
+    open file descriptor of every process.
+    """
+    sockets = [sock for protocol in ('tcp', 'tcp6', 'udp', 'udp6')
+               for sock in read_proc_net(protocol, proc)]
+    return resolve_socket_owners(sockets, proc)
+
+
+# Constants from linux/netlink.h, linux/sock_diag.h and linux/inet_diag.h
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+
+INET_DIAG_REQ_V2 = struct.Struct('=BBBBI48x')  # family, protocol, ext, pad, states, id
+INET_DIAG_MSG = struct.Struct('=BBBB2s2s16s16s12x5I')
+# family, state, timer, retrans, id.sport, id.dport, id.src, id.dst,
+# id.if + id.cookie, expires, rqueue, wqueue, uid, inode
+
+SOCK_DIAG_QUERIES = [
+    # (protocol name, address family, IP protocol, socket states)
+    ('tcp', socket.AF_INET, socket.IPPROTO_TCP, 1 << int(TCP_LISTEN, 16)),
+    ('tcp6', socket.AF_INET6, socket.IPPROTO_TCP, 1 << int(TCP_LISTEN, 16)),
+    ('udp', socket.AF_INET, socket.IPPROTO_UDP, 1 << int(TCP_CLOSE, 16)),
+    ('udp6', socket.AF_INET6, socket.IPPROTO_UDP, 1 << int(TCP_CLOSE, 16)),
+]
+
+
+def sock_diag_dump(sock, protocol, family, ipproto, states, seq=1):
+    """Ask the kernel for sockets in the given states.
+
+    ``sock`` is a NETLINK_SOCK_DIAG socket.  Yields ProcNetSocket tuples.
+    """
+    request = INET_DIAG_REQ_V2.pack(family, ipproto, 0, 0, states)
+    addrlen = 4 if family == socket.AF_INET else 16
+    for msgtype, message in netlink_dump(sock, SOCK_DIAG_BY_FAMILY, request,
+                                         seq=seq):
+        if msgtype != SOCK_DIAG_BY_FAMILY:
+            continue
+        (_, _, _, _, sport, dport, src, _,
+         _, _, _, uid, inode) = unpack_payload(INET_DIAG_MSG, message)
+        if protocol.startswith('tcp') or dport == b'\0\0':
+            ip = socket.inet_ntop(family, src[:addrlen])
+            port = struct.unpack('!H', sport)[0]
+            yield ProcNetSocket(protocol, ip, port, uid, inode)
+
+
+def netlink_sockets(proc=PROC):
+    """List listening sockets by asking the kernel over netlink.
+
+    Unlike /proc/net/tcp, the kernel filters by socket state for us, so
+    this doesn't care how many established connections there are.
+
+    Raises OSError if NETLINK_SOCK_DIAG is not available (e.g. in some
+    containers, or on old kernels).
+    """
+    sockets = []
+    with closing(netlink_socket(NETLINK_SOCK_DIAG)) as sock:
+        for seq, query in enumerate(SOCK_DIAG_QUERIES, 1):
+            try:
+                sockets.extend(sock_diag_dump(sock, *query, seq=seq))
+            except OSError as e:
+                if e.errno == errno.ENOENT and query[1] == socket.AF_INET6:
+                    # IPv6 is disabled
+                    continue
+                raise
+    return resolve_socket_owners(sockets, proc)
+
+
+def listening_sockets():
+    try:
+        return netlink_sockets(PROC)
+    except OSError as e:
+        log.debug('Cannot use NETLINK_SOCK_DIAG: %s', e)
+    if os.path.exists(os.path.join(PROC, 'net', 'tcp')):
+        return proc_net_sockets(PROC)
+    # no /proc/net?  maybe netstat knows some other way
+    return netstat()
+
+
 def rpcinfo_dump():
     with pipe('rpcinfo', '-p') as f:
         header = next(f)  # skip header
@@ -243,6 +549,14 @@ def get_argv(pid):
         return argv
 
 
+def get_comm(pid, proc=PROC):
+    try:
+        with open(os.path.join(proc, '%d' % pid, 'comm')) as f:
+            return f.read().rstrip('\n')
+    except (TypeError, IOError):
+        return None
+
+
 def format_arg(arg):
     safe_chars = string.ascii_letters + string.digits + '-=+,./:@^_~'
     if all(c in safe_chars for c in arg):
@@ -260,8 +574,7 @@ def is_interpreter(program_name):
     return re.match(r'^python(\d([.]\d+)?)?$', program_name)
 
 
-def get_program(pid, unknown='-'):
-    argv = get_argv(pid)
+def format_program(argv, unknown='-'):
     if len(argv) >= 1 and ''.join(argv[1:]) == '' and ' ' in argv[0]:
         # programs that change their argv like postgrey or spamd
         argv = argv[0].split()
@@ -279,8 +592,7 @@ def get_program(pid, unknown='-'):
     return progname
 
 
-def get_html_cmdline(pid, unknown='-'):
-    argv = get_argv(pid)
+def format_html_cmdline(argv, unknown='-'):
     if len(argv) >= 1 and ''.join(argv[1:]) == '' and ' ' in argv[0]:
         # programs that change their argv like postgrey or spamd
         argv = argv[0].split()
@@ -299,6 +611,75 @@ def get_html_cmdline(pid, unknown='-'):
     return ' '.join(args)
 
 
+def get_program(pid, unknown='-'):
+    return format_program(get_argv(pid), unknown)
+
+
+def get_html_cmdline(pid, unknown='-'):
+    return format_html_cmdline(get_argv(pid), unknown)
+
+
+ProcessInfo = namedtuple('ProcessInfo', 'pid uid argv comm')
+
+
+def get_process_info(pid):
+    return ProcessInfo(pid, get_owner(pid), tuple(get_argv(pid)),
+                       get_comm(pid))
+
+
+class ProcessTable(object):
+    """Snapshot of process metadata.
+
+    Reads /proc/<pid> for every pid at most once, and looks up every uid
+    in the password database at most once.
+    """
+
+    def __init__(self, pids=()):
+        self._processes = {}
+        self._usernames = {}
+        for pid in pids:
+            self[pid]
+
+    @classmethod
+    def from_mapping(cls, netstat_mapping):
+        return cls(sorted(set(
+            t.pid for netstat_list in netstat_mapping.values()
+            for t in netstat_list if t.pid is not None)))
+
+    def __getitem__(self, pid):
+        try:
+            return self._processes[pid]
+        except KeyError:
+            info = self._processes[pid] = get_process_info(pid)
+            return info
+
+    def __len__(self):
+        return len(self._processes)
+
+    def username(self, uid):
+        try:
+            return self._usernames[uid]
+        except KeyError:
+            name = self._usernames[uid] = username(uid)
+            return name
+
+    def owner(self, pid):
+        return self.username(self[pid].uid)
+
+    def program(self, pid, unknown='-'):
+        info = self[pid]
+        if not info.argv and info.comm:
+            # kernel threads have an empty command line
+            return escape(info.comm)
+        return format_program(info.argv, unknown)
+
+    def html_cmdline(self, pid, unknown='-'):
+        info = self[pid]
+        if not info.argv and info.comm:
+            return '[<b>%s</b>]' % escape(info.comm)
+        return format_html_cmdline(info.argv, unknown)
+
+
 def parse_port_mapping(netstat_data):
     mapping = defaultdict(list)
     for data in netstat_data:
@@ -306,22 +687,45 @@ def parse_port_mapping(netstat_data):
     return mapping
 
 
-def get_port_mapping():
-    mapping = parse_port_mapping(netstat())
+def get_port_mapping(timeout=TIMEOUT, stats=None):
+    netstat_data, wireguard_data = run_sources([
+        ('listening sockets', listening_sockets),
+        ('wg show', wireguard_ports),
+    ], timeout, stats)
+    mapping = parse_port_mapping(netstat_data)
+    more_sources = []
     if ('tcp', 111) in mapping: # portmap is used
-        portmap_data = list(rpcinfo_dump())
-        merge_portmap_data(mapping, portmap_data)
+        more_sources.append(('rpcinfo -p', rpcinfo_dump))
     # It's not safe to filter on data.program, it might be 'systemd', but it
     # might also be 'init' -- and if we switch to ss(8) rather than netstat(8),
     # we no longer get program names.  We assume that pid 1 is systemd always,
     # which is true for Ubuntu.
     if any(data.pid == 1 for plist in mapping.values() for data in plist):
-        systemd_sockets = list(systemctl_list_sockets())
-        merge_portmap_data(mapping, systemd_sockets)
-    merge_portmap_data(mapping, wireguard_ports())
+        more_sources.append(('systemctl list-sockets', systemctl_list_sockets))
+    for portmap_data in run_sources(more_sources, timeout, stats):
+        merge_portmap_data(mapping, portmap_data)
+    merge_portmap_data(mapping, wireguard_data)
     return mapping
 
 
+def fingerprint():
+    """Return a value that changes whenever get_port_mapping() would change.
+
+    Much cheaper than get_port_mapping(): doesn't run rpcinfo, systemctl or
+    wg.  The price is that only the set of listening sockets and
+    /etc/services are covered.  An RPC service that moves to another port
+    changes the sockets, so that's noticed, but a change that leaves the
+    sockets alone (an RPC program re-registered under a different number on
+    the same port, a systemd unit or WireGuard interface renamed) leaves
+    ports.html stale until something else changes or a --force rebuild.
+    """
+    try:
+        services_mtime = os.stat('/etc/services').st_mtime
+    except OSError:
+        services_mtime = None
+    return [sorted(map(repr, listening_sockets())), services_mtime]
+
+
 def is_loopback_ip(ip):
     return ip == '::1' or ip.startswith('127.')
 
@@ -348,17 +752,24 @@ def get_service_name(proto, port, _cache={}):
     return '/'.join(_cache['services'].get('%s/%s' % (port, proto), []))
 
 
-def render_row(netstat_list):
+def render_row(netstat_list, processes=None):
     assert len(netstat_list) >= 1
+    if processes is None:
+        processes = ProcessTable()
     proto = netstat_list[0].proto
     port = netstat_list[0].port
     pids = sorted(set(t.pid for t in netstat_list if t.pid is not None))
     ips = set(t.ip for t in netstat_list if t.ip is not None)
-    user = sorted(set(map(username, map(get_owner, pids)))) or '-'
-    program = sorted(set(map(get_program, pids)))
+    users = set(map(processes.owner, pids))
+    # the socket's uid is all we know when we can't find the owning process
+    # (we're not root, or it's a kernel socket)
+    users.update(processes.username(t.uid) for t in netstat_list
+                 if t.pid is None and t.uid is not None)
+    user = sorted(users) or '-'
+    program = sorted(set(map(processes.program, pids)))
     if not program or pids == [1] and (program == ['systemd'] or program == ['init']):
         program = sorted(set(escape(t.program) or '-' for t in netstat_list)) or '-'
-    commands = sorted(set(map(get_html_cmdline, pids)))
+    commands = sorted(set(map(processes.html_cmdline, pids)))
     if not commands:
         commands = ['<b>%s</b>' % p for p in program]
     return ROW_TEMPLATE.substitute(
@@ -376,23 +787,34 @@ def render_row(netstat_list):
 
 
 def render_rows(netstat_mapping):
-    return ''.join(render_row(netstat_list)
+    processes = ProcessTable.from_mapping(netstat_mapping)
+    return ''.join(render_row(netstat_list, processes)
                    for (proto, port), netstat_list in sorted(netstat_mapping.items()))
 
 
-def render_html(netstat_mapping, hostname=HOSTNAME):
+def render_warnings(stats):
+    return ''.join(
+        WARNING_TEMPLATE.substitute(source=escape(s.name),
+                                    elapsed='%.0f' % s.elapsed)
+        for s in stats if s.timed_out)
+
+
+def render_html(netstat_mapping, hostname=None, stats=()):
+    if hostname is None:
+        hostname = get_fqdn()
     rows = render_rows(netstat_mapping)
     now = time.strftime('%Y-%m-%d %H:%M:%S %z')
     return TEMPLATE.substitute(
         hostname=hostname,
+        warnings=render_warnings(stats),
         rows=rows,
         date=now,
     )
 
 
-def render_file(netstat_mapping, output, hostname=HOSTNAME):
+def render_file(netstat_mapping, output, hostname=None, stats=()):
     with open(output, 'w') as f:
-        f.write(render_html(netstat_mapping, hostname=hostname))
+        f.write(render_html(netstat_mapping, hostname=hostname, stats=stats))
 
 
 def init_logging():
@@ -405,16 +827,26 @@ def main():
     init_logging()
     parser = optparse.OptionParser(usage='usage: %prog [options]',
                                    version=__version__)
-    parser.add_option('-H', '--hostname', default=HOSTNAME,
-                      help='Specify hostname explicitly (default: %default)')
+    parser.add_option('-H', '--hostname',
+                      help='Specify hostname explicitly (default: the fully'
+                           ' qualified domain name of this machine)')
     parser.add_option('-o', '--output', default=OUTPUT,
                       help='Specify output file name (default: %default)')
+    parser.add_option('-t', '--timeout', default=TIMEOUT, type='float',
+                      help='Give up on slow data sources after this many'
+                           ' seconds (default: %default)')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='Show how long each data source took')
     opts, args = parser.parse_args()
     if args:
         parser.error('unexpected arguments')
-    output = opts.output.replace('${hostname}', opts.hostname)
-    mapping = get_port_mapping()
-    render_file(mapping, output=output, hostname=opts.hostname)
+    hostname = opts.hostname or get_fqdn()
+    output = opts.output.replace('${hostname}', hostname)
+    stats = []
+    mapping = get_port_mapping(timeout=opts.timeout, stats=stats)
+    if opts.verbose:
+        print(format_stats(stats), end='')
+    render_file(mapping, output=output, hostname=hostname, stats=stats)
 
 
 if __name__ == '__main__':
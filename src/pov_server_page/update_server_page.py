@@ -20,16 +20,23 @@ file with htpasswd, enable the site with a2ensite and restart Apache::
 
 import datetime
 import errno
+import fcntl
+import functools
 import glob
 import grp
+import hashlib
 import io
+import itertools
+import json
 import logging
 import optparse
 import os
 import pwd
+import shutil
 import stat
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -37,12 +44,14 @@ try:
     from ConfigParser import SafeConfigParser
 except ImportError:
     from configparser import ConfigParser as SafeConfigParser
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 
-from mako.lookup import TemplateLookup
-
-from .utils import ansi2html, mako_error_handler
-from . import update_ports_html, machine_summary, disk_inventory
+from .host_identity import get_fqdn, get_host_identity
+from .utils import CACHE_DIR, ansi2html, mako_error_handler
 
 
 __author__ = 'Marius Gedminas <marius@gedmin.as>'
@@ -79,11 +88,14 @@ else:
     WEBTREEMAP = os.path.join(root, 'webtreemap')
 
 
-def get_fqdn():
-    """Return the fully-qualified hostname."""
-    # socket.getfqdn() likes to get confused on Ubuntu and return
-    # 'localhost6.localdomain' etc.
-    return os.popen("hostname -f").read().strip()
+STATE_DIR = '/var/lib/pov-server-page'
+
+# replace_file() reads existing files in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# Markers are at the top of the generated files, so replace_file() doesn't
+# need to look any further than this
+MARKER_SEARCH_SIZE = 4096
 
 
 def newer(file1, file2):
@@ -138,55 +150,213 @@ def symlink(target, filename):
     return True
 
 
-def replace_file(filename, marker, new_contents):
+def file_fingerprint(filename):
+    """Return a value that changes whenever a file changes.
+
+    Looks at the metadata, not the contents.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (filename, st.st_mtime_ns, st.st_size, st.st_mode, st.st_uid,
+            st.st_gid)
+
+
+def ssh_host_keys_fingerprint():
+    return [file_fingerprint(fn)
+            for fn in sorted(glob.glob('/etc/ssh/ssh_host_*_key.pub'))]
+
+
+def strip_volatile(chunks):
+    """Blank out the parts of a generated file that change on every run.
+
+    Takes and yields byte chunks; volatile regions may span chunk boundaries.
+    """
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        start = pending.find(VOLATILE_START)
+        while start != -1:
+            end = pending.find(VOLATILE_END, start + len(VOLATILE_START))
+            if end == -1:
+                break
+            yield pending[:start] + VOLATILE_START + VOLATILE_END
+            pending = pending[end + len(VOLATILE_END):]
+            start = pending.find(VOLATILE_START)
+        if start == -1:
+            # hold back what could be the beginning of a VOLATILE_START
+            start = max(0, len(pending) - len(VOLATILE_START) + 1)
+        yield pending[:start]
+        pending = pending[start:]
+    yield pending
+
+
+def content_hash(chunks):
+    """Hash a file's contents, ignoring volatile regions."""
+    h = hashlib.sha256()
+    for chunk in strip_volatile(chunks):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def read_chunks(f, size=CHUNK_SIZE):
+    return iter(functools.partial(f.read, size), b'')
+
+
+def write_chunks(f, chunks):
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+
+def old_content_hash(filename, manifest=None):
+    """Return the content_hash() of an existing file, or None.
+
+    Trusts the hash recorded in the manifest if the file's size and mtime
+    still match, to avoid reading it.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    entry = manifest.get(filename) if manifest is not None else None
+    if (isinstance(entry, dict) and entry.get('size') == st.st_size
+            and entry.get('mtime_ns') == st.st_mtime_ns):
+        return entry.get('sha256')
+    with open(filename, 'rb') as f:
+        return content_hash(read_chunks(f))
+
+
+def unchanged_since_built(filename, manifest):
+    """Check that nobody touched a file since replace_file() wrote it."""
+    entry = manifest.get(filename)
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    return (isinstance(entry, dict) and entry.get('size') == st.st_size
+            and entry.get('mtime_ns') == st.st_mtime_ns)
+
+
+def check_marker(filename, marker):
+    """Refuse to overwrite files that don't have the marker near the top."""
+    if not marker:
+        return
+    with open(filename, 'rb') as f:
+        head = f.read(MARKER_SEARCH_SIZE)
+    if marker not in head:
+        raise Error('Refusing to overwrite %s' % filename)
+
+
+def remember_file(manifest, filename, sha256):
+    if manifest is not None:
+        st = os.stat(filename)
+        manifest[filename] = dict(size=st.st_size, mtime_ns=st.st_mtime_ns,
+                                  sha256=sha256)
+
+
+def replace_file(filename, marker, new_contents, manifest=None):
     """Safely replace a file's contents.
 
     Creates the file if it didn't exist.
 
-    Check that the file contains a marker before overwriting
-    (so that only explicitly marked autogenerated files will be
+    ``new_contents`` is either a bytes object or an iterable of byte
+    chunks.  Chunks are streamed to a temporary file, so producers don't
+    have to hold the whole file in memory.
+
+    Check that the file contains a marker in its first few kilobytes before
+    overwriting (so that only explicitly marked autogenerated files will be
     overwritten).
 
-    Doesn't write if the file already has the right contents.
+    Doesn't write if the file already has the right contents, ignoring any
+    differences in volatile regions (see VOLATILE_START).  Contents are
+    compared by hash.  If you pass a ``manifest`` dict, it remembers the
+    size, mtime and hash of every file written, so unchanged files don't
+    even have to be read next time.
 
     Returns True if the file was created or overwritten, False if it was
     already up to date.
     """
-    assert marker in new_contents
-    try:
-        with open(filename, 'rb') as f:
-            old_contents = f.read()
-            if old_contents == new_contents:
-                return False
-            if marker not in old_contents:
-                raise Error('Refusing to overwrite %s' % filename)
-    except IOError as e:
-        if e.errno == errno.ENOENT:
-            pass
-        else:
-            raise
-    mkdir_with_parents(os.path.dirname(filename))
-    with open(filename + '.tmp', 'wb') as f:
-        f.write(new_contents)
+    old_hash = old_content_hash(filename, manifest)
+    if isinstance(new_contents, bytes):
+        assert marker in new_contents
+        new_hash = content_hash([new_contents])
+        if new_hash == old_hash:
+            remember_file(manifest, filename, new_hash)
+            return False
+        if old_hash is not None:
+            check_marker(filename, marker)
+        mkdir_with_parents(os.path.dirname(filename))
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(new_contents)
+    else:
+        mkdir_with_parents(os.path.dirname(filename))
+        with open(filename + '.tmp', 'wb') as f:
+            new_hash = content_hash(write_chunks(f, new_contents))
+        if new_hash == old_hash:
+            os.unlink(filename + '.tmp')
+            remember_file(manifest, filename, new_hash)
+            return False
+        if old_hash is not None:
+            try:
+                check_marker(filename, marker)
+            except Error:
+                os.unlink(filename + '.tmp')
+                raise
     os.rename(filename + '.tmp', filename)
+    remember_file(manifest, filename, new_hash)
     return True
 
 
-def pipeline(*args, **kwargs):
-    """Construct a shell pipeline."""
-    stdout = kwargs.pop('stdout', None)
-    assert not kwargs
+def build_state_version():
+    """Return the versions of the code that produced the build state.
+
+    A new version of a data collector can render the same inputs
+    differently, so upgrading any of them invalidates the state.
+    """
+    from . import disk_inventory, machine_summary, update_ports_html
+    return ' '.join([__version__, disk_inventory.__version__,
+                     machine_summary.__version__, update_ports_html.__version__])
+
+
+def lock_file(filename, blocking=True):
+    """Open and flock() a lock file, creating it if necessary.
+
+    Returns the open file (close it to release the lock), or None if
+    ``blocking`` is False and some other process holds the lock.
+    """
+    mkdir_with_parents(os.path.dirname(filename))
+    f = open(filename, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking
+                    else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def pipeline(*args):
+    """Run a shell pipeline, yield its output in chunks."""
     children = []
-    for n, command in enumerate(args):
+    for command in args:
         p = subprocess.Popen(
             command,
             stdin=children[-1].stdout if children else None,
-            stdout=stdout if n == len(args) - 1 else subprocess.PIPE)
+            stdout=subprocess.PIPE)
         children.append(p)
     for child in children[:-1]:
         child.stdout.close()
-    for child in children:
-        child.wait()
+    try:
+        for chunk in read_chunks(children[-1].stdout):
+            yield chunk
+    finally:
+        children[-1].stdout.close()
+        for child in children:
+            child.wait()
 
 
 class Error(Exception):
@@ -197,6 +367,55 @@ HTML_MARKER = b'<!-- generated by pov-update-server-page -->'
 CONFIG_MARKER = b'# generated by pov-update-server-page'
 NO_MARKER = b''
 
+# Things like "Last updated on" timestamps are wrapped in these so that
+# replace_file() doesn't rewrite the file (bumping its mtime and ETag) every
+# hour when nothing else changed.
+VOLATILE_START = b'<!-- volatile -->'
+VOLATILE_END = b'<!-- /volatile -->'
+
+
+class Facts(object):
+    """Facts about this machine, each gathered at most once per build.
+
+    The sub-builders and the templates (as FACTS) share one of these, so
+    info/index.html doesn't run df, lvm or ip addr again after
+    machine-summary.txt and disk-inventory.txt did.
+    """
+
+    def __init__(self):
+        self._facts = {}
+
+    def _get(self, name, collect):
+        if name not in self._facts:
+            self._facts[name] = collect()
+        return self._facts[name]
+
+    @property
+    def machine_summary(self):
+        """A machine_summary.Summary."""
+        from . import machine_summary
+        return self._get('machine_summary', machine_summary.get_summary)
+
+    @property
+    def disk_info(self):
+        """A disk_inventory.LinuxDiskInfo, for disk_inventory.report_*()."""
+        from . import disk_inventory
+        return self._get('disk_info', disk_inventory.LinuxDiskInfo)
+
+    @property
+    def machine_summary_fingerprint(self):
+        """machine_summary.fingerprint(), shared by its dependants."""
+        from . import machine_summary
+        return self._get('machine_summary_fingerprint',
+                         machine_summary.fingerprint)
+
+    @property
+    def disk_inventory_fingerprint(self):
+        """disk_inventory.fingerprint(), shared by its dependants."""
+        from . import disk_inventory
+        return self._get('disk_inventory_fingerprint',
+                         disk_inventory.fingerprint)
+
 
 class Builder(object):
 
@@ -204,7 +423,7 @@ class Builder(object):
 
     defaults = dict(
         ENABLED=False,
-        HOSTNAME=get_fqdn(),
+        HOSTNAME='',  # get_fqdn(), but only when we need it
         SERVER_ALIASES='',
         MOTD_FILE='/etc/motd',
         LOOPBACK_ONLY=False,
@@ -250,43 +469,96 @@ class Builder(object):
                 print("Created %s" % filename)
 
     class Template(object):
-        def __init__(self, template_name, marker=HTML_MARKER):
+        # depends is a list of functions that take the builder and return
+        # something that changes whenever the template output would
+        def __init__(self, template_name, marker=HTML_MARKER, depends=()):
             self.template_name = template_name
             self.marker = marker
+            self.template_names = [template_name]
+            self.depends = depends
+
+        def inputs(self, filename, builder):
+            template_file = os.path.join(builder.template_dir,
+                                         self.template_name)
+            return [file_fingerprint(template_file), builder.var_inputs()] + [
+                fn(builder) for fn in self.depends]
 
         def build(self, filename, builder, extra_vars=None):
-            if self.template_name.endswith('.html.in'):
-                template = builder.html_lookup.get_template(self.template_name)
-            else:
-                template = builder.lookup.get_template(self.template_name)
+            template = builder.get_template(self.template_name)
+            kw = dict(builder.vars, FACTS=builder.facts)
             if extra_vars:
-                kw = builder.vars.copy()
                 kw.update(extra_vars)
-            else:
-                kw = builder.vars
             new_contents = template.render_unicode(**kw).encode('UTF-8')
             builder.replace_file(filename, self.marker, new_contents)
 
     class Ports(object):
+        def inputs(self, filename, builder):
+            from . import update_ports_html
+            return [builder.vars['HOSTNAME'], update_ports_html.fingerprint()]
+
         def build(self, filename, builder):
-            mapping = update_ports_html.get_port_mapping()
-            new_contents = update_ports_html.render_html(mapping, hostname=builder.vars['HOSTNAME'])
+            from . import update_ports_html
+            stats = []
+            mapping = update_ports_html.get_port_mapping(stats=stats)
+            if builder.verbose:
+                print(update_ports_html.format_stats(stats), end='')
+            new_contents = update_ports_html.render_html(
+                mapping, hostname=builder.vars['HOSTNAME'], stats=stats)
             builder.replace_file(filename, HTML_MARKER, new_contents.encode('UTF-8'))
 
     class MachineSummary(object):
+        @staticmethod
+        def fingerprint(builder):
+            return builder.facts.machine_summary_fingerprint
+
+        def inputs(self, filename, builder):
+            return self.fingerprint(builder)
+
         def build(self, filename, builder):
-            new_contents = machine_summary.report_text(title=False)
+            from . import machine_summary
+            new_contents = machine_summary.report_text(
+                title=False, summary=builder.facts.machine_summary)
             if not isinstance(new_contents, bytes):  # pragma: PY3
                 new_contents = new_contents.encode('UTF-8')
             builder.replace_file(filename, NO_MARKER, new_contents)
 
     class DiskInventory(object):
+        @staticmethod
+        def fingerprint(builder):
+            return builder.facts.disk_inventory_fingerprint
+
+        def inputs(self, filename, builder):
+            return self.fingerprint(builder)
+
         def build(self, filename, builder):
-            new_contents = disk_inventory.report_text()
+            from . import disk_inventory
+            new_contents = disk_inventory.report_text(
+                info=builder.facts.disk_info)
             builder.replace_file(filename, NO_MARKER, new_contents.encode('UTF-8'))
 
     class DiskUsage(object):
         IGNORE = ('tmpfs', 'devtmpfs', 'ecryptfs', 'nfs', 'squashfs')
+        top_list_titles = [
+            ('largest_files', 'Largest files'),
+            ('largest_dirs', 'Largest directories (not counting subdirectories)'),
+            ('fastest_growing', 'Fastest growing directories (since the previous snapshot)'),
+        ]
+        template_names = ['du.html.in', 'du-page.html.in']
+
+        @staticmethod
+        def webtreemap_js(du_file, metadata):
+            """Convert a snapshot into du.js, in chunks.
+
+            du.js can be tens of megabytes, so it's never held in memory.
+            """
+            for chunk in pipeline(['zcat', du_file], [DU2WEBTREEMAP]):
+                yield chunk
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S %z')
+            yield ('\nvar last_updated = "%s";\n'
+                   'var duration = "%.0f";\n'
+                   'var paused = "%.0f";\n' % (
+                       timestamp, metadata.get('elapsed', 0),
+                       metadata.get('throttle', {}).get('paused', 0))).encode()
 
         @staticmethod
         def location_name(location):
@@ -362,11 +634,12 @@ class Builder(object):
             locations = builder.vars['DISK_USAGE_LIST']
             if not locations:
                 return
+            from . import du_history, du_scan
             delete_old = builder.vars['DISK_USAGE_DELETE_OLD']
             keep_daily = builder.vars['DISK_USAGE_KEEP_DAILY']
             keep_monthly = builder.vars['DISK_USAGE_KEEP_MONTHLY']
             keep_yearly = builder.vars['DISK_USAGE_KEEP_YEARLY']
-            self.collectd_hostname = get_fqdn()
+            self.collectd_hostname = get_host_identity().collectd_hostname
             self.hostname = builder.vars['SHORTHOSTNAME']
             index_html = os.path.join(dirname, 'index.html')
             Builder.Template('du.html.in').build(
@@ -394,34 +667,41 @@ class Builder(object):
                     if builder.verbose:
                         print('Creating %s' % du_file)
                     mkdir_with_parents(datadir)
-                    started = time.time()
-                    with open(du_file + ".tmp", 'wb') as f:
-                        nice = ['nice', '-n', '10']
-                        if os.path.exists('/usr/bin/ionice'):
-                            ionice = ['ionice', '-c3']
-                        else:
-                            ionice = []
-                        pipeline(nice + ionice + ['du', '-x', location],
-                                 ['gzip'], stdout=f)
-                    os.rename(du_file + '.tmp', du_file)
-                    duration = time.time() - started
-                    need_build = True
+                    nice = ['nice', '-n', '10']
+                    if os.path.exists('/usr/bin/ionice'):
+                        ionice = ['ionice', '-c3']
+                    else:
+                        ionice = []
+                    older = sorted(self.find_old_files(datadir))
+                    scan = du_scan.DuScan(location, du_file,
+                                          command_prefix=nice + ionice,
+                                          previous=older[-1] if older else None)
+                    try:
+                        metadata = scan.run(verbose=builder.verbose)
+                    except du_scan.ScanError as e:
+                        # the next run will resume it
+                        print(e, file=sys.stderr)
+                        need_build = False
+                    else:
+                        need_build = True
                 else:
-                    duration = 0 # sadly, unknown
+                    metadata = du_scan.load_metadata(du_file)
                     need_build = newer(du_file, js_file)
                 if need_build:
-                    if builder.verbose:
-                        print('Creating %s' % js_file)
-                    with open(js_file + ".tmp", 'w') as f:
-                        pipeline(['zcat', du_file], [DU2WEBTREEMAP], stdout=f)
-                        timestamp = time.strftime('%Y-%m-%d %H:%M:%S %z')
-                        f.write('\nvar last_updated = "%s";\n' % timestamp)
-                        f.write('var duration = "%.0f";\n' % duration)
-                    os.rename(js_file + ".tmp", js_file)
+                    builder.replace_file(js_file, NO_MARKER,
+                                         self.webtreemap_js(du_file, metadata))
+                if not builder.quick:
+                    du_history.SizeHistory(datadir).update(
+                        self.find_old_files(datadir), verbose=builder.verbose)
                 snapshots = [
                     os.path.basename(fn)[len('du-'):-len('.gz')]
                     for fn in sorted(self.find_old_files(datadir), reverse=True)
                 ]
+                if snapshots:
+                    latest = du_scan.load_metadata(
+                        os.path.join(datadir, 'du-%s.gz' % snapshots[0]))
+                else:
+                    latest = {}
                 Builder.Template('du-page.html.in').build(
                     index_html, builder,
                     extra_vars=dict(
@@ -431,9 +711,19 @@ class Builder(object):
                         disk_graph_url=self.disk_graph_url,
                         has_data=os.path.exists(js_file),
                         snapshots=snapshots,
+                        history_url=functools.partial(
+                            self.history_url, location_name),
+                        top_lists=[
+                            (name, title, latest.get(name, []))
+                            for name, title in self.top_list_titles
+                        ],
                     ),
                 )
 
+        @staticmethod
+        def history_url(location_name, path):
+            return '../history/%s%s?format=html' % (location_name, quote(path))
+
         def find_old_files(self, datadir):
             return glob.glob(os.path.join(datadir, 'du-????-??-??.gz'))
 
@@ -444,6 +734,9 @@ class Builder(object):
             delete = set(files) - keep
             for fn in sorted(delete):
                 os.unlink(fn)
+                metadata = os.path.splitext(fn)[0] + '.json'
+                if os.path.exists(metadata):
+                    os.unlink(metadata)
 
         @staticmethod
         def files_to_keep(files, keep_daily=0, keep_monthly=0, keep_yearly=0):
@@ -475,13 +768,15 @@ class Builder(object):
         ('/var/www/{HOSTNAME}/ports/index.html',
          Ports()),
         ('/var/www/{HOSTNAME}/ssh/index.html',
-         Template('ssh.html.in')),
+         Template('ssh.html.in', depends=[
+             lambda builder: ssh_host_keys_fingerprint()])),
         ('/var/www/{HOSTNAME}/info/machine-summary.txt',
          MachineSummary()),
         ('/var/www/{HOSTNAME}/info/disk-inventory.txt',
          DiskInventory()),
         ('/var/www/{HOSTNAME}/info/index.html',
-         Template('info.html.in')),
+         Template('info.html.in', depends=[MachineSummary.fingerprint,
+                                           DiskInventory.fingerprint])),
         ('/var/www/{HOSTNAME}/du',
          DiskUsage()),
         ('/var/log/apache2/{HOSTNAME}',
@@ -489,6 +784,17 @@ class Builder(object):
         ('/etc/apache2/sites-available/{HOSTNAME}.conf',
          Template('apache.conf.in', CONFIG_MARKER)),
     ]
+    watch_list = [
+        # (file or directory, destinations to rebuild when it changes)
+        ('{MOTD_FILE}', ['/var/www/{HOSTNAME}/index.html',
+                         '/var/www/{HOSTNAME}/info/index.html',
+                         '/etc/apache2/sites-available/{HOSTNAME}.conf']),
+        ('/root/Changelog', ['/var/www/{HOSTNAME}/index.html',
+                             '/etc/apache2/sites-available/{HOSTNAME}.conf']),
+        ('/etc/services', ['/var/www/{HOSTNAME}/ports/index.html']),
+        # systemd adds/removes entries here as units start and stop
+        ('/run/systemd/units', ['/var/www/{HOSTNAME}/ports/index.html']),
+    ]
     check_list = [
         ('/etc/apache2/mods-enabled/ssl.load', 'a2enmod ssl'),
         ('/etc/apache2/mods-enabled/rewrite.load', 'a2enmod rewrite'),
@@ -499,15 +805,24 @@ class Builder(object):
         ('{AUTH_USER_FILE}', 'htpasswd -c {AUTH_USER_FILE} <username>')
     ]
 
+    # vars that change on every run but don't affect the generated files
+    volatile_vars = ('TIMESTAMP', )
+
     def __init__(self, vars=None, template_dir=TEMPLATE_DIR, destdir='',
-                 verbose=False, quick=False):
+                 verbose=False, quick=False, force=False, cache_dir=CACHE_DIR):
         if vars is None:
             vars = {}
         self.verbose = verbose
         self.quick = quick
+        self.force = force
         self.vars = vars
+        from mako.lookup import TemplateLookup
+        if cache_dir and not os.access(cache_dir, os.W_OK):
+            # Mako insists on writing out the modules it compiles
+            cache_dir = None
         self.html_lookup = TemplateLookup(
             directories=[template_dir],
+            module_directory=cache_dir and os.path.join(cache_dir, 'html'),
             error_handler=mako_error_handler,
             strict_undefined=True,
             default_filters=['to_unicode', 'h'],
@@ -515,15 +830,22 @@ class Builder(object):
         )
         self.lookup = TemplateLookup(
             directories=[template_dir],
+            module_directory=cache_dir and os.path.join(cache_dir, 'text'),
             error_handler=mako_error_handler,
             strict_undefined=True,
             default_filters=['to_unicode'],
             imports=['from pov_server_page.utils import to_unicode'],
         )
+        self.template_dir = template_dir
         self.destdir = destdir
         for name, value in self.defaults.items():
             self.vars.setdefault(name, value)
+        if not self.vars['HOSTNAME']:
+            self.vars['HOSTNAME'] = get_fqdn()
         self.needs_apache_reload = False
+        self.facts = Facts()
+        self.fingerprints = None
+        self.manifest = None
 
     @classmethod
     def ConfigParser(cls, **extra):
@@ -546,6 +868,12 @@ class Builder(object):
             for name, default in cls.defaults.items())
         return cls(vars, template_dir, destdir)
 
+    def get_template(self, template_name):
+        if template_name.endswith('.html.in'):
+            return self.html_lookup.get_template(template_name)
+        else:
+            return self.lookup.get_template(template_name)
+
     def _compute_derived(self):
         self.vars['SHORTHOSTNAME'] = self.vars['HOSTNAME'].partition('.')[0]
         self.vars['TIMESTAMP'] = str(datetime.datetime.now())
@@ -611,9 +939,17 @@ class Builder(object):
         return stat.S_IMODE(st.st_mode) & stat.S_IXOTH
 
     def replace_file(self, destination, marker, new_contents):
-        if marker not in new_contents:
-            new_contents = marker + b'\n' + new_contents
-        if replace_file(destination, marker, new_contents) and self.verbose:
+        if isinstance(new_contents, bytes):
+            if marker not in new_contents:
+                new_contents = marker + b'\n' + new_contents
+        else:
+            chunks = iter(new_contents)
+            first = next(chunks, b'')
+            if marker not in first:
+                first = marker + b'\n' + first
+            new_contents = itertools.chain([first], chunks)
+        if (replace_file(destination, marker, new_contents,
+                         manifest=self.manifest) and self.verbose):
             print("Created %s" % destination)
             if destination.startswith('/etc/apache2'):
                 self.needs_apache_reload = True
@@ -634,23 +970,130 @@ class Builder(object):
     def parse_map(self, value):
         return dict(self.parse_pairs(value))
 
-    def build(self, verbose=None, quick=None):
+    def get_watch_list(self):
+        """List files that build_list entries depend on.
+
+        Returns a list of (filename, destinations), where destinations are
+        build_list keys.
+        """
+        result = [(filename.format(**self.vars), destinations)
+                  for filename, destinations in self.watch_list]
+        for destination, subbuilder in self.build_list:
+            for name in getattr(subbuilder, 'template_names', []):
+                result.append((os.path.join(self.template_dir, name),
+                               [destination]))
+        return result
+
+    @property
+    def state_file(self):
+        return self.destdir + os.path.join(STATE_DIR, 'build-state.json')
+
+    def load_build_state(self):
+        """Load input fingerprints of the files built last time.
+
+        Returns two dicts: one mapping filenames to fingerprints, and a
+        manifest for replace_file().
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return {}, {}
+        if (not isinstance(state, dict)
+                or state.get('version') != build_state_version()):
+            return {}, {}
+        return state.get('fingerprints', {}), state.get('manifest', {})
+
+    def save_build_state(self, fingerprints, manifest):
+        """Merge updated fingerprints and manifest entries into the state file.
+
+        A quick run can happen in the middle of the daily disk usage scan;
+        merging lets both of them save what they built.
+        """
+        with lock_file(self.state_file + '.lock'):
+            old_fingerprints, old_manifest = self.load_build_state()
+            old_fingerprints.update(fingerprints)
+            old_manifest.update(manifest)
+            state = dict(version=build_state_version(),
+                         fingerprints=old_fingerprints,
+                         manifest=old_manifest)
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.rename(self.state_file + '.tmp', self.state_file)
+
+    def var_inputs(self):
+        return sorted((name, value) for name, value in self.vars.items()
+                      if name not in self.volatile_vars)
+
+    def get_fingerprint(self, filename, subbuilder):
+        """Compute a fingerprint of the inputs of a build_list entry.
+
+        Returns None for sub-builders that don't declare their inputs.
+        """
+        if not hasattr(subbuilder, 'inputs'):
+            return None
+        inputs = subbuilder.inputs(filename, self)
+        return hashlib.sha256(repr(inputs).encode('UTF-8')).hexdigest()
+
+    def build(self, verbose=None, quick=None, only=None, force=None):
+        self.start_build(verbose=verbose, quick=quick, force=force)
+        self.build_targets(only)
+        self.finish_build()
+
+    def start_build(self, verbose=None, quick=None, force=None):
+        """Compute the variables and load the build state.
+
+        build() is start_build(), then one or more build_targets(), then
+        finish_build().
+        """
         if verbose is not None:
             self.verbose = verbose
         if quick is not None:
             self.quick = quick
+        if force is not None:
+            self.force = force
+        self.facts = Facts()
         self._compute_derived()
         self.skip = self.vars['SKIP'].split()
-        redirect = self.parse_map(self.vars['REDIRECT'])
+        self.redirect = self.parse_map(self.vars['REDIRECT'])
+        self.old_build_state = self.load_build_state()
+        old_fingerprints, old_manifest = self.old_build_state
+        self.fingerprints = dict(old_fingerprints)
+        self.manifest = dict(old_manifest)
+
+    def build_targets(self, only=None):
+        """Build the build_list entries listed in ``only`` (default: all)."""
         for destination, subbuilder in self.build_list:
+            if only is not None and destination not in only:
+                continue
             filename = self.destdir + destination.format(**self.vars)
             if filename not in self.skip:
-                if filename in redirect:
-                    filename = redirect[filename]
+                if filename in self.redirect:
+                    filename = self.redirect[filename]
+                fingerprint = self.get_fingerprint(filename, subbuilder)
+                if (fingerprint is not None and not self.force
+                        and self.fingerprints.get(filename) == fingerprint
+                        and unchanged_since_built(filename, self.manifest)):
+                    continue
                 subbuilder.build(filename, self)
+                if fingerprint is not None:
+                    self.fingerprints[filename] = fingerprint
             elif self.verbose:
                 print("Skipping %s" % filename)
 
+    def finish_build(self):
+        """Save the build state, if anything changed."""
+        old_fingerprints, old_manifest = self.old_build_state
+        if (self.fingerprints != old_fingerprints
+                or self.manifest != old_manifest):
+            self.save_build_state(
+                changed_items(self.fingerprints, old_fingerprints),
+                changed_items(self.manifest, old_manifest))
+
+    def du_destinations(self):
+        return [destination for destination, subbuilder in self.build_list
+                if isinstance(subbuilder, Builder.DiskUsage)]
+
     def check(self):
         self._compute_derived()
         for target, command in self.check_list:
@@ -661,6 +1104,396 @@ class Builder(object):
             print("Please run service apache2 reload")
 
 
+def changed_items(new, old):
+    return dict((key, value) for key, value in new.items()
+                if old.get(key) != value)
+
+
+class RunCoordinator(object):
+    """Keep overlapping runs from stepping on each other's toes.
+
+    A full run has two phases: "build" (everything except disk usage, takes
+    seconds) and "du" (the daily disk usage scan, which can take hours).
+    Each phase is guarded by a flock()ed lock file, and the start and end
+    of each phase are recorded in run-state.json.
+    """
+
+    phases = ('build', 'du')
+
+    def __init__(self, state_dir=STATE_DIR):
+        self.state_dir = state_dir
+        self.locks = {}
+
+    @property
+    def state_file(self):
+        return os.path.join(self.state_dir, 'run-state.json')
+
+    def lock_filename(self, phase):
+        return os.path.join(self.state_dir, '%s.lock' % phase)
+
+    def busy(self, phase):
+        """Is some other process in this phase right now?"""
+        f = lock_file(self.lock_filename(phase), blocking=False)
+        if f is None:
+            return True
+        f.close()
+        return False
+
+    def acquire(self, phase, blocking=False):
+        """Enter a phase.
+
+        Returns False if some other process is in this phase and
+        ``blocking`` is False.
+        """
+        f = lock_file(self.lock_filename(phase), blocking=blocking)
+        if f is None:
+            return False
+        self.locks[phase] = f
+        self.record(phase, start=time.time(), end=None, pid=os.getpid())
+        return True
+
+    def release(self, phase):
+        self.record(phase, end=time.time())
+        self.locks.pop(phase).close()
+
+    def load_state(self):
+        """Return {phase: {'start': ..., 'end': ..., 'pid': ...}}.
+
+        'end' is None while the phase is in progress (or if the process
+        doing it crashed).
+        """
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def record(self, phase, **info):
+        with lock_file(self.state_file + '.lock'):
+            state = self.load_state()
+            state.setdefault(phase, {}).update(info)
+            with open(self.state_file + '.tmp', 'w') as f:
+                json.dump(state, f, indent=2, sort_keys=True)
+            os.rename(self.state_file + '.tmp', self.state_file)
+
+
+def coordinated_build(builder, runs, verbose=False, quick=False, force=False,
+                      only=None):
+    """Build the server page without getting in the way of other runs.
+
+    A full run is skipped if another full run is still going.  A quick
+    run is skipped if another run is in its build phase (that one will
+    produce the same pages).  A quick run can happen while a full run is
+    busy with the disk usage scan, but leaves the disk usage pages alone.
+
+    A quick run can be limited to the build_list entries listed in
+    ``only``.
+
+    Returns False if the run was skipped.
+    """
+    du = set(builder.du_destinations())
+    targets = set(destination for destination, subbuilder in builder.build_list)
+    if only is not None:
+        targets.intersection_update(only)
+    if not quick and not runs.acquire('du'):
+        if verbose:
+            print("Another full run is in progress, skipping.")
+        return False
+    try:
+        if quick:
+            if not runs.acquire('build'):
+                if verbose:
+                    print("Another run is in progress, skipping.")
+                return False
+            if runs.busy('du'):
+                if verbose:
+                    print("Disk usage scan in progress, not touching"
+                          " disk usage pages.")
+                targets -= du
+        else:
+            runs.acquire('build', blocking=True)
+            targets -= du
+        try:
+            builder.start_build(verbose=verbose, quick=quick, force=force)
+            builder.build_targets(targets)
+        finally:
+            runs.release('build')
+        if not quick:
+            builder.build_targets(du)
+        builder.finish_build()
+    finally:
+        if not quick:
+            runs.release('du')
+    return True
+
+
+def read_config(config_file, overrides=()):
+    """Read the config file and apply var=value overrides."""
+    cp = Builder.ConfigParser()
+    if not cp.read([config_file]):
+        raise Error("Could not read %s" % config_file)
+    for arg in overrides:
+        name, _, value = arg.partition('=')
+        cp.set(Builder.section, name, value)
+    return cp
+
+
+PRECOMPILE_SCRIPT = """
+from pov_server_page import changelog2html, dudiff2html
+from pov_server_page.utils import LazyTemplate
+for module in changelog2html, dudiff2html:
+    for value in list(vars(module).values()):
+        if isinstance(value, LazyTemplate):
+            value.template
+"""
+
+
+def precompile(cache_dir=CACHE_DIR, template_dir=TEMPLATE_DIR, verbose=False):
+    """Compile all the templates into Python modules in cache_dir.
+
+    Mako checks compiled modules against the mtimes of template files, but
+    dpkg preserves the mtimes from the package build, so we start from
+    scratch here.
+    """
+    if not cache_dir:
+        raise Error("No template cache directory configured")
+    for subdir in ['html', 'text', 'changelog2html', 'dudiff2html']:
+        shutil.rmtree(os.path.join(cache_dir, subdir), ignore_errors=True)
+    mkdir_with_parents(cache_dir)
+    builder = Builder(template_dir=template_dir, cache_dir=cache_dir)
+    for filename in sorted(glob.glob(os.path.join(template_dir, '*.in'))):
+        template_name = os.path.basename(filename)
+        if verbose:
+            print("Compiling %s" % template_name)
+        builder.get_template(template_name)
+    # changelog2html and dudiff2html pick the cache directory at import time
+    if verbose:
+        print("Compiling changelog2html and dudiff2html templates")
+    subprocess.check_call(
+        [sys.executable, '-c', PRECOMPILE_SCRIPT],
+        env=dict(os.environ, POV_SERVER_PAGE_CACHE_DIR=cache_dir))
+
+
+class Watcher(object):
+    """Map inotify events to the build_list entries they affect."""
+
+    max_delay = 30  # seconds; don't let a stream of events stall rebuilds
+
+    def __init__(self, watch_list, inotify=None):
+        if inotify is None:
+            from .inotify import Inotify
+            inotify = Inotify()
+        self.inotify = inotify
+        self.dirs = {}  # dirname -> {basename or None: set of destinations}
+        for filename, destinations in watch_list:
+            for fn in sorted(set([filename, os.path.realpath(filename)])):
+                if os.path.isdir(fn):
+                    dirname, basename = fn, None
+                else:
+                    dirname, basename = os.path.split(fn)
+                names = self.dirs.setdefault(dirname, {})
+                names.setdefault(basename, set()).update(destinations)
+        for dirname in sorted(self.dirs):
+            try:
+                self.inotify.add_watch(dirname)
+            except OSError:
+                pass  # e.g. no /run/systemd on this machine
+
+    def close(self):
+        self.inotify.close()
+
+    def affected(self, events):
+        from .inotify import IN_Q_OVERFLOW
+        result = set()
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                for names in self.dirs.values():
+                    for destinations in names.values():
+                        result.update(destinations)
+                continue
+            names = self.dirs.get(event.path, {})
+            result.update(names.get(None, ()))
+            result.update(names.get(event.name, ()))
+        return result
+
+    def wait(self, timeout, debounce):
+        """Wait up to ``timeout`` seconds for changes.
+
+        Once something changes, keeps collecting events until there's a
+        ``debounce`` second pause.
+
+        Returns a set of affected build_list destinations.
+        """
+        events = self.inotify.read(timeout)
+        result = self.affected(events)
+        deadline = time.time() + self.max_delay
+        while events and time.time() < deadline:
+            events = self.inotify.read(debounce)
+            result.update(self.affected(events))
+        return result
+
+
+class Daemon(object):
+    """Keep the server page up to date from a long-running process.
+
+    Does a quick build (everything except disk usage) every ``interval``
+    seconds, or as soon as the config file changes, and a full build once
+    a day, after ``du_hour`` o'clock.  The full build runs in a background
+    thread, so quick builds go on during the disk usage scan.
+
+    Unlike the cron jobs this reuses compiled templates and other in-process
+    state between builds.
+
+    With ``watch`` it also uses inotify to notice changes in files listed
+    by Builder.get_watch_list() and rebuilds just the affected pages.
+    """
+
+    poll_interval = 60  # seconds between config file checks
+    debounce = 2  # seconds of quiet before rebuilding after a change
+
+    def __init__(self, config_file, overrides=(), destdir='', interval=3600,
+                 du_hour=6, verbose=False, quick=False, checks=False,
+                 watch=False, force=False):
+        self.config_file = config_file
+        self.overrides = overrides
+        self.destdir = destdir
+        self.interval = interval
+        self.du_hour = du_hour
+        self.verbose = verbose
+        self.quick = quick
+        self.checks = checks
+        self.watch = watch
+        self.force = force
+        self.watcher = None
+        self.changed = set()
+        self.config = None
+        self.builder = None
+        self.runs = RunCoordinator(destdir + STATE_DIR)
+        self.full_run = None
+        self.config_mtime = None
+        self.loaded = False
+        self.next_build = 0
+        self.last_full_build = None
+
+    def get_config_mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def config_changed(self):
+        return not self.loaded or self.get_config_mtime() != self.config_mtime
+
+    def reload(self):
+        self.config_mtime = self.get_config_mtime()
+        self.loaded = True
+        cp = read_config(self.config_file, self.overrides)
+        if not cp.getboolean(Builder.section, 'enabled'):
+            if self.verbose:
+                print("Disabled in the config file, waiting.")
+            self.builder = None
+            return
+        self.config = cp
+        self.builder = self.new_builder()
+        if self.watch:
+            self.start_watching()
+
+    def new_builder(self):
+        builder = Builder.from_config(self.config, destdir=self.destdir)
+        if self.builder is not None:
+            # keep the compiled templates
+            builder.lookup = self.builder.lookup
+            builder.html_lookup = self.builder.html_lookup
+        return builder
+
+    def start_watching(self):
+        if self.watcher is not None:
+            self.watcher.close()
+        watch_list = self.builder.get_watch_list()
+        watch_list.append((self.config_file, []))
+        self.watcher = Watcher(watch_list)
+
+    def full_build_due(self, now):
+        today = datetime.date.fromtimestamp(now)
+        return (not self.quick and self.last_full_build != today
+                and time.localtime(now).tm_hour >= self.du_hour)
+
+    def step(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.config_changed():
+            self.reload()
+            self.next_build = now
+        if self.builder is None:
+            return
+        full = self.full_build_due(now)
+        if not full and now < self.next_build:
+            if self.changed:
+                changed, self.changed = self.changed, set()
+                if not coordinated_build(self.builder, self.runs,
+                                         verbose=self.verbose, quick=True,
+                                         only=changed):
+                    # try again after the other run
+                    self.changed.update(changed)
+            return
+        self.changed = set()
+        if full:
+            self.start_full_build()
+            self.last_full_build = datetime.date.fromtimestamp(now)
+        else:
+            coordinated_build(self.builder, self.runs, verbose=self.verbose,
+                              quick=True, force=self.force)
+            if self.checks:
+                self.builder.check()
+        self.force = False
+        self.next_build = now + self.interval
+
+    def start_full_build(self):
+        """Start a full build in a background thread.
+
+        It gets a Builder and a RunCoordinator of its own, so the quick
+        builds in the main thread coordinate with it like they would with
+        another process.
+        """
+        self.full_run = threading.Thread(
+            target=self.full_build, name='full build',
+            args=(self.new_builder(), RunCoordinator(self.runs.state_dir),
+                  self.force))
+        self.full_run.daemon = True
+        self.full_run.start()
+
+    def full_build(self, builder, runs, force):
+        try:
+            coordinated_build(builder, runs, verbose=self.verbose,
+                              force=force)
+            if self.checks:
+                builder.check()
+        except Error as e:
+            print(e, file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+        sys.stdout.flush()
+
+    def wait(self):
+        if self.watcher is None:
+            time.sleep(self.poll_interval)
+        else:
+            self.changed.update(
+                self.watcher.wait(self.poll_interval, self.debounce))
+
+    def run(self):
+        while True:
+            try:
+                self.step()
+            except Error as e:
+                print(e, file=sys.stderr)
+            except Exception:
+                traceback.print_exc()
+            sys.stdout.flush()
+            self.wait()
+
+
 def init_logging():
     root = logging.getLogger()
     root.setLevel(logging.INFO)
@@ -677,6 +1510,9 @@ def main():
                       help="show what is happening")
     parser.add_option('-q', '--quick', action='store_true', default=False,
                       help='skip expensive steps (disk usage)')
+    parser.add_option('-f', '--force', action='store_true', default=False,
+                      help='rebuild everything, even if the inputs did not'
+                           ' change since the last run')
     parser.add_option('--no-checks', action='store_false', dest='checks',
                       help="don't check system configuration"
                            " (suppresses 'Please run ...' suggestions)",
@@ -686,15 +1522,40 @@ def main():
     parser.add_option('--destdir', default='',
                       help='prepend DESTDIR/ in front of all created files'
                            ' (for testing)')
+    parser.add_option('--daemon', action='store_true', default=False,
+                      help='keep running and rebuild the page periodically')
+    parser.add_option('--watch', action='store_true', default=False,
+                      help='in daemon mode, rebuild pages as soon as the'
+                           ' files they depend on change (implies --daemon)')
+    parser.add_option('--interval', type='int', default=3600,
+                      help='seconds between quick rebuilds in daemon mode'
+                           ' (default: %default)')
+    parser.add_option('--du-hour', type='int', default=6,
+                      help='hour of the day after which daemon mode does the'
+                           ' daily disk usage scan (default: %default)')
+    parser.add_option('--precompile', action='store_true', default=False,
+                      help='compile all templates into %s and exit'
+                           % (CACHE_DIR or 'the template cache directory'))
     opts, args = parser.parse_args()
-    # Config file parsing
-    cp = Builder.ConfigParser()
-    if not cp.read([opts.config_file]):
-        sys.exit("Could not read %s" % opts.config_file)
-    # Command-line overrides
-    for arg in args:
-        name, _, value = arg.partition('=')
-        cp.set(Builder.section, name, value)
+    if opts.precompile:
+        try:
+            precompile(verbose=opts.verbose)
+        except Error as e:
+            sys.exit(str(e))
+        return
+    if opts.daemon or opts.watch:
+        daemon = Daemon(opts.config_file, args, destdir=opts.destdir,
+                        interval=opts.interval, du_hour=opts.du_hour,
+                        verbose=opts.verbose, quick=opts.quick,
+                        checks=opts.checks, watch=opts.watch,
+                        force=opts.force)
+        daemon.run()
+        return
+    # Config file parsing, command-line overrides
+    try:
+        cp = read_config(opts.config_file, args)
+    except Error as e:
+        sys.exit(str(e))
     # Enabled?
     enabled = cp.getboolean(Builder.section, 'enabled')
     if not enabled:
@@ -703,8 +1564,10 @@ def main():
         return
     # Build /var/www/{hostname} and /etc/apache2/sites-available/
     builder = Builder.from_config(cp, destdir=opts.destdir)
+    runs = RunCoordinator(opts.destdir + STATE_DIR)
     try:
-        builder.build(verbose=opts.verbose, quick=opts.quick)
+        coordinated_build(builder, runs, verbose=opts.verbose,
+                          quick=opts.quick, force=opts.force)
         if opts.checks:
             builder.check()
     except Error as e:
@@ -1,16 +1,36 @@
+import hashlib
+import importlib.util
 import linecache
+import logging
+import os
 import re
 import sys
+import threading
 
 try:
     from html import escape
 except ImportError:
     from cgi import escape
 
-import mako.exceptions
 from markupsafe import Markup
 
 
+log = logging.getLogger(__name__)
+
+debian_package = (
+    __file__.startswith('/usr/lib/python') and 'dist-packages' in __file__
+)
+
+
+# Compiled Mako templates are cached here.  The Debian package creates it;
+# when running from a source checkout there's no cache by default.
+if debian_package:
+    CACHE_DIR = '/var/cache/pov-server-page'
+else:
+    CACHE_DIR = None
+CACHE_DIR = os.getenv('POV_SERVER_PAGE_CACHE_DIR', CACHE_DIR)
+
+
 #
 # ANSI to HTML colorizer
 #
@@ -100,6 +120,94 @@ def ansi2html(text):
     return Markup(u''.join(parts))
 
 
+#
+# Compiled template cache
+#
+
+# Template() arguments that don't affect the generated code
+RUNTIME_TEMPLATE_ARGS = ('error_handler', 'lookup')
+
+
+def load_template_module(filename):
+    """Import a compiled template module; return the module and its source."""
+    with open(filename) as f:
+        source = f.read()
+    name = re.sub(r'\W', '_', os.path.basename(filename)[:-len('.py')])
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, source
+
+
+def compile_template(text, uri=None, cache_dir=None, **kw):
+    """Create a Mako Template from source text.
+
+    Mako caches compiled modules only for templates loaded from files.  This
+    does the same for inline templates, when ``cache_dir`` is specified.
+    Modules are keyed by a hash of the source and compiler options, so stale
+    ones are never used.  Failures to write the cache are ignored (we might
+    not be running as root).
+    """
+    import mako.codegen
+    import mako.template
+    if not cache_dir:
+        return mako.template.Template(text=text, uri=uri, **kw)
+    runtime_args = dict((k, v) for k, v in kw.items()
+                        if k in RUNTIME_TEMPLATE_ARGS)
+    compile_args = sorted((k, v) for k, v in kw.items()
+                          if k not in RUNTIME_TEMPLATE_ARGS)
+    key = hashlib.sha256(repr(
+        (mako.codegen.MAGIC_NUMBER, uri, compile_args, text)
+    ).encode('UTF-8')).hexdigest()[:16]
+    filename = os.path.join(
+        cache_dir, '%s-%s.py' % (re.sub(r'\W', '_', uri or 'template'), key))
+    try:
+        module, source = load_template_module(filename)
+    except (OSError, IOError):
+        pass
+    except Exception as e:
+        log.warning("Ignoring broken compiled template %s: %s", filename, e)
+    else:
+        return mako.template.ModuleTemplate(
+            module, module_filename=filename, module_source=source,
+            template_source=text, **runtime_args)
+    template = mako.template.Template(text=text, uri=uri, **kw)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(filename + '.tmp', 'w') as f:
+            f.write(template.code)
+        os.rename(filename + '.tmp', filename)
+    except (OSError, IOError):
+        pass
+    return template
+
+
+class LazyTemplate(object):
+    """A template that gets compiled the first time it's rendered.
+
+    ``compile`` is called with ``uri`` and ``text`` keyword arguments and
+    must return a Mako Template.
+    """
+
+    def __init__(self, compile, uri, text):
+        self.compile = compile
+        self.uri = uri
+        self.text = text
+        self._template = None
+        self._lock = threading.Lock()
+
+    @property
+    def template(self):
+        with self._lock:
+            if self._template is None:
+                self._template = self.compile(uri=self.uri, text=self.text)
+        return self._template
+
+    def render_unicode(self, *args, **kw):
+        return self.template.render_unicode(*args, **kw)
+
+
 #
 # Pretty error messages
 #
@@ -112,6 +220,8 @@ def mako_error_handler(context, error):
 
     https://gist.github.com/mgedmin/4269249
     """
+    import mako.exceptions
+    import mako.template
     rich_tb = mako.exceptions.RichTraceback()
     rich_iter = iter(rich_tb.traceback)
     tb = sys.exc_info()[-1]
@@ -123,11 +233,11 @@ def mako_error_handler(context, error):
         co = f.f_code
         filename = co.co_filename
         lineno = tb.tb_lineno
-        if filename.startswith('memory:') or filename.endswith(('_html', '_in')):
+        if filename in mako.template.ModuleInfo._modules:
             lines = source.get(filename)
             if lines is None:
                 info = mako.template._get_module_info(filename)
-                lines = source[filename] = info.module_source.splitlines(True)
+                lines = source[filename] = info.code.splitlines(True)
                 linecache.cache[filename] = (None, None, lines, filename)
             if (filename, lineno) not in annotated:
                 annotated.add((filename, lineno))
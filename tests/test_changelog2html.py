@@ -2,9 +2,9 @@
 import datetime
 import errno
 import functools
+import json
 import os
 import shutil
-import socket
 import sys
 import tempfile
 import textwrap
@@ -17,10 +17,13 @@ try:
 except ImportError:
     from io import StringIO
 
+import mako.exceptions
+import mako.template
 import mock
 import pytest
 
 import pov_server_page.changelog2html as c2h
+from pov_server_page.utils import LazyTemplate
 
 
 class TestCase(unittest.TestCase):
@@ -117,6 +120,17 @@ class TestEntry(TestCase):
         entry = self.makeEntry()
         self.assertTrue(entry.title(), '2015-11-05 15:57 +0200 mg')
 
+    def test_isoformat(self):
+        entry = self.makeEntry()
+        self.assertEqual(entry.isoformat(), '2015-11-05T15:57:00+02:00')
+
+    def test_isoformat_no_timezone(self):
+        entry = self.makeEntry("""
+            2020-05-27: mg
+              # testing testing
+        """)
+        self.assertEqual(entry.isoformat(), '2020-05-27T00:00:00Z')
+
     def test_url(self):
         entry = self.makeEntry()
         self.assertTrue(entry.url('/changelog'), '/2015/11/05/#e1')
@@ -196,6 +210,13 @@ class TestChangelog(TestCase):
         changelog = self.makeChangelog()
         self.assertEqual([e.id for e in changelog.search('test')], [3, 2])
 
+    def test_newer_than(self):
+        changelog = self.makeChangelog()
+        self.assertEqual([e.id for e in changelog.newer_than(0)], [1, 2, 3])
+        self.assertEqual([e.id for e in changelog.newer_than(2)], [3])
+        self.assertEqual([e.id for e in changelog.newer_than(3)], [])
+        self.assertEqual([e.id for e in changelog.newer_than(-5)], [1, 2, 3])
+
     def test_parse(self):
         changelog = self.makeChangelog()
         self.assertEqual(changelog.preamble.text[0],
@@ -443,7 +464,9 @@ class TestHostname(TestCase):
 
     def test_fallback(self):
         os.environ.pop('HOSTNAME', None)
-        self.assertEqual(c2h.get_hostname({}), socket.gethostname())
+        self.patch('pov_server_page.changelog2html.get_fqdn',
+                   return_value='frog.example.com')
+        self.assertEqual(c2h.get_hostname({}), 'frog.example.com')
 
 
 class TestChangelogFilename(TestCase):
@@ -476,6 +499,55 @@ class TestGetMotdFilename(TestCase):
         self.assertEqual(c2h.get_motd_filename({}), '/etc/motd')
 
 
+class TestConditionalGet(TestCase):
+
+    def setUp(self):
+        self.filename = os.path.join(self.mkdtemp(), 'changelog')
+        with open(self.filename, 'w') as f:
+            f.write('hello')
+        os.utime(self.filename, (1445000000, 1445000000))
+
+    def test_get_validators(self):
+        etag, last_modified = c2h.get_validators(self.filename)
+        self.assertEqual(etag, '"%x-5"' % (1445000000 * 10**9))
+        self.assertEqual(last_modified, 'Fri, 16 Oct 2015 12:53:20 GMT')
+
+    def test_get_validators_change_when_file_changes(self):
+        etag, last_modified = c2h.get_validators(self.filename)
+        with open(self.filename, 'a') as f:
+            f.write(' world')
+        os.utime(self.filename, (1445000000, 1445000000))
+        new_etag, new_last_modified = c2h.get_validators(self.filename)
+        self.assertNotEqual(etag, new_etag)
+
+    def test_is_not_modified_no_headers(self):
+        self.assertFalse(c2h.is_not_modified(
+            {}, '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+
+    def test_is_not_modified_etag(self):
+        self.assertTrue(c2h.is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '"xyz", "abc"'},
+            '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+        self.assertTrue(c2h.is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '*'},
+            '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+        self.assertFalse(c2h.is_not_modified(
+            {'HTTP_IF_NONE_MATCH': '"xyz"',
+             'HTTP_IF_MODIFIED_SINCE': 'Fri, 16 Oct 2015 12:53:20 GMT'},
+            '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+
+    def test_is_not_modified_since(self):
+        self.assertTrue(c2h.is_not_modified(
+            {'HTTP_IF_MODIFIED_SINCE': 'Fri, 16 Oct 2015 12:53:20 GMT'},
+            '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+        self.assertFalse(c2h.is_not_modified(
+            {'HTTP_IF_MODIFIED_SINCE': 'Fri, 16 Oct 2015 12:53:19 GMT'},
+            '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+        self.assertFalse(c2h.is_not_modified(
+            {'HTTP_IF_MODIFIED_SINCE': 'yesterday'},
+            '"abc"', 'Fri, 16 Oct 2015 12:53:20 GMT'))
+
+
 class TestResponse(TestCase):
 
     def test(self):
@@ -558,6 +630,27 @@ class TestTemplateDefaultFilters(unittest.TestCase):
                          '<p>&amp;</p>')
 
 
+class TestLazyTemplates(unittest.TestCase):
+
+    def test_compiled_on_demand(self):
+        lookup = c2h.TemplateLookup()
+        compile = mock.Mock(side_effect=lambda uri, text: mako.template.Template(
+            uri=uri, text=text, lookup=lookup))
+        lookup.lazy_templates['page.html'] = LazyTemplate(
+            compile, 'page.html', '<body>${next.body()}</body>')
+        template = LazyTemplate(
+            compile, 'hello.html', '<%inherit file="page.html" />Hello')
+        self.assertEqual(compile.call_count, 0)
+        self.assertEqual(template.render_unicode(), '<body>Hello</body>')
+        self.assertEqual(compile.call_count, 2)
+        self.assertEqual(template.render_unicode(), '<body>Hello</body>')
+        self.assertEqual(compile.call_count, 2)
+
+    def test_unknown_template(self):
+        with self.assertRaises(mako.exceptions.TopLevelLookupException):
+            c2h.TEMPLATES.get_template('nosuchtemplate.html')
+
+
 class TestStylesheet(TestCase):
 
     def test(self):
@@ -812,6 +905,127 @@ class TestSearchPage(PageTestCase):
         self.assertEqual(response.status, '404 Not Found')
 
 
+class FeedTestCase(PageTestCase):
+
+    changelog_text = """
+        Test changelog
+
+        2014-10-08 09:26 +0300: mg
+          # did a thing
+
+        2014-10-09 10:00 +0300: mg
+          # did <another> thing
+    """
+
+    def setUp(self):
+        super(FeedTestCase, self).setUp()
+        filename = os.path.join(self.mkdtemp(), 'testlog')
+        with open(filename, 'w') as f:
+            f.write('placeholder')
+        self.environment = dict(self.environment, CHANGELOG_FILE=filename)
+        self.etag, self.last_modified = c2h.get_validators(filename)
+
+    def get_changelog(self, filename):
+        if filename == 'nosuchfile':
+            raise OSError(errno.ENOENT)
+        self.parsed = True
+        changelog_text = textwrap.dedent(self.changelog_text.lstrip('\n'))
+        changelog = c2h.Changelog()
+        changelog.parse(StringIO(changelog_text))
+        return changelog
+
+
+class TestFeedPage(FeedTestCase):
+
+    def test(self):
+        response = c2h.feed_page(self.environ())
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['ETag'], self.etag)
+        self.assertEqual(response.headers['Last-Modified'], self.last_modified)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/atom+xml; charset=UTF-8')
+        self.assertTrue(response.body.startswith('<?xml version="1.0"'))
+        self.assertIn('<updated>2014-10-09T10:00:00+03:00</updated>',
+                      response.body)
+        self.assertIn('<id>tag:example.com,2000:changelog/e2</id>',
+                      response.body)
+        self.assertIn('&lt;pre&gt;  # did &amp;lt;another&amp;gt; thing',
+                      response.body)
+        self.assertLess(response.body.index('changelog/e2'),
+                        response.body.index('changelog/e1'))
+
+    def test_empty(self):
+        self.changelog_text = "Nothing here yet\n"
+        response = c2h.feed_page(self.environ())
+        self.assertIn('<updated>1970-01-01T00:00:00Z</updated>',
+                      response.body)
+
+    def test_not_modified(self):
+        response = c2h.feed_page(self.environ(HTTP_IF_NONE_MATCH=self.etag))
+        self.assertEqual(response.status, '304 Not Modified')
+        self.assertEqual(response.body, '')
+        self.assertEqual(response.headers['ETag'], self.etag)
+        self.assertFalse(hasattr(self, 'parsed'))
+
+    def test_not_found(self):
+        response = c2h.feed_page(self.environ(CHANGELOG_FILE='nosuchfile'))
+        self.assertEqual(response.status, '404 Not Found')
+
+    def test_disappeared(self):
+        self.patch('pov_server_page.changelog2html.get_validators',
+                   return_value=(self.etag, self.last_modified))
+        response = c2h.feed_page(self.environ(CHANGELOG_FILE='nosuchfile'))
+        self.assertEqual(response.status, '404 Not Found')
+
+
+class TestEntriesPage(FeedTestCase):
+
+    def test(self):
+        response = c2h.entries_page(self.environ(QUERY_STRING='since=1'))
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['ETag'], self.etag)
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.body), {
+            'last_id': 2,
+            'entries': [
+                {
+                    'id': 2,
+                    'timestamp': '2014-10-09T10:00:00+03:00',
+                    'user': 'mg',
+                    'title': '2014-10-09 10:00 +0300 mg',
+                    'url': '/2014/10/09/#e2',
+                    'text': '  # did <another> thing\n',
+                },
+            ],
+        })
+
+    def test_all(self):
+        response = c2h.entries_page(self.environ())
+        data = json.loads(response.body)
+        self.assertEqual([e['id'] for e in data['entries']], [1, 2])
+
+    def test_bad_since(self):
+        response = c2h.entries_page(self.environ(QUERY_STRING='since=last'))
+        self.assertEqual(response.status, '400 Bad Request')
+
+    def test_not_modified(self):
+        response = c2h.entries_page(self.environ(
+            QUERY_STRING='since=1',
+            HTTP_IF_MODIFIED_SINCE=self.last_modified))
+        self.assertEqual(response.status, '304 Not Modified')
+        self.assertFalse(hasattr(self, 'parsed'))
+
+    def test_not_found(self):
+        response = c2h.entries_page(self.environ(CHANGELOG_FILE='nosuchfile'))
+        self.assertEqual(response.status, '404 Not Found')
+
+    def test_disappeared(self):
+        self.patch('pov_server_page.changelog2html.get_validators',
+                   return_value=(self.etag, self.last_modified))
+        response = c2h.entries_page(self.environ(CHANGELOG_FILE='nosuchfile'))
+        self.assertEqual(response.status, '404 Not Found')
+
+
 class TestWsgiApp(PageTestCase):
 
     def test_view_that_returns_response(self):
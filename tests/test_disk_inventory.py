@@ -1,7 +1,9 @@
 from __future__ import print_function
 
+import json
 import os
 import textwrap
+import time
 import unittest
 
 import pytest
@@ -96,6 +98,90 @@ class TestCase(PatchMixin, unittest.TestCase):
         self.patch_files({})
         self.patch_commands({})
 
+    def patch_commands(self, commands):
+        super(TestCase, self).patch_commands(commands)
+        self.patch('run_command', self._run_command)
+
+    def _run_command(self, command, timeout):
+        return di.CommandResult(self._commands.get(command, ''), None)
+
+
+class TestRunCommand(unittest.TestCase):
+
+    def test_success(self):
+        self.assertEqual(di.run_command('echo hello'), ('hello\n', None))
+
+    def test_failure(self):
+        output, error = di.run_command('ls /nonexistent/directory')
+        self.assertIn('/nonexistent/directory', error)
+
+    def test_failure_without_message(self):
+        self.assertEqual(di.run_command('false'), ('', 'exit status 1'))
+
+    def test_timeout(self):
+        self.assertEqual(di.run_command('sleep 10', timeout=0.1),
+                         ('', 'timed out after 0.1 seconds'))
+
+    def test_no_such_command(self):
+        self.assertEqual(di.run_command('no-such-command-I-hope'), ('', None))
+
+    def test_other_errors(self):
+        output, error = di.run_command('/dev/null')
+        self.assertIn('Permission denied', error)
+
+
+class TestCommandRunner(TestCase):
+
+    def setUp(self):
+        super(TestCommandRunner, self).setUp()
+        self.warnings = []
+        self.info.warn = self.warnings.append
+
+    def test_commands_run_in_parallel(self):
+        started = []
+
+        def run_command(command, timeout):
+            started.append(command)
+            if command == self.info.DF:
+                # wait for all the others to start
+                deadline = time.time() + 5
+                while len(started) < 3 and time.time() < deadline:
+                    time.sleep(0.001)
+            return di.CommandResult('', None)
+
+        self.patch('run_command', run_command)
+        self.info.start_commands()
+        self.info.list_filesystems()
+        self.assertEqual(len(started), 3)
+
+    def test_each_command_runs_once(self):
+        started = []
+        self.patch('run_command', lambda command, timeout: (
+            started.append(command) or di.CommandResult('', None)))
+        self.info.start_commands()
+        self.info.list_lvm_volume_groups()
+        self.info.list_lvm_physical_volumes()
+        self.assertEqual(sorted(started), sorted(set(started)))
+
+    def test_warnings(self):
+        self.patch('os.getuid', lambda: 0)
+        self.patch('run_command', lambda command, timeout: di.CommandResult(
+            '', 'timed out after 30 seconds'))
+        self.assertEqual(self.info.list_device_mapper(), [])
+        self.assertEqual(self.warnings, [
+            'disk-inventory: dmsetup: timed out after 30 seconds',
+        ])
+
+    def test_no_warnings_for_root_commands_when_not_root(self):
+        self.patch('os.getuid', lambda: 1000)
+        self.patch('run_command', lambda command, timeout: di.CommandResult(
+            '', 'Permission denied'))
+        self.assertEqual(self.info.list_device_mapper(), [])
+        self.assertEqual(self.info.list_filesystems(), [])
+        self.assertEqual(self.warnings, [
+            'disk-inventory: df: Permission denied',
+        ])
+
 
 class TestCanonicalDeviceName(TestCase):
 
@@ -216,7 +302,7 @@ class TestLVM(TestCase):
 
     def test_list_vgs(self):
         self.patch_commands({
-            'vgdisplay -c 2>/dev/null': (
+            'vgdisplay -c': (
                 '  platonas:r/w:772:-1:0:2:2:-1:0:1:1:487878656:4096:119111:119111:0:jzd3VL-RR7v-44tD-O8zO-9sSI-qFEs-hpmnPE\n'
             ),
         })
@@ -226,7 +312,7 @@ class TestLVM(TestCase):
 
     def test_list_pvs(self):
         self.patch_commands({
-            'pvdisplay -c 2>/dev/null': (
+            'pvdisplay -c': (
                 '  /dev/mapper/sda5_crypt:platonas:975765504:-1:8:8:-1:4096:119111:0:119111:mRMbR0-4xMf-IuXS-cx20-gXJW-r6MG-QewhqEn\n'
                 '  "/dev/sdc2" is a new physical volume of "231.95 GiB"\n'
             ),
@@ -237,7 +323,7 @@ class TestLVM(TestCase):
 
     def test_list_lvm_logical_volumes(self):
         self.patch_commands({
-            'lvs --separator=: --units=b --nosuffix --noheadings -o lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open --all 2>/dev/null': (
+            'lvs --separator=: --units=b --nosuffix --noheadings -o lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open --all': (
                 '  root:platonas:491119443968:/dev/mapper/platonas-root:public:/dev/mapper/sda5_crypt(0)::open\n'
                 '  swap_1:platonas:8468299776:/dev/mapper/platonas-swap_1:public:/dev/mapper/sda5_crypt(117092)::open\n'
             ),
@@ -248,6 +334,112 @@ class TestLVM(TestCase):
         ])
 
 
+class TestLVMFullReport(TestCase):
+
+    REPORT = json.dumps({'report': [
+        {
+            'vg': [{'vg_name': 'platonas', 'vg_size': '499587743744',
+                    'vg_free': '1073741824'}],
+            'pv': [{'pv_name': '/dev/mapper/sda5_crypt',
+                    'vg_name': 'platonas', 'pv_free': '1073741824'}],
+            'lv': [{'lv_name': 'root'}, {'lv_name': 'swap_1'}],
+            'pvseg': [{'pvseg_start': '0'}, {'pvseg_start': '117092'}],
+            'seg': [
+                {'lv_name': 'root', 'vg_name': 'platonas',
+                 'lv_size': '491119443968',
+                 'lv_dm_path': '/dev/mapper/platonas-root',
+                 'lv_role': 'public', 'devices': '/dev/mapper/sda5_crypt(0)',
+                 'metadata_devices': '', 'lv_device_open': 'open'},
+                {'lv_name': 'swap_1', 'vg_name': 'platonas',
+                 'lv_size': '8468299776',
+                 'lv_dm_path': '/dev/mapper/platonas-swap_1',
+                 'lv_role': 'public',
+                 'devices': '/dev/mapper/sda5_crypt(117092)',
+                 'metadata_devices': '', 'lv_device_open': ''},
+            ],
+        },
+        {
+            'vg': [], 'lv': [], 'pvseg': [], 'seg': [],
+            'pv': [{'pv_name': '/dev/sdc2', 'vg_name': '',
+                    'pv_free': '249042370560'}],
+        },
+    ]})
+
+    def setUp(self):
+        super(TestLVMFullReport, self).setUp()
+        self.started = []
+
+    def patch_commands(self, commands):
+        super(TestLVMFullReport, self).patch_commands(commands)
+        self.patch('run_command', lambda command, timeout: (
+            self.started.append(command.split()[0])
+            or self._run_command(command, timeout)))
+
+    def test_list_vgs(self):
+        self.patch_commands({di.LinuxDiskInfo.LVM_FULLREPORT: self.REPORT})
+        self.assertEqual(self.info.list_lvm_volume_groups(), [
+            ('platonas', 487878656, 486830080, 1048576),
+        ])
+
+    def test_list_pvs(self):
+        self.patch_commands({di.LinuxDiskInfo.LVM_FULLREPORT: self.REPORT})
+        self.assertEqual(self.info.list_lvm_physical_volumes(), [
+            ('mapper/sda5_crypt', 'platonas', 1048576),
+        ])
+
+    def test_list_lvm_logical_volumes(self):
+        self.patch_commands({di.LinuxDiskInfo.LVM_FULLREPORT: self.REPORT})
+        self.assertEqual(self.info.list_lvm_logical_volumes(), [
+            ('root', 'platonas', 491119443968, 'mapper/platonas-root', 'public', {'/dev/mapper/sda5_crypt'}, True),
+            ('swap_1', 'platonas', 8468299776, 'mapper/platonas-swap_1', 'public', {'/dev/mapper/sda5_crypt'}, False),
+        ])
+
+    def test_one_lvm_command(self):
+        self.patch_commands({di.LinuxDiskInfo.LVM_FULLREPORT: self.REPORT})
+        self.info.list_lvm_volume_groups()
+        self.info.list_lvm_physical_volumes()
+        self.info.list_lvm_logical_volumes()
+        self.assertEqual(self.started, ['lvm'])
+
+    def test_fallback_for_old_lvm(self):
+        self.patch_commands({
+            # lvm 2.02.157 and older say 'No such command' and exit with 1,
+            # which we don't get to see because of the stderr handling
+            di.LinuxDiskInfo.LVM_FULLREPORT: '',
+            'vgdisplay -c': (
+                '  platonas:r/w:772:-1:0:2:2:-1:0:1:1:487878656:4096:119111:119111:0:jzd3VL-RR7v-44tD-O8zO-9sSI-qFEs-hpmnPE\n'
+            ),
+        })
+        self.assertEqual(self.info.list_lvm_volume_groups(), [
+            ('platonas', 487878656, 487878656, 0),
+        ])
+        self.assertIn('vgdisplay', self.started)
+
+    def test_fallback_on_error(self):
+        self.patch_commands({})
+        self.patch('run_command', lambda command, timeout: (
+            self.started.append(command.split()[0])
+            or di.CommandResult('', 'exit status 5' if command.startswith('lvm ') else None)))
+        self.assertEqual(self.info.list_lvm_volume_groups(), [])
+        self.assertIn('vgdisplay', self.started)
+
+    def test_no_fallback_on_timeout(self):
+        warnings = []
+        self.info.warn = warnings.append
+        self.patch('os.getuid', lambda: 0)
+        self.patch('run_command', lambda command, timeout: (
+            self.started.append(command.split()[0])
+            or di.CommandResult('', 'timed out after 30 seconds'
+                                if command.startswith('lvm ') else None)))
+        self.assertEqual(self.info.list_lvm_volume_groups(), [])
+        self.assertEqual(self.info.list_lvm_physical_volumes(), [])
+        self.assertEqual(self.info.list_lvm_logical_volumes(), [])
+        self.assertEqual(self.started, ['lvm'])
+        self.assertEqual(warnings, [
+            'disk-inventory: lvm: timed out after 30 seconds',
+        ])
+
+
 class TestKVM(TestCase):
 
     def test(self):
@@ -487,7 +679,7 @@ class TestPartitions(TestCase):
                 platonas-root:253:1:L--w:1:1:0:LVM-blahblah
                 sda5_crypt:253:0:L--w:2:1:0:CRYPT-LUKS1-blah-sda5_crypt
             '''),
-            'pvdisplay -c 2>/dev/null': (
+            'pvdisplay -c': (
                 '  /dev/mapper/sda5_crypt:platonas:975765504:-1:8:8:-1:4096:119111:0:119111:mRMbR0-4xMf-IuXS-cx20-gXJW-r6MG-QewhqEn\n'
                 '  "/dev/sdc2" is a new physical volume of "231.95 GiB"\n'
             ),
@@ -555,7 +747,7 @@ class TestPartitions(TestCase):
             '/proc/swaps': '',
         })
         self.patch_commands({
-            'pvdisplay -c 2>/dev/null': '',
+            'pvdisplay -c': '',
             'df -P --local --print-type -x debugfs': '',
             'dmsetup -c --noheadings info': textwrap.dedent('''\
                 fridge-box_rimage_1:252:33:L--w:1:1:0:LVM-vdq2Htm5RNrD0vlTEfoqtNLGm4UGZDn2xMjyUUhS8GSQvnw8d7TgQvbEYIffzihX
@@ -582,7 +774,7 @@ class TestPartitions(TestCase):
                 /dev/md3                        ext4       220956716  79482580 130243504      38% /home
                 /dev/md4                        ext4       237379060 189781084  45184944      81% /stuff
             '''),
-            'pvdisplay -c 2>/dev/null': '',
+            'pvdisplay -c': '',
         })
         self.assertEqual(self.info.get_partition_usage('sda2'),
                          'md0: ext4 /boot')
@@ -615,7 +807,7 @@ class TestPartitions(TestCase):
                 /dev/mapper/platonas-root ext4       471950640 143870928 304082888      33% /
                 /dev/sda1                 ext2          482922    143130    314858      32% /boot
             '''),
-            'pvdisplay -c 2>/dev/null': (
+            'pvdisplay -c': (
                 '  /dev/mapper/sda5_crypt:platonas:975765504:-1:8:8:-1:4096:119111:0:119111:mRMbR0-4xMf-IuXS-cx20-gXJW-r6MG-QewhqEn\n'
             ),
         })
@@ -631,6 +823,135 @@ class TestPartitions(TestCase):
                          'swap')
 
 
+class TestDeviceResolutionCache(TestCase):
+
+    def setUp(self):
+        super(TestDeviceResolutionCache, self).setUp()
+        self.patch_files({
+            '/dev/mapper/sda5_crypt': Symlink('../dm-0'),
+            '/sys/block/sda/sda5/holders/dm-0': Symlink('../../../../../../../../../../virtual/block/dm-0'),
+            '/sys/block/sda/sda5/holders/md0': Symlink('../../../../../../../../../../virtual/block/md0'),
+        })
+
+    def count_calls(self, name):
+        calls = []
+        orig = getattr(self.info, name)
+        setattr(self.info, name, lambda *args: calls.append(args) or orig(*args))
+        return calls
+
+    def test_dm_names_computed_once(self):
+        calls = self.count_calls('list_device_mapper_names')
+        self.assertEqual(self.info._canonical_device_name('/dev/dm-0'),
+                         'mapper/sda5_crypt')
+        self.assertEqual(self.info.partition_dm_devices('sda5'),
+                         ['mapper/sda5_crypt'])
+        self.assertEqual(len(calls), 1)
+
+    def test_canonical_device_name_cached(self):
+        calls = self.count_calls('_compute_canonical_device_name')
+        for n in range(3):
+            self.assertEqual(self.info._canonical_device_name('/dev/sda1'),
+                             'sda1')
+        self.assertEqual(len(calls), 1)
+
+    def test_partition_devices_cached(self):
+        calls = self.count_calls('list_partition_holders')
+        self.patch_commands({'df -P --local --print-type -x debugfs': ''})
+        self.patch_files({'/proc/swaps': ''})
+        self.info.get_partition_usage('sda5')
+        self.info.get_partition_fsinfo('sda5')
+        self.info.get_partition_lvm_pv('sda5')
+        self.info.get_partition_kvm_vm('sda5')
+        self.info.is_partition_used('sda5')
+        self.assertEqual(self.info._partition_devices('sda5'),
+                         ('sda5', 'md0', 'mapper/sda5_crypt'))
+        # twice to build the cached device list, once more for the md
+        # prefixes in get_partition_usage()
+        self.assertEqual(len(calls), 3)
+
+
+class TestSysfsSnapshot(TestCase):
+
+    def test_read(self):
+        self.patch_files({
+            '/sys/block/sda/size': '976773168\n',
+            '/sys/block/sda/queue/rotational': '1\n',
+            '/sys/block/sda/device/model': 'WDC WD5000AAKX\n',
+            '/sys/block/sda/device/firmware_rev': '15.01H15\n',
+            '/sys/block/sda/device/serial': 'WD-WCAYUJ123456\n',
+            '/sys/block/sda/sda1/size': '997376\n',
+            '/sys/block/sda/sda1/start': '2048\n',
+            '/sys/block/sda/sda1/holders/md0': Symlink('../../../../../../../../../../virtual/block/md0'),
+            '/sys/block/md0/size': '995328\n',
+            '/sys/block/md0/holders': Directory(),
+            '/sys/block/loop0/size': '0\n',
+        })
+        snapshot = di.SysfsSnapshot.read()
+        self.assertEqual(dict(snapshot.disks), {
+            'sda': di.SysDisk(
+                name='sda', size_sectors=976773168, model='WDC WD5000AAKX',
+                firmware_rev='15.01H15', serial='WD-WCAYUJ123456',
+                rotational=True, partitions=('sda1', ))
+        })
+        self.assertEqual(sorted(snapshot.devices),
+                         ['loop0', 'md0', 'sda', 'sda1'])
+        self.assertEqual(snapshot.devices['sda1'],
+                         ('sda1', 997376, 2048, ('md0', )))
+        self.assertEqual(snapshot.devices['md0'], ('md0', 995328, None, ()))
+
+    def test_immutable(self):
+        snapshot = di.SysfsSnapshot.read()
+        with self.assertRaises(TypeError):
+            snapshot.devices['sda'] = None
+
+    def test_no_sys_block(self):
+        snapshot = di.SysfsSnapshot.read()
+        self.assertEqual(dict(snapshot.disks), {})
+        self.assertEqual(dict(snapshot.devices), {})
+
+    def test_missing_attributes(self):
+        self.patch_files({
+            '/sys/block/sdp/sdp1/size': '997376\n',
+        })
+        self.assertEqual(self.info.list_physical_disks(), ['sdp'])
+        self.assertEqual(self.info.get_disk_model('sdp'), 'N/A')
+        self.assertEqual(self.info.get_disk_firmware_rev('sdp'), 'N/A')
+        self.assertEqual(self.info.get_disk_serial('sdp'), 'N/A')
+        self.assertEqual(self.info.get_disk_size_bytes('sdp'), 0)
+        self.assertFalse(self.info.is_disk_an_ssd('sdp'))
+        self.assertEqual(self.info.list_partitions('sdp'), ['sdp1'])
+        self.assertEqual(self.info.get_partition_size_bytes('sdp1'),
+                         510656512)
+        self.assertEqual(self.info.get_partition_offset_bytes('sdp1'), 0)
+
+    def test_unknown_devices(self):
+        self.assertEqual(self.info.list_partitions('sdz'), [])
+        self.assertEqual(self.info.get_partition_size_bytes('sdz1'), 0)
+        self.assertEqual(self.info.get_partition_offset_bytes('sdz1'), 0)
+
+    def test_sysfs_read_once(self):
+        self.patch_files({
+            '/proc/swaps': '',
+            '/sys/block/sda/size': '976773168\n',
+            '/sys/block/sda/device/model': 'Samsung SSD 850\n',
+            '/sys/block/sda/sda1/size': '997376\n',
+            '/sys/block/sda/sda1/start': '2048\n',
+            '/sys/block/sda/sda1/holders': Directory(),
+            '/sys/block/sda/sda2/size': '975769600\n',
+            '/sys/block/sda/sda2/start': '1001472\n',
+            '/sys/block/sda/sda2/holders': Directory(),
+        })
+        opened = []
+        listed = []
+        _open, _listdir = self._open, self._listdir
+        self.patch('open', lambda fn, mode='r': (
+            opened.append(fn) or _open(fn, mode)))
+        self.patch('os.listdir', lambda dn: listed.append(dn) or _listdir(dn))
+        di.report_text(info=self.info, verbose=2)
+        self.assertEqual(sorted(opened), sorted(set(opened)))
+        self.assertEqual(sorted(listed), sorted(set(listed)))
+
+
 class TestTextReporter(TestCase):
 
     def test_ssd_label(self):
@@ -713,13 +1034,13 @@ class TestReport(TestCase):
             '/sys/block/dm-2/holders': Directory(),
         })
         self.patch_commands({
-            'pvdisplay -c 2>/dev/null': (
+            'pvdisplay -c': (
                 '  /dev/mapper/sda5_crypt:platonas:975765504:-1:8:8:-1:4096:119111:0:119111:mRMbR0-4xMf-IuXS-cx20-gXJW-r6MG-QewhqEn\n'
             ),
-            'vgdisplay -c 2>/dev/null': (
+            'vgdisplay -c': (
                 '  platonas:r/w:772:-1:0:2:2:-1:0:1:1:487878656:4096:119111:119111:0:jzd3VL-RR7v-44tD-O8zO-9sSI-qFEs-hpmnPE\n'
             ),
-            'lvs --separator=: --units=b --nosuffix --noheadings -o lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open --all 2>/dev/null': (
+            'lvs --separator=: --units=b --nosuffix --noheadings -o lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open --all': (
                 '  root:platonas:491119443968:/dev/mapper/platonas-root:public:/dev/mapper/sda5_crypt(0)::open\n'
                 '  swap_1:platonas:8468299776:/dev/mapper/platonas-swap_1:public:/dev/mapper/sda5_crypt(117092)::open\n'
             ),
@@ -800,18 +1121,18 @@ class TestReport(TestCase):
             '/sys/block/sde/sde5/holders/dm-0': Symlink('../../../../../../../../../../virtual/block/dm-0'),
         })
         self.patch_commands({
-            'pvdisplay -c 2>/dev/null': (
+            'pvdisplay -c': (
                 '  /dev/mapper/sde5_crypt:platonas:975765504:-1:8:8:-1:4096:119111:0:119111:mRMbR0-4xMf-IuXS-cx20-gXJW-r6MG-QewhqEn\n'
                 '  /dev/sda9:fridge:976755038:-1:8:8:-1:4096:119232:66996:52236:cGLoDM-0HFH-u8X8-66T7-2u6k-LM13-6fyNVk\n'
                 '  /dev/sdb9:fridge:976755038:-1:8:8:-1:4096:119232:66996:52236:zLNTe2-usSn-9cJC-Atqa-wjwX-dUsQ-3jtI3E\n'
                 '  /dev/sdc2:fridge:486443376:-1:8:8:-1:4096:59380:33779:25601:VUA1rj-ZAdJ-VxuO-Cbb0-8DQz-B5Yf-zRuR2x\n'
                 '  /dev/sdd2:fridge:486443376:-1:8:8:-1:4096:59380:33779:25601:0uEuwq-6HB5-9zqB-5fnS-K4pX-RSlH-CKOrrj\n'
             ),
-            'vgdisplay -c 2>/dev/null': (
+            'vgdisplay -c': (
                 '  platonas:r/w:772:-1:0:2:2:-1:0:1:1:487878656:4096:119111:119111:0:jzd3VL-RR7v-44tD-O8zO-9sSI-qFEs-hpmnPE\n'
                 '  fridge:r/w:772:-1:0:13:10:-1:0:4:4:1463189504:4096:357224:155674:201550:vdq2Ht-m5RN-rD0v-lTEf-oqtN-LGm4-UGZDn2\n'
             ),
-            'lvs --separator=: --units=b --nosuffix --noheadings -o lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open --all 2>/dev/null': (
+            'lvs --separator=: --units=b --nosuffix --noheadings -o lv_name,vg_name,lv_size,lv_dm_path,lv_role,devices,metadata_devices,lv_device_open --all': (
                 '  root:platonas:491119443968:/dev/mapper/platonas-root:public:/dev/mapper/sda5_crypt(0)::open\n'
                 '  swap_1:platonas:8468299776:/dev/mapper/platonas-swap_1:public:/dev/mapper/sda5_crypt(117092)::open\n'
                 '  apache-logs:fridge:21474836480:/dev/mapper/fridge-apache--logs:public:apache-logs_rimage_0(0),apache-logs_rimage_1(0):apache-logs_rmeta_0(0),apache-logs_rmeta_1(0):open\n'
@@ -1002,6 +1323,98 @@ class TestReport(TestCase):
         di.report_html(verbose=2)
 
 
+class TestReportSharedInfo(TestCase):
+
+    def test_warnings_repeated(self):
+        self.patch('os.getuid', lambda: 1000)
+        self.patch_files({'/proc/swaps': ''})
+        expected = ['disk-inventory: cannot discover block devices: /sys/block is missing',
+                    'disk-inventory: cannot list LVM devices: running as non-root']
+        warnings = []
+        di.report(info=self.info, print=[].append, warn=warnings.append)
+        self.assertEqual(warnings, expected)
+        warnings = []
+        di.report_html(info=self.info)
+        di.report(info=self.info, print=[].append, warn=warnings.append)
+        self.assertEqual(warnings, expected)
+
+    def test_warnings_go_to_stderr(self):
+        self.patch('sys.stderr', NativeStringIO())
+        self.patch_files({'/proc/swaps': ''})
+        self.patch('os.getuid', lambda: 0)
+        di.report(info=self.info, print=[].append)
+        self.assertEqual(
+            di.sys.stderr.getvalue(),
+            'disk-inventory: cannot discover block devices: /sys/block is missing\n')
+
+    def test_commands_run_once(self):
+        started = []
+        self.patch('run_command', lambda command, timeout: (
+            started.append(command) or di.CommandResult('', None)))
+        self.patch_files({'/proc/swaps': ''})
+        di.report_text(info=self.info)
+        di.report_html(info=self.info)
+        self.assertEqual(sorted(started), sorted(set(started)))
+
+
+class TestFingerprint(TestCase):
+
+    def setUp(self):
+        super(TestFingerprint, self).setUp()
+        self.patch_files({
+            '/proc/partitions': 'major minor  #blocks  name\n\n   8        0  488386584 sda\n',
+            '/proc/self/mounts': (
+                'sysfs /sys sysfs rw,nosuid,nodev,noexec,relatime 0 0\n'
+                '/dev/sda1 / ext4 rw,relatime 0 0\n'
+                '/dev/sda2 /mnt/old\\040disk ext4 rw,relatime 0 0\n'
+                '/dev/sda3 /mnt/gone ext4 rw,relatime 0 0\n'
+            ),
+            '/dev/mapper/control': '',
+            '/dev/mapper/platonas-root': Symlink('../dm-0'),
+            '/etc/lvm/backup/platonas': '',
+            '/etc/lvm/backup/gone': '',
+        })
+        self.patch('os.statvfs', self.statvfs)
+        self.patch('os.stat', self.stat)
+        self.avail = {'/': 123456789, '/mnt/old disk': 0}
+
+    def statvfs(self, path):
+        if path not in self.avail:
+            raise OSError(2, 'No such file or directory')
+        return os.statvfs_result((4096, 4096, 0, 0, self.avail[path] // 4096,
+                                  0, 0, 0, 0, 255))
+
+    def stat(self, path):
+        if path == '/etc/lvm/backup/gone':
+            raise OSError(2, 'No such file or directory')
+        return os.stat_result((0o100600, 0, 0, 1, 0, 0, 0, 0, 1700000000, 0))
+
+    def test(self):
+        self.assertEqual(di.fingerprint(), [
+            'major minor  #blocks  name\n\n   8        0  488386584 sda\n',
+            None,
+            self._files['/proc/self/mounts'],
+            '/dev/mapper/control',
+            ('/dev/mapper/platonas-root', '../dm-0'),
+            ('/etc/lvm/backup/platonas', 1700000000),
+            ('/', '123.5 MB'),
+            ('/mnt/old disk', '0.0 B'),
+        ])
+
+    def test_no_devmapper(self):
+        for name in ['/dev/mapper', '/dev/mapper/control',
+                     '/dev/mapper/platonas-root']:
+            del self._files[name]
+        self.assertNotIn('/dev/mapper/control', di.fingerprint())
+
+    def test_free_space_rounded(self):
+        before = di.fingerprint()
+        self.avail['/'] += 4096
+        self.assertEqual(di.fingerprint(), before)
+        self.avail['/'] += 1000000
+        self.assertNotEqual(di.fingerprint(), before)
+
+
 class TestMain(TestCase):
 
     def run_main(self, *args):
@@ -1014,7 +1427,7 @@ class TestMain(TestCase):
             '/sys/block': Directory(),
         })
         self.patch_commands({
-            'vgdisplay -c 2>/dev/null': '',
+            'vgdisplay -c': '',
         })
         self.run_main()
 
@@ -1024,6 +1437,6 @@ class TestMain(TestCase):
             '/sys/block': Directory(),
         })
         self.patch_commands({
-            'vgdisplay -c 2>/dev/null': '',
+            'vgdisplay -c': '',
         })
         self.run_main('--html')
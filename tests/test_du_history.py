@@ -0,0 +1,178 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import mock
+
+from pov_server_page.du_history import SizeHistory, snapshot_date
+
+
+class TestSnapshotDate(unittest.TestCase):
+
+    def test(self):
+        self.assertEqual(snapshot_date('/var/www/du/root/du-2015-11-01.gz'),
+                         '2015-11-01')
+
+
+class TestSizeHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.datadir)
+        self.history = SizeHistory(self.datadir)
+
+    def patch(self, *args, **kw):
+        patcher = mock.patch(*args, **kw)
+        retval = patcher.start()
+        self.addCleanup(patcher.stop)
+        return retval
+
+    def snapshot(self, date, data):
+        filename = os.path.join(self.datadir, 'du-%s.gz' % date)
+        with gzip.open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def create_snapshots(self):
+        return [
+            self.snapshot('2015-11-01', b'10\t/pond/frogs\n30\t/pond\n'),
+            self.snapshot('2015-11-02', b'15\t/pond/frogs\n5\t/pond/toads\n40\t/pond\n'),
+            self.snapshot('2015-11-03', b'20\t/pond/frogs\n50\t/pond\n'),
+        ]
+
+    def test_update(self):
+        self.history.update(self.create_snapshots())
+        self.assertEqual(self.history.dates(),
+                         ['2015-11-01', '2015-11-02', '2015-11-03'])
+        self.assertEqual(self.history.load_paths(),
+                         [b'/pond', b'/pond/frogs', b'/pond/toads'])
+        self.assertEqual(self.history.load_column('2015-11-01').tolist(),
+                         [30, 10])
+        self.assertEqual(self.history.load_column('2015-11-03').tolist(),
+                         [50, 20, -1])
+
+    def test_update_incremental(self):
+        snapshots = self.create_snapshots()
+        self.history.update(snapshots[:1])
+        self.history.update(snapshots)
+        self.assertEqual(self.history.lookup(b'/pond/toads'), [
+            ('2015-11-01', None),
+            ('2015-11-02', 5),
+            ('2015-11-03', None),
+        ])
+
+    def test_update_nothing_to_do(self):
+        self.history.update([])
+        self.assertFalse(os.path.exists(self.history.dirname))
+
+    def test_update_verbose(self):
+        stdout = self.patch('sys.stdout', StringIO())
+        snapshots = self.create_snapshots()
+        self.history.update(snapshots[:1], verbose=True)
+        self.history.update(snapshots[1:], verbose=True)
+        self.assertEqual(
+            stdout.getvalue().replace(self.datadir, '/du/pond'),
+            "Adding /du/pond/du-2015-11-01.gz to /du/pond/history\n"
+            "Removing 2015-11-01 from /du/pond/history\n"
+            "Compacting /du/pond/history\n"
+            "Adding /du/pond/du-2015-11-02.gz to /du/pond/history\n"
+            "Adding /du/pond/du-2015-11-03.gz to /du/pond/history\n"
+        )
+
+    def test_update_bad_snapshot(self):
+        with open(os.path.join(self.datadir, 'du-2015-11-04.gz'), 'wb') as f:
+            f.write(b'not gzipped')
+        self.history.update(self.create_snapshots() + [f.name])
+        self.assertEqual(self.history.dates(),
+                         ['2015-11-01', '2015-11-02', '2015-11-03'])
+
+    def test_lookup(self):
+        self.history.update(self.create_snapshots())
+        self.assertEqual(self.history.lookup(b'/pond'), [
+            ('2015-11-01', 30),
+            ('2015-11-02', 40),
+            ('2015-11-03', 50),
+        ])
+
+    def test_lookup_unknown_path(self):
+        self.history.update(self.create_snapshots())
+        self.assertIsNone(self.history.lookup(b'/pond/fish'))
+
+    def test_find_path(self):
+        paths = [b'/pond/%03d' % n for n in range(200, 0, -2)]
+        self.history.update([self.snapshot('2015-11-01', b''.join(
+            b'1\t%s\n' % path for path in paths))])
+        self.history.update([self.snapshot('2015-11-02', b'1\t/pond/000\n')]
+                            + [os.path.join(self.datadir, 'du-2015-11-01.gz')])
+        dictionary = self.history.load_paths()
+        for path in paths + [b'/pond/000']:
+            self.assertEqual(dictionary[self.history.find_path(path)], path)
+        for path in [b'/', b'/pond/001', b'/pond/199', b'/pond/201', b'/zoo']:
+            self.assertIsNone(self.history.find_path(path))
+
+    def test_lookup_no_history(self):
+        self.assertIsNone(self.history.lookup(b'/pond'))
+
+    def test_lookup_column_deleted(self):
+        self.history.update(self.create_snapshots())
+        self.patch('pov_server_page.du_history.SizeHistory.dates',
+                   return_value=['2015-10-31', '2015-11-01'])
+        self.assertEqual(self.history.lookup(b'/pond'), [
+            ('2015-10-31', None),
+            ('2015-11-01', 30),
+        ])
+
+    def test_lookup_column_truncated(self):
+        self.history.update(self.create_snapshots())
+        with open(self.history.column_filename('2015-11-01'), 'wb') as f:
+            f.write(b'\0\0\0')
+        self.assertEqual(self.history.lookup(b'/pond')[0], ('2015-11-01', None))
+
+    def test_prune(self):
+        snapshots = self.create_snapshots()
+        self.history.update(snapshots)
+        self.history.update(snapshots[1:])
+        self.assertEqual(self.history.dates(), ['2015-11-02', '2015-11-03'])
+        # /pond/toads only disappeared from the newest snapshot
+        self.assertEqual(self.history.load_paths(),
+                         [b'/pond', b'/pond/frogs', b'/pond/toads'])
+
+    def test_prune_and_compact(self):
+        snapshots = self.create_snapshots()
+        self.history.compact_ratio = 1
+        self.history.update(snapshots)
+        self.history.update(snapshots[2:])
+        self.assertEqual(self.history.dates(), ['2015-11-03'])
+        self.assertEqual(self.history.load_paths(), [b'/pond', b'/pond/frogs'])
+        self.assertEqual(self.history.lookup(b'/pond/frogs'),
+                         [('2015-11-03', 20)])
+        self.assertEqual(sorted(os.listdir(self.datadir)),
+                         ['du-2015-11-01.gz', 'du-2015-11-02.gz',
+                          'du-2015-11-03.gz', 'history'])
+
+    def test_compact_short_columns(self):
+        snapshots = self.create_snapshots()
+        self.history.update(snapshots[:1])
+        self.history.update(snapshots)
+        self.history.compact()
+        # the column of 2015-11-01 predates /pond/toads
+        self.assertEqual(self.history.load_column('2015-11-01').tolist(),
+                         [30, 10, -1])
+
+    def test_compact_verbose(self):
+        stdout = self.patch('sys.stdout', StringIO())
+        self.history.update(self.create_snapshots())
+        self.history.compact(verbose=True)
+        self.assertEqual(stdout.getvalue().replace(self.datadir, '/du/pond'),
+                         "Compacting /du/pond/history\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,520 @@
+import errno
+import gzip
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+import unittest
+
+import mock
+
+from pov_server_page.du_scan import (
+    CHECKPOINT_MAX_AGE,
+    FIND_FORMAT,
+    DirectorySizes,
+    DuScan,
+    IOThrottle,
+    Largest,
+    ScanError,
+    load_metadata,
+    read_io_pressure,
+    snapshot_growth,
+    sorted_exclusive_sizes,
+)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestDuScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.location = os.path.join(self.tmpdir, 'home')
+        for dirname, size in [('alice/photos', 100000), ('alice', 5000),
+                              ('bob', 50000), ('.cache', 0), ('', 3000)]:
+            path = os.path.join(self.location, dirname)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(path, 'data'), 'wb') as f:
+                f.write(b'x' * size)
+        os.symlink('/usr', os.path.join(self.location, 'usr'))
+        self.datadir = os.path.join(self.tmpdir, 'du')
+        os.makedirs(self.datadir)
+        self.output = os.path.join(self.datadir, 'du-2015-11-01.gz')
+        self.scan = DuScan(self.location, self.output)
+
+    def patch(self, *args, **kw):
+        patcher = mock.patch(*args, **kw)
+        retval = patcher.start()
+        self.addCleanup(patcher.stop)
+        return retval
+
+    def read_output(self):
+        with gzip.open(self.output) as f:
+            return sorted(f.read().splitlines())
+
+    def expected_output(self):
+        return sorted(subprocess.check_output(
+            ['du', '-x', self.location]).splitlines())
+
+    def interrupt_after_checkpoints(self, n):
+        real_save_checkpoint = self.scan.save_checkpoint
+
+        def save_checkpoint(checkpoint):
+            real_save_checkpoint(checkpoint)
+            if len(checkpoint['done']) >= n:
+                raise Interrupted()
+
+        self.scan.save_checkpoint = save_checkpoint
+
+    def test_subdirectories(self):
+        self.assertEqual(self.scan.subdirectories(),
+                         ['.cache', 'alice', 'bob'])
+
+    def test_subdirectories_skip_other_filesystems(self):
+        real_lstat = os.lstat
+
+        def lstat(path):
+            st = real_lstat(path)
+            if path.endswith('bob'):
+                return os.stat_result(st[:2] + (st.st_dev + 1, ) + st[3:])
+            return st
+
+        self.patch('os.lstat', lstat)
+        self.assertEqual(self.scan.subdirectories(), ['.cache', 'alice'])
+
+    def test_subdirectories_race(self):
+        real_lstat = os.lstat
+
+        def lstat(path):
+            if path.endswith('bob'):
+                raise OSError(errno.ENOENT, 'No such file or directory')
+            return real_lstat(path)
+
+        self.patch('os.lstat', lstat)
+        self.assertEqual(self.scan.subdirectories(), ['.cache', 'alice'])
+
+    def test_run(self):
+        metadata = self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+        self.assertEqual(sorted(os.listdir(self.datadir)),
+                         ['du-2015-11-01.gz', 'du-2015-11-01.json'])
+        self.assertEqual(load_metadata(self.output), metadata)
+        self.assertEqual(sorted(metadata['throttle']),
+                         ['paused', 'pauses', 'probes', 'probing'])
+
+    def test_run_empty(self):
+        shutil.rmtree(self.location)
+        os.mkdir(self.location)
+        self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+
+    def test_resume(self):
+        self.interrupt_after_checkpoints(2)
+        with self.assertRaises(Interrupted):
+            self.scan.run()
+        self.assertFalse(os.path.exists(self.output))
+        with open(self.scan.checkpoint_file) as f:
+            self.assertEqual(sorted(json.load(f)['done']), ['.cache', 'alice'])
+        scan = DuScan(self.location, self.output)
+        popen = self.patch('subprocess.Popen', side_effect=subprocess.Popen)
+        with mock.patch('sys.stdout') as stdout:
+            scan.run(verbose=True)
+        stdout.write.assert_any_call(
+            'Resuming the scan of %s (2 directories done)' % self.location)
+        self.assertEqual(popen.call_args_list[0][0][0],
+                         ['find', os.path.join(self.location, 'bob'),
+                          '-xdev', '-depth', '-printf', FIND_FORMAT])
+        self.assertEqual(self.read_output(), self.expected_output())
+        self.assertFalse(os.path.exists(scan.checkpoint_file))
+
+    def test_resume_nothing_left(self):
+        self.interrupt_after_checkpoints(3)
+        with self.assertRaises(Interrupted):
+            self.scan.run()
+        DuScan(self.location, self.output).run()
+        self.assertEqual(self.read_output(), self.expected_output())
+
+    def test_top_lists(self):
+        previous = os.path.join(self.datadir, 'du-2015-10-31.gz')
+        with gzip.open(previous, 'wb') as f:
+            f.write(('4\t{0}/alice/photos\n'
+                     '8\t{0}/alice\n'
+                     '12\t{0}\n'.format(self.location)).encode())
+        self.scan.previous = previous
+        self.scan.top = 2
+        metadata = self.scan.run()
+        sizes = dict((path[len(self.location):], size) for size, path in
+                     (line.split(b'\t') for line in
+                      subprocess.check_output(['du', '-x', '-a', '-S',
+                                               self.location]).splitlines()))
+        self.assertEqual(metadata['largest_files'], [
+            [int(sizes[b'/alice/photos/data']), self.location + '/alice/photos/data'],
+            [int(sizes[b'/bob/data']), self.location + '/bob/data'],
+        ])
+        self.assertEqual(metadata['largest_dirs'], [
+            [int(sizes[b'/alice/photos']), self.location + '/alice/photos'],
+            [int(sizes[b'/bob']), self.location + '/bob'],
+        ])
+        self.assertEqual(metadata['fastest_growing'], [
+            [int(sizes[b'/alice/photos']) - 4, self.location + '/alice/photos'],
+            [int(sizes[b'/bob']), self.location + '/bob'],
+        ])
+
+    def test_top_lists_survive_resume(self):
+        self.interrupt_after_checkpoints(2)
+        with self.assertRaises(Interrupted):
+            self.scan.run()
+        metadata = DuScan(self.location, self.output).run()
+        self.assertEqual(metadata['largest_files'][0][1],
+                         self.location + '/alice/photos/data')
+
+    def test_top_level_files(self):
+        self.assertEqual(
+            [path for size, path in self.scan.top_level_files()],
+            [os.fsencode(os.path.join(self.location, name))
+             for name in ['data', 'usr']])
+
+    def test_own_size(self):
+        self.assertEqual(
+            self.scan.own_size(),
+            int(subprocess.check_output(
+                ['du', '-x', '-S', '-s', self.location]).split()[0]))
+
+    def test_empty_directories(self):
+        os.makedirs(os.path.join(self.location, 'bob', 'empty', 'emptier'))
+        os.mkdir(os.path.join(self.location, 'bob', 'also-empty'))
+        lstat = self.patch('os.lstat', side_effect=os.lstat)
+        scandir = self.patch('os.scandir', side_effect=os.scandir)
+        self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+        # only the top-level entries: find does the one and only walk
+        self.assertEqual(
+            [path for (path, ), kw in lstat.call_args_list
+             if os.path.dirname(path) not in (self.tmpdir, self.location)],
+            [])
+        self.assertEqual(scandir.call_count, 0)
+
+    def test_hard_links(self):
+        os.link(os.path.join(self.location, 'bob', 'data'),
+                os.path.join(self.location, 'bob', 'data2'))
+        metadata = self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+        paths = [path for size, path in metadata['largest_files']]
+        self.assertEqual(paths.count(self.location + '/bob/data')
+                         + paths.count(self.location + '/bob/data2'), 1)
+
+    def test_file_name_with_newline(self):
+        with open(os.path.join(self.location, 'bob', 'new\nline'), 'wb') as f:
+            f.write(b'x' * 10000)
+        self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+
+    def test_mount_points(self):
+        real_find = self.scan.find
+        photos = os.path.join(self.location, 'alice', 'photos')
+        listing = os.path.join(self.tmpdir, 'find-output')
+
+        def find(*paths):
+            # pretend alice/photos is another filesystem, which find -xdev
+            # lists but doesn't descend into
+            p = real_find(*paths)
+            with open(listing, 'wb') as f:
+                for line in p.stdout:
+                    fields = line.split(b'\t')
+                    if fields[5] == os.fsencode(photos) + b'\n':
+                        fields[1] = b'-1'
+                    elif fields[5].startswith(os.fsencode(photos) + b'/'):
+                        continue
+                    f.write(b'\t'.join(fields))
+            p.stdout.close()
+            p.wait()
+            shutil.rmtree(photos)
+            return subprocess.Popen(['cat', listing], stdout=subprocess.PIPE)
+
+        self.scan.find = find
+        self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+
+    def test_top_lists_previous_snapshot_corrupted(self):
+        previous = os.path.join(self.datadir, 'du-2015-10-31.gz')
+        with open(previous, 'wb') as f:
+            f.write(b'not gzip')
+        self.scan.previous = previous
+        metadata = self.scan.run()
+        self.assertEqual(metadata['fastest_growing'], [])
+
+    def test_subdirectory_vanished(self):
+        real_subdirectories = self.scan.subdirectories
+        self.scan.subdirectories = lambda: real_subdirectories() + ['carol']
+        self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+
+    def test_find_killed(self):
+        real_find = self.scan.find
+        dev = os.lstat(self.location).st_dev
+
+        def find(*paths):
+            # finish the first directory, then get OOM-killed
+            return subprocess.Popen(
+                ['sh', '-c', 'printf "d\\t%d\\t1\\t2\\t8\\t%s\\n"; kill -9 $$'
+                 % (dev, os.path.join(self.location, '.cache'))],
+                stdout=subprocess.PIPE)
+
+        self.scan.find = find
+        with self.assertRaises(ScanError):
+            self.scan.run()
+        self.assertFalse(os.path.exists(self.output))
+        checkpoint = self.scan.load_checkpoint()
+        self.assertEqual(checkpoint['done'], {'.cache': 4})
+        self.scan.find = real_find
+        self.scan.run()
+        self.assertEqual(self.read_output(), self.expected_output())
+
+    def test_interrupted_while_find_stopped(self):
+        dev = os.lstat(self.location).st_dev
+        children = []
+
+        def find(*paths):
+            # finish the first directory, then get stopped (e.g. by
+            # IOThrottle) just as we die
+            p = subprocess.Popen(
+                ['sh', '-c', 'printf "d\\t%d\\t1\\t2\\t8\\t%s\\n";'
+                 ' kill -STOP $$; exec sleep 60'
+                 % (dev, os.path.join(self.location, '.cache'))],
+                stdout=subprocess.PIPE)
+            children.append(p)
+            return p
+
+        self.scan.find = find
+        self.interrupt_after_checkpoints(1)
+        with self.assertRaises(Interrupted):
+            self.scan.run()
+        self.assertEqual(children[0].returncode, -signal.SIGTERM)
+
+    def test_location_vanished(self):
+        shutil.rmtree(self.location)
+        with self.assertRaises(ScanError):
+            self.scan.run()
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_location_vanished_during_scan(self):
+        self.scan.scan_subdirectories = (
+            lambda *args: shutil.rmtree(self.location))
+        with self.assertRaises(ScanError):
+            self.scan.run()
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_location_vanished_before_find(self):
+        self.scan.subdirectories = lambda: ['bob']
+        shutil.rmtree(self.location)
+        with self.assertRaises(ScanError):
+            self.scan.run()
+
+    def test_load_checkpoint(self):
+        self.interrupt_after_checkpoints(1)
+        with self.assertRaises(Interrupted):
+            self.scan.run()
+        checkpoint = self.scan.load_checkpoint()
+        self.assertEqual(checkpoint['location'], self.location)
+        self.assertEqual(list(checkpoint['done']), ['.cache'])
+        self.assertIsNone(self.scan.load_checkpoint(
+            checkpoint['started'] + CHECKPOINT_MAX_AGE))
+        self.assertIsNone(DuScan(self.tmpdir, self.output).load_checkpoint())
+        with open(self.scan.partial_file, 'r+b') as f:
+            f.truncate(checkpoint['offset'] - 1)
+        self.assertIsNone(self.scan.load_checkpoint())
+
+    def test_load_checkpoint_missing(self):
+        self.assertIsNone(self.scan.load_checkpoint())
+
+    def test_load_checkpoint_corrupted(self):
+        with open(self.scan.partial_file, 'wb'):
+            pass
+        with open(self.scan.checkpoint_file, 'w') as f:
+            f.write('[]')
+        self.assertIsNone(self.scan.load_checkpoint())
+
+    def test_cannot_remove_checkpoint(self):
+        self.patch('os.unlink',
+                   side_effect=OSError(errno.EACCES, 'Permission denied'))
+        with self.assertRaises(OSError):
+            self.scan.run()
+
+
+class TestLargest(unittest.TestCase):
+
+    def test_largest(self):
+        largest = Largest(2, [[5, 'five']])
+        for size, path in [(1, b'one'), (7, b'seven'), (3, b'three'),
+                           (2, b'two'), (6, b'\xff')]:
+            largest.add(size, path)
+        self.assertEqual(largest.items(), [[7, 'seven'], [6, u'\ufffd']])
+
+
+class TestDirectorySizes(unittest.TestCase):
+
+    def test_directory_sizes(self):
+        sizes = DirectorySizes()
+        sizes.add_file(3, b'/home/a/b/file')
+        self.assertEqual(sizes.add_directory(8, b'/home/a/b'), (11, 11))
+        sizes.add_file(5, b'/home/a/file')
+        self.assertEqual(sizes.add_directory(8, b'/home/a/c'), (8, 8))
+        self.assertEqual(sizes.add_directory(8, b'/home/a'), (32, 13))
+
+
+class TestSnapshotGrowth(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.old = os.path.join(self.tmpdir, 'du-2015-10-31.gz')
+        self.new = os.path.join(self.tmpdir, 'du-2015-11-01.gz')
+        with gzip.open(self.old, 'wb') as f:
+            f.write(b'4\t/home/a/b\n'
+                    b'6\t/home/a/c\n'
+                    b'16\t/home/a\n'
+                    b'\n'
+                    b'1\t/home/old\n'
+                    b'21\t/home\n')
+        with gzip.open(self.new, 'wb') as f:
+            f.write(b'2\t/home/new\n'
+                    b'4\t/home/a/c\n'
+                    b'9\t/home/a/b\n'
+                    b'20\t/home/a\n'
+                    b'30\t/home\n')
+
+    def test_sorted_exclusive_sizes(self):
+        self.assertEqual(list(sorted_exclusive_sizes(self.old)), [
+            (b'/home', 4),
+            (b'/home/a', 6),
+            (b'/home/a/b', 4),
+            (b'/home/a/c', 6),
+            (b'/home/old', 1),
+        ])
+
+    def test_sorted_exclusive_sizes_missing(self):
+        with self.assertRaises(IOError):
+            list(sorted_exclusive_sizes(self.old + '.missing'))
+
+    def test_snapshot_growth(self):
+        self.assertEqual(sorted(snapshot_growth(self.old, self.new)), [
+            (1, b'/home/a'),
+            (2, b'/home/new'),
+            (4, b'/home'),
+            (5, b'/home/a/b'),
+        ])
+
+    def test_snapshot_growth_stop_early(self):
+        growth = snapshot_growth(self.old, self.new)
+        next(growth)
+        growth.close()
+
+
+class TestIOPressure(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, 'io')
+
+    def test_read_io_pressure(self):
+        with open(self.filename, 'w') as f:
+            f.write('some avg10=0.00 avg60=0.01 avg300=0.00 total=3063033\n'
+                    'full avg10=0.00 avg60=0.01 avg300=0.00 total=2505889\n')
+        self.assertEqual(read_io_pressure(self.filename), 3063033)
+
+    def test_read_io_pressure_not_supported(self):
+        self.assertIsNone(read_io_pressure(self.filename))
+
+    def test_read_io_pressure_garbage(self):
+        with open(self.filename, 'w') as f:
+            f.write('some total=lots\n')
+        self.assertIsNone(read_io_pressure(self.filename))
+
+    def test_read_io_pressure_no_some_line(self):
+        with open(self.filename, 'w') as f:
+            f.write('\n')
+        self.assertIsNone(read_io_pressure(self.filename))
+
+
+class TestIOThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.signals = []
+        self.stall = 0
+        self.busy_probes = 0
+        self.throttle = IOThrottle(1234, pressure=self.pressure,
+                                   kill=self.kill)
+        self.throttle.probe_time = 0.001
+
+    def pressure(self):
+        if self.busy_probes:
+            self.busy_probes -= 0.5
+            self.stall += 10**6
+        return self.stall
+
+    def kill(self, pid, signum):
+        self.assertEqual(pid, 1234)
+        self.signals.append(signum)
+
+    def test_idle(self):
+        self.throttle.step()
+        self.assertEqual(self.signals, [signal.SIGSTOP, signal.SIGCONT])
+        self.assertEqual(self.throttle.stats['probes'], 1)
+        self.assertEqual(self.throttle.stats['pauses'], 0)
+        self.assertEqual(self.throttle.stats['paused'], 0)
+        self.assertGreater(self.throttle.stats['probing'], 0)
+        self.assertEqual(self.throttle.interval, 2)
+
+    def test_busy(self):
+        self.throttle.interval = 8
+        self.busy_probes = 3
+        self.throttle.step()
+        self.assertEqual(self.signals, [signal.SIGSTOP, signal.SIGCONT])
+        self.assertEqual(self.throttle.stats['probes'], 1)
+        self.assertEqual(self.throttle.stats['pauses'], 1)
+        self.assertEqual(self.busy_probes, 0)
+        self.assertEqual(self.throttle.interval, 4)
+        self.assertGreater(self.throttle.stats['paused'], 0)
+        self.assertGreater(self.throttle.stats['probing'], 0)
+
+    def test_busy_for_too_long(self):
+        self.busy_probes = 3
+        self.throttle.max_pause = 0
+        self.throttle.step()
+        self.assertEqual(self.throttle.stats['pauses'], 1)
+        self.assertEqual(self.busy_probes, 2)
+
+    def test_pressure_unavailable_during_probe(self):
+        self.throttle.pressure = lambda: None
+        self.throttle.step()
+        self.assertEqual(self.throttle.stats['pauses'], 0)
+
+    def test_process_gone(self):
+        def kill(pid, signum):
+            raise OSError(errno.ESRCH, 'No such process')
+        self.throttle.kill = kill
+        self.throttle.step()
+        self.assertTrue(self.throttle.done.is_set())
+
+    def test_no_psi(self):
+        self.throttle.pressure = lambda: None
+        self.throttle.start()
+        self.assertIsNone(self.throttle.thread)
+        self.throttle.stop()
+
+    def test_thread(self):
+        self.throttle.min_interval = self.throttle.interval = 0.001
+        self.throttle.start()
+        while not self.throttle.stats['probes']:
+            time.sleep(0.001)
+        self.throttle.stop()
+        self.assertFalse(self.throttle.thread.is_alive())
+        self.assertEqual(self.signals[-1], signal.SIGCONT)
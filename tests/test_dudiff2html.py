@@ -1,4 +1,5 @@
 import gzip
+import json
 import os
 import shutil
 import tempfile
@@ -54,6 +55,10 @@ class TestFormat(TestCase):
         self.assertEqual(d2h.fmt(1234567890), '+1.3 TB')
         self.assertEqual(d2h.fmt(1234567890000), '+1,264.2 TB')
 
+    def test_fmt_size(self):
+        self.assertEqual(d2h.fmt_size(12345), '12.6 MB')
+        self.assertEqual(d2h.fmt_size(-12345), '-12.6 MB')
+
 
 class TestNotFound(TestCase):
 
@@ -153,6 +158,92 @@ class TestRenderDuDiff(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/plain; charset=UTF-8')
 
 
+class TestSparkline(TestCase):
+
+    def test_empty(self):
+        self.assertEqual(d2h.sparkline([None, None]), [])
+
+    def test_flat(self):
+        self.assertEqual(d2h.sparkline([5], width=100, height=20),
+                         [[(4, 10)]])
+
+    def test_gaps(self):
+        self.assertEqual(
+            d2h.sparkline([10, 20, None, 30], width=38, height=28, margin=4),
+            [[(4, 24), (14, 14)], [(34, 4)]])
+
+
+class TestRenderHistory(TestCase):
+
+    def setUp(self):
+        os.environ.pop('DIRECTORY', None)
+        self.environ = {'SCRIPT_NAME': '/du/history'}
+
+    def create_history(self):
+        tmpdir = self.mkdtemp()
+        os.environ['DIRECTORY'] = tmpdir
+        self.addCleanup(os.environ.pop, 'DIRECTORY', None)
+        datadir = os.path.join(tmpdir, 'root')
+        os.mkdir(datadir)
+        snapshots = []
+        for date, data in [
+            ('2016-02-03', b'42\t/var\xc3\xbf\n'),
+            ('2016-02-04', b''),
+            ('2016-02-05', b'40\t/var\xc3\xbf\n'),
+            ('2016-02-06', b'50\t/var\xc3\xbf\n'),
+        ]:
+            snapshots.append(os.path.join(datadir, 'du-%s.gz' % date))
+            with gzip.open(snapshots[-1], 'wb') as f:
+                f.write(data)
+        d2h.SizeHistory(datadir).update(snapshots)
+
+    def render(self, *args):
+        return d2h.render_history(self.environ, *args)
+
+    def test_bad_location_dots(self):
+        response = self.render('..', '/etc')
+        self.assertEqual(response.status, '404 Not Found')
+
+    def test_bad_location_slashes(self):
+        response = self.render('sub/dir', '/etc')
+        self.assertEqual(response.status, '404 Not Found')
+
+    def test_bad_location_no_such_dir(self):
+        response = self.render('nosuchdir', '/etc')
+        self.assertEqual(response.status, '404 Not Found')
+
+    def test_unknown_path(self):
+        self.create_history()
+        response = self.render('root', '/etc')
+        self.assertEqual(response.status, '404 Not Found')
+
+    def test_json(self):
+        self.create_history()
+        # PATH_INFO is UTF-8 decoded as Latin-1
+        response = self.render('root', '/var\xc3\xbf')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.body), {
+            'location': 'root',
+            'path': u'/var\xff',
+            'dates': ['2016-02-03', '2016-02-04', '2016-02-05', '2016-02-06'],
+            'sizes': [43008, None, 40960, 51200],
+        })
+
+    def test_html(self):
+        self.create_history()
+        response = self.render('root', '/var\xc3\xbf', 'html')
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.headers['Content-Type'], 'text/html; charset=UTF-8')
+        self.assertIn(u'<h1>Disk usage history of /var\xff <small>root</small></h1>',
+                      response.body)
+        self.assertIn('<td>-</td>', response.body)
+        self.assertIn('<td>+10.2 kB</td>', response.body)
+        self.assertIn('<td>-2.0 kB</td>', response.body)
+        self.assertIn('<link rel="stylesheet" href="/du/history/style.css">',
+                      response.body)
+
+
 class TestDispatch(TestCase):
 
     def test_not_found(self):
@@ -182,6 +273,30 @@ class TestDispatch(TestCase):
         self.assertEqual(view, d2h.render_du_diff)
         self.assertEqual(args, (environ, 'dir', '2016-02-03', '2016-02-04', '.txt'))
 
+    def test_history(self):
+        environ = {'PATH_INFO': '/history/root/var/lib/postgresql'}
+        view, args = d2h.dispatch(environ)
+        self.assertEqual(view, d2h.render_history)
+        self.assertEqual(args, (environ, 'root', '/var/lib/postgresql', None))
+
+    def test_history_root(self):
+        environ = {'PATH_INFO': '/history/root/'}
+        view, args = d2h.dispatch(environ)
+        self.assertEqual(view, d2h.render_history)
+        self.assertEqual(args, (environ, 'root', '/', None))
+
+    def test_history_mod_wsgi(self):
+        environ = {'SCRIPT_NAME': '/du/history', 'PATH_INFO': '/root/var',
+                   'QUERY_STRING': 'format=html'}
+        view, args = d2h.dispatch(environ)
+        self.assertEqual(view, d2h.render_history)
+        self.assertEqual(args, (environ, 'root', '/var', 'html'))
+
+    def test_history_stylesheet(self):
+        environ = {'SCRIPT_NAME': '/du/history', 'PATH_INFO': '/style.css'}
+        view, args = d2h.dispatch(environ)
+        self.assertEqual(view, d2h.stylesheet)
+
 
 class TestWsgiApp(TestCase):
 
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import mock
+
+from pov_server_page.host_identity import (
+    CACHE_TTL,
+    HostIdentity,
+    compute_host_identity,
+    get_fqdn,
+    get_host_identity,
+    resolve_fqdn,
+)
+
+
+class TestResolveFqdn(unittest.TestCase):
+
+    def patch_run(self, **kw):
+        patcher = mock.patch('subprocess.run', **kw)
+        run = patcher.start()
+        self.addCleanup(patcher.stop)
+        return run
+
+    def test_resolve_fqdn(self):
+        run = self.patch_run()
+        run.return_value.stdout = 'frog.example.com\n'
+        self.assertEqual(resolve_fqdn(timeout=3), 'frog.example.com')
+        self.assertEqual(run.call_args[0][0], ['hostname', '-f'])
+        self.assertEqual(run.call_args[1]['timeout'], 3)
+
+    def test_resolve_fqdn_broken_ubuntu(self):
+        run = self.patch_run()
+        run.return_value.stdout = 'localhost6.localdomain6\n'
+        self.assertIsNone(resolve_fqdn())
+
+    def test_resolve_fqdn_timeout(self):
+        self.patch_run(side_effect=subprocess.TimeoutExpired('hostname', 5))
+        self.assertIsNone(resolve_fqdn())
+
+    def test_resolve_fqdn_no_hostname_command(self):
+        self.patch_run(side_effect=OSError('no such file or directory'))
+        self.assertIsNone(resolve_fqdn())
+
+
+class TestHostIdentity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_file = os.path.join(self.tmpdir, 'host-identity.json')
+        self.resolve_fqdn = self.patch(
+            'pov_server_page.host_identity.resolve_fqdn',
+            return_value='frog.example.com')
+        self.patch('socket.gethostname', return_value='frog')
+        self.now = 1500000000
+        self.patch('time.time', lambda: self.now)
+
+    def patch(self, *args, **kw):
+        patcher = mock.patch(*args, **kw)
+        retval = patcher.start()
+        self.addCleanup(patcher.stop)
+        return retval
+
+    def test_identity(self):
+        self.assertEqual(compute_host_identity(self.cache_file), HostIdentity(
+            nodename='frog',
+            fqdn='frog.example.com',
+            short_name='frog',
+            collectd_hostname='frog.example.com',
+        ))
+
+    def test_no_cache_file(self):
+        identity = compute_host_identity(None)
+        self.assertEqual(identity.fqdn, 'frog.example.com')
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_cached(self):
+        compute_host_identity(self.cache_file)
+        self.now += CACHE_TTL - 1
+        identity = compute_host_identity(self.cache_file)
+        self.assertEqual(identity.fqdn, 'frog.example.com')
+        self.assertEqual(self.resolve_fqdn.call_count, 1)
+
+    def test_cache_expired(self):
+        compute_host_identity(self.cache_file)
+        self.now += CACHE_TTL
+        compute_host_identity(self.cache_file)
+        self.assertEqual(self.resolve_fqdn.call_count, 2)
+
+    def test_hostname_changed(self):
+        compute_host_identity(self.cache_file)
+        self.patch('socket.gethostname', return_value='toad')
+        self.resolve_fqdn.return_value = 'toad.example.com'
+        identity = compute_host_identity(self.cache_file)
+        self.assertEqual(identity.fqdn, 'toad.example.com')
+
+    def test_hostname_file_changed(self):
+        hosts = os.path.join(self.tmpdir, 'hosts')
+        self.patch('pov_server_page.host_identity.HOSTNAME_FILES', [hosts])
+        compute_host_identity(self.cache_file)
+        with open(hosts, 'w') as f:
+            f.write('127.0.1.1 toad.example.com toad\n')
+        compute_host_identity(self.cache_file)
+        self.assertEqual(self.resolve_fqdn.call_count, 2)
+
+    def test_corrupted_cache(self):
+        with open(self.cache_file, 'w') as f:
+            f.write('{')
+        identity = compute_host_identity(self.cache_file)
+        self.assertEqual(identity.fqdn, 'frog.example.com')
+        with open(self.cache_file) as f:
+            self.assertEqual(json.load(f)['fqdn'], 'frog.example.com')
+
+    def test_cache_not_writable(self):
+        cache_file = os.path.join(self.tmpdir, 'nosuchdir', 'host-identity.json')
+        identity = compute_host_identity(cache_file)
+        self.assertEqual(identity.fqdn, 'frog.example.com')
+
+    def test_dns_down_stale_cache(self):
+        compute_host_identity(self.cache_file)
+        self.now += CACHE_TTL * 10
+        self.resolve_fqdn.return_value = None
+        identity = compute_host_identity(self.cache_file)
+        self.assertEqual(identity.fqdn, 'frog.example.com')
+
+    def test_dns_down_no_cache(self):
+        self.resolve_fqdn.return_value = None
+        identity = compute_host_identity(self.cache_file)
+        self.assertEqual(identity.fqdn, 'frog')
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_get_host_identity_once_per_process(self):
+        cache = {}
+        get_host_identity(self.cache_file, _cache=cache)
+        os.unlink(self.cache_file)
+        identity = get_host_identity(self.cache_file, _cache=cache)
+        self.assertEqual(identity.fqdn, 'frog.example.com')
+        self.assertEqual(self.resolve_fqdn.call_count, 1)
+
+    def test_get_fqdn(self):
+        self.patch('pov_server_page.host_identity.get_host_identity',
+                   return_value=HostIdentity('toad', 'toad.example.com',
+                                             'toad', 'toad.example.com'))
+        self.assertEqual(get_fqdn(), 'toad.example.com')
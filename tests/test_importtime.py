@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import unittest
+
+
+# Seconds; generous, so that slow CI machines don't fail the build, but small
+# enough to catch a DNS lookup or a subprocess at import time.
+IMPORT_TIME_BUDGET = 0.5
+
+
+ENTRY_POINTS = {
+    # module: modules it must not import eagerly
+    'pov_server_page.update_server_page': [
+        'mako',
+        'pov_server_page.disk_inventory',
+        'pov_server_page.inotify',
+        'pov_server_page.machine_summary',
+        'pov_server_page.update_ports_html',
+        'xml.etree.ElementTree',
+    ],
+    'pov_server_page.update_ports_html': ['mako'],
+    'pov_server_page.machine_summary': ['mako'],
+    'pov_server_page.disk_inventory': ['mako', 'xml.etree.ElementTree'],
+    'pov_server_page.changelog2html': [],
+    'pov_server_page.dudiff2html': ['mako'],
+    'pov_server_page.du_diff': ['mako'],
+}
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter with -X importtime.
+
+    Returns a dict mapping module names to cumulative import times in
+    seconds.
+    """
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+    result = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        result[name.strip()] = int(cumulative_us) / 1e6
+    return result
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_entry_points(self):
+        for module, forbidden in sorted(ENTRY_POINTS.items()):
+            with self.subTest(module=module):
+                times = import_times(module)
+                self.assertLess(times[module], IMPORT_TIME_BUDGET)
+                for name in forbidden:
+                    self.assertNotIn(name, times)
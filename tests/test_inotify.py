@@ -0,0 +1,77 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pov_server_page.inotify import (
+    EVENT_HEADER,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_IGNORED,
+    Inotify,
+    check_error,
+    load_libc,
+)
+
+
+class TestInotify(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.inotify = Inotify()
+        self.addCleanup(self.inotify.close)
+
+    def test_events(self):
+        self.inotify.add_watch(self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'motd'), 'w') as f:
+            f.write('hello')
+        events = self.inotify.read(1)
+        self.assertEqual([(e.path, e.name) for e in events],
+                         [(self.tmpdir, 'motd'), (self.tmpdir, 'motd')])
+        self.assertTrue(events[0].mask & IN_CREATE)
+        self.assertTrue(events[1].mask & IN_CLOSE_WRITE)
+
+    def test_timeout(self):
+        self.inotify.add_watch(self.tmpdir)
+        self.assertEqual(self.inotify.read(0), [])
+
+    def test_spurious_wakeup(self):
+        self.inotify.add_watch(self.tmpdir)
+        with mock.patch('select.select', return_value=([self.inotify], [], [])):
+            self.assertEqual(self.inotify.read(0), [])
+
+    def test_add_watch_error(self):
+        with self.assertRaises(OSError) as ctx:
+            self.inotify.add_watch(os.path.join(self.tmpdir, 'nosuchdir'))
+        self.assertEqual(ctx.exception.errno, errno.ENOENT)
+
+    def test_watch_removed(self):
+        wd = self.inotify.add_watch(self.tmpdir)
+        data = EVENT_HEADER.pack(wd, IN_IGNORED, 0, 0)
+        self.assertEqual(list(self.inotify.parse_events(data)), [])
+        self.assertEqual(self.inotify.watches, {})
+
+    def test_context_manager(self):
+        with Inotify() as inotify:
+            self.assertIsNotNone(inotify.fileno())
+        self.assertIsNone(inotify.fileno())
+        inotify.close()
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_check_error(self):
+        self.assertEqual(check_error(3), 3)
+        with mock.patch('ctypes.get_errno', return_value=errno.EMFILE):
+            with self.assertRaises(OSError) as ctx:
+                check_error(-1)
+        self.assertEqual(ctx.exception.errno, errno.EMFILE)
+
+    def test_load_libc_no_inotify(self):
+        with mock.patch('ctypes.CDLL', return_value=object()):
+            with self.assertRaises(OSError):
+                load_libc(_cache={})
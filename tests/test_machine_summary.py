@@ -1,9 +1,16 @@
 from __future__ import print_function
 
+import errno
 import os
+import shutil
+import socket
+import struct
+import tempfile
 import textwrap
 import unittest
 
+import mock
+
 import pov_server_page.machine_summary as ms
 from . import PatchMixin, NativeStringIO
 
@@ -58,14 +65,10 @@ class TestCase(PatchMixin, unittest.TestCase):
 class TestHostname(TestCase):
 
     def test(self):
-        self.patch('socket.getfqdn', lambda: 'example.com')
+        self.patch('pov_server_page.machine_summary.get_fqdn',
+                   lambda: 'example.com')
         self.assertEqual(ms.get_hostname(), 'example.com')
 
-    def test_broken_ubuntu(self):
-        self.patch('socket.getfqdn', lambda: 'localhost6.localdomain6')
-        self.patch('socket.gethostname', lambda: 'example')
-        self.assertEqual(ms.get_hostname(), 'example')
-
 
 class TestGetRamInfo(TestCase):
 
@@ -114,6 +117,137 @@ class TestGetDiskInfo(TestCase):
         self.assertEqual(ms.get_disk_info('sda'), '500.1 GB')
 
 
+class TestHardwareFacts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_file = os.path.join(self.tmpdir, 'hardware-facts.json')
+        self.key = ['boot-1', ['sda']]
+        patcher = mock.patch.object(ms.HardwareFacts, 'cache_key',
+                                    staticmethod(lambda: self.key))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.computed = []
+
+    def get_disk_model(self, device):
+        self.computed.append(device)
+        return 'model Samsung SSD 850'
+
+    def lookup(self, cache_file=None):
+        facts = ms.HardwareFacts(cache_file or self.cache_file)
+        result = facts.get(self.get_disk_model, 'sda')
+        facts.save()
+        return result
+
+    def test_cached(self):
+        self.assertEqual(self.lookup(), 'model Samsung SSD 850')
+        self.assertEqual(self.lookup(), 'model Samsung SSD 850')
+        self.assertEqual(self.computed, ['sda'])
+
+    def test_reboot(self):
+        self.lookup()
+        self.key = ['boot-2', ['sda']]
+        self.lookup()
+        self.assertEqual(self.computed, ['sda', 'sda'])
+
+    def test_hotplug(self):
+        self.lookup()
+        self.key = ['boot-1', ['sda', 'sdb']]
+        self.lookup()
+        self.assertEqual(self.computed, ['sda', 'sda'])
+
+    def test_no_boot_id(self):
+        self.key = None
+        self.lookup()
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_corrupted_cache(self):
+        with open(self.cache_file, 'w') as f:
+            f.write('{')
+        self.assertEqual(self.lookup(), 'model Samsung SSD 850')
+        self.assertEqual(self.lookup(), 'model Samsung SSD 850')
+        self.assertEqual(self.computed, ['sda'])
+
+    def test_cache_not_writable(self):
+        cache_file = os.path.join(self.tmpdir, 'nosuchdir', 'hardware-facts.json')
+        self.assertEqual(self.lookup(cache_file), 'model Samsung SSD 850')
+
+    def test_get_summary(self):
+        cpu_lookups = []
+
+        def get_cpu_info():
+            cpu_lookups.append(1)
+            return '2 × Intel(R) Core(TM)2 Duo CPU'
+
+        with mock.patch.object(ms, 'get_cpu_info', get_cpu_info):
+            self.assertEqual(ms.get_summary(self.cache_file).cpu,
+                             '2 × Intel(R) Core(TM)2 Duo CPU')
+            self.assertEqual(ms.fingerprint(self.cache_file)[0],
+                             '2 × Intel(R) Core(TM)2 Duo CPU')
+        self.assertEqual(len(cpu_lookups), 1)
+
+
+class TestHardwareCacheKey(TestCase):
+
+    def test(self):
+        self.patch_files({
+            '/proc/sys/kernel/random/boot_id': '0b0e1f2a-0000-4000-8000-000000000000\n',
+            '/sys/block/sda/size': '976773168\n',
+            '/sys/class/net/eth0/address': '52:54:00:12:34:56\n',
+        })
+        self.assertEqual(ms.HardwareFacts.cache_key(), [
+            '0b0e1f2a-0000-4000-8000-000000000000', ['sda'],
+        ])
+
+    def test_no_sys_block(self):
+        self.patch_files({
+            '/proc/sys/kernel/random/boot_id': '0b0e1f2a-0000-4000-8000-000000000000\n',
+        })
+        self.assertEqual(ms.HardwareFacts.cache_key(), [
+            '0b0e1f2a-0000-4000-8000-000000000000', [],
+        ])
+
+    def test_no_boot_id(self):
+        self.patch_files({})
+        self.assertIsNone(ms.HardwareFacts.cache_key())
+
+
+class TestNetworkDevices(TestCase):
+
+    def test(self):
+        self.patch_files({
+            '/sys/class/net/eth0/address': '52:54:00:12:34:56\n',
+            '/sys/class/net/eth0.42/address': '52:54:00:12:34:56\n',
+            '/sys/class/net/br0/address': '52:54:00:12:34:57\n',
+            '/sys/class/net/lo/address': '00:00:00:00:00:00\n',
+            '/sys/class/net/wg0/address': '\n',
+        })
+        self.assertEqual(ms.get_network_devices(), [
+            ('eth0', 'MAC: 52:54:00:12:34:56'),
+            ('wg0', None),
+        ])
+
+    def test_cached_per_interface(self):
+        self.patch_files({
+            '/sys/class/net/eth0/address': '52:54:00:12:34:56\n',
+            '/sys/class/net/veth1/address': '52:54:00:12:34:58\n',
+        })
+        hardware = ms.HardwareFacts(None)
+        hardware.facts['get_netdev_info:eth0'] = 'MAC: cached'
+        hardware.facts['get_netdev_info:veth0'] = 'MAC: gone'
+        hardware.facts['get_cpu_info'] = 'Z80'
+        self.assertEqual(ms.get_network_devices(hardware), [
+            ('eth0', 'MAC: cached'),
+            ('veth1', 'MAC: 52:54:00:12:34:58'),
+        ])
+        self.assertEqual(hardware.facts, {
+            'get_cpu_info': 'Z80',
+            'get_netdev_info:eth0': 'MAC: cached',
+            'get_netdev_info:veth1': 'MAC: 52:54:00:12:34:58',
+        })
+
+
 class TestEnumerateDisks(TestCase):
 
     def test_no_sys_block(self):
@@ -156,6 +290,211 @@ class TestIpAddresses(TestCase):
         ])
 
 
+def nlmsg(msgtype, payload, seq=1):
+    msg = struct.pack('=IHHII', 16 + len(payload), msgtype, 2, seq, 0) + payload
+    return msg + b'\0' * (-len(msg) % 4)
+
+
+def rtattr(rta_type, value):
+    attr = struct.pack('=HH', 4 + len(value), rta_type) + value
+    return attr + b'\0' * (-len(attr) % 4)
+
+
+def link_msg(index, name, mac=None):
+    payload = struct.pack('=BxHiII', socket.AF_UNSPEC, 1, index, 0, 0)
+    # the kernel sends lots of attributes we don't care about
+    payload += rtattr(4, struct.pack('=I', 1500))  # IFLA_MTU
+    payload += rtattr(3, name.encode() + b'\0')  # IFLA_IFNAME
+    if mac:
+        payload += rtattr(1, bytes(bytearray(int(b, 16) for b in mac.split(':'))))
+    return nlmsg(16, payload)
+
+
+def addr_msg(index, family, ip, scope=0, peer=None):
+    payload = struct.pack('=BBBBi', family, 24, 0, scope, index)
+    packed = socket.inet_pton(family, ip)
+    if peer:
+        payload += rtattr(1, socket.inet_pton(family, peer))  # IFA_ADDRESS
+        payload += rtattr(2, packed)  # IFA_LOCAL
+    else:
+        payload += rtattr(1, packed)  # IFA_ADDRESS
+    return nlmsg(20, payload)
+
+
+NLMSG_DONE = nlmsg(3, struct.pack('=i', 0))
+
+
+def nlmsg_error(errno):
+    return nlmsg(2, struct.pack('=i', -errno) + b'\0' * 16)
+
+
+class FakeNetlinkSocket(object):
+
+    def __init__(self, responses):
+        # responses: {msgtype: [chunk, ...]}
+        self.responses = responses
+        self.pending = []
+        self.closed = False
+
+    def sendto(self, data, address):
+        assert address == (0, 0)
+        length, msgtype, flags, seq, pid = struct.unpack_from('=IHHII', data)
+        assert length == len(data)
+        self.pending = list(self.responses.get(msgtype, [NLMSG_DONE]))
+
+    def recv(self, bufsize):
+        return self.pending.pop(0) if self.pending else b''
+
+    def close(self):
+        self.closed = True
+
+
+class TestNetlink(TestCase):
+
+    def setUp(self):
+        self.responses = {
+            18: [  # RTM_GETLINK
+                link_msg(1, 'lo', '00:00:00:00:00:00') +
+                link_msg(2, 'eth0', 'd4:ae:52:c8:70:d5'),
+                link_msg(3, 'eth1', 'd4:ae:52:c8:70:d6') +
+                link_msg(4, 'eth1.42', 'd4:ae:52:c8:70:d6') +
+                link_msg(5, 'br0', 'd4:ae:52:c8:70:d7') +
+                link_msg(6, 'docker0', '02:42:ac:11:00:01') +
+                link_msg(7, 'wg0') +
+                nlmsg(1, b'') +  # NLMSG_NOOP
+                NLMSG_DONE,
+            ],
+            22: [  # RTM_GETADDR
+                addr_msg(1, socket.AF_INET, '127.0.0.1', scope=254) +
+                addr_msg(2, socket.AF_INET, '151.236.45.231',
+                         peer='151.236.45.193') +
+                addr_msg(6, socket.AF_INET, '172.17.0.1') +
+                addr_msg(7, socket.AF_INET, '10.0.0.1') +
+                addr_msg(1, socket.AF_INET6, '::1', scope=254) +
+                addr_msg(2, socket.AF_INET6, '2a02:af8:6:1200::1:2586') +
+                addr_msg(2, socket.AF_INET6, 'fe80::d6ae:52ff:fec8:70d5',
+                         scope=253) +
+                nlmsg(1, b'') +  # NLMSG_NOOP
+                NLMSG_DONE,
+            ],
+        }
+        self.sock = FakeNetlinkSocket(self.responses)
+        self.patch('socket.socket', lambda *args: self.sock)
+
+    def test_netlink_interfaces(self):
+        links, addresses = ms.netlink_interfaces()
+        self.assertEqual(links[:2], [
+            (1, 'lo', '00:00:00:00:00:00'),
+            (2, 'eth0', 'd4:ae:52:c8:70:d5'),
+        ])
+        self.assertEqual(links[-1], (7, 'wg0', ''))
+        self.assertEqual(addresses, [
+            ('151.236.45.231', 'eth0'),
+            ('2a02:af8:6:1200::1:2586', 'eth0'),
+            ('10.0.0.1', 'wg0'),
+        ])
+        self.assertTrue(self.sock.closed)
+
+    def test_get_interfaces(self):
+        self.assertEqual(ms.get_interfaces(), ([
+            ('eth0', 'MAC: d4:ae:52:c8:70:d5'),
+            ('eth1', 'MAC: d4:ae:52:c8:70:d6'),
+            ('wg0', None),
+        ], [
+            ('151.236.45.231', 'eth0'),
+            ('2a02:af8:6:1200::1:2586', 'eth0'),
+            ('10.0.0.1', 'wg0'),
+        ]))
+
+    def test_error(self):
+        self.responses[22] = [nlmsg_error(errno.EPERM)]
+        with self.assertRaises(OSError):
+            ms.netlink_interfaces()
+        self.assertTrue(self.sock.closed)
+
+    def test_connection_closed(self):
+        self.responses[22] = []
+        self.assertEqual(ms.netlink_interfaces()[1], [])
+
+    def test_truncated_attribute(self):
+        message = struct.pack('=BxHiII', socket.AF_UNSPEC, 1, 9, 0, 0)
+        message += struct.pack('=HH', 2, 3)
+        self.assertEqual(ms.parse_rtattrs(message, 16, (3, )), {})
+
+    def test_truncated_message(self):
+        self.responses[22] = [nlmsg(20, b'\0\0') + NLMSG_DONE]
+        with self.assertRaises(OSError):
+            ms.netlink_interfaces()
+
+    def test_no_af_netlink(self):
+        self.patch('socket.AF_NETLINK', None)
+        with self.assertRaises(OSError):
+            ms.netlink_interfaces()
+
+    def test_fallback(self):
+        for reply in [
+            nlmsg_error(errno.EPERM),
+            struct.pack('=IHHII', 0, 16, 2, 1, 0),  # malformed
+            nlmsg(16, b'\0\0') + NLMSG_DONE,  # truncated
+        ]:
+            with self.subTest(reply=reply):
+                self.responses[18] = [reply]
+                self.check_fallback()
+
+    def check_fallback(self):
+        self.patch_files({
+            '/sys/class/net/eth0/address': 'd4:ae:52:c8:70:d5\n',
+        })
+        self.patch('os.popen', lambda cmd: NativeStringIO(textwrap.dedent('''\
+            2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc mq state UP group default qlen 1000
+                link/ether d4:ae:52:c8:70:d5 brd ff:ff:ff:ff:ff:ff
+                inet 151.236.45.231 peer 151.236.45.193/32 brd 151.236.45.231 scope global eth0
+                   valid_lft forever preferred_lft forever
+        ''')))
+        self.assertEqual(ms.get_interfaces(), (
+            [('eth0', 'MAC: d4:ae:52:c8:70:d5')],
+            [('151.236.45.231', 'eth0')],
+        ))
+
+
+class TestLocalAddresses(TestCase):
+
+    def test(self):
+        self.patch_files({
+            '/proc/net/fib_trie': textwrap.dedent('''\
+                Main:
+                  +-- 0.0.0.0/0 3 0 5
+                     |-- 0.0.0.0
+                        /0 universe UNICAST
+                     +-- 127.0.0.0/8 2 0 2
+                        +-- 127.0.0.0/31 1 0 0
+                           |-- 127.0.0.0
+                              /8 host LOCAL
+                           |-- 127.0.0.1
+                              /32 host LOCAL
+                     |-- 151.236.45.231
+                        /32 host LOCAL
+                Local:
+                     |-- 151.236.45.231
+                        /32 host LOCAL
+            '''),
+            '/proc/net/if_inet6': textwrap.dedent('''\
+                00000000000000000000000000000001 01 80 10 80       lo
+                2a020af8000612000000000000012586 02 80 00 80     eth0
+            '''),
+        })
+        self.assertEqual(ms.get_local_addresses(), [
+            '00000000000000000000000000000001 lo',
+            '127.0.0.1',
+            '151.236.45.231',
+            '2a020af8000612000000000000012586 eth0',
+        ])
+
+    def test_no_proc(self):
+        self.patch_files({})
+        self.assertEqual(ms.get_local_addresses(), [])
+
+
 class TestOsInfo(TestCase):
 
     def test_lsb(self):
@@ -186,6 +525,28 @@ class TestReport(TestCase):
     def test(self):
         ms.report(print=[].append)
 
+    def test_with_summary(self):
+        summary = ms.Summary(
+            cpu='2 × Intel(R) Core(TM)2 Duo CPU', ram='4 GiB',
+            disks=[('sda', '500 GB (model Samsung SSD 850)')],
+            network_devices=[('eth0', 'MAC: 52:54:00:12:34:56')],
+            ip_addresses=[('192.0.2.1', 'eth0')],
+            os='Ubuntu 20.04 LTS', architecture='x86_64')
+        self.assertEqual(ms.report_text(title=False, summary=summary), '\n'.join([
+            ':CPU: 2 × Intel(R) Core(TM)2 Duo CPU',
+            ':RAM: 4 GiB',
+            ':Disks: sda - 500 GB (model Samsung SSD 850)',
+            ':Network: eth0 - MAC: 52:54:00:12:34:56',
+            ':IP: 192.0.2.1 (eth0)',
+            ':OS: Ubuntu 20.04 LTS (x86_64)',
+        ]))
+
+
+class TestFingerprint(TestCase):
+
+    def test(self):
+        self.assertEqual(ms.fingerprint(), ms.fingerprint())
+
 
 class TestMain(TestCase):
 
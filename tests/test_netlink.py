@@ -0,0 +1,93 @@
+import errno
+import socket
+import struct
+import unittest
+
+import mock
+
+from pov_server_page.netlink import (
+    NLMSGERR,
+    netlink_dump,
+    netlink_socket,
+    unpack_payload,
+)
+
+
+def nlmsg(msgtype, payload, seq=1):
+    msg = struct.pack('=IHHII', 16 + len(payload), msgtype, 2, seq, 0) + payload
+    return msg + b'\0' * (-len(msg) % 4)
+
+
+NLMSG_DONE = nlmsg(3, struct.pack('=i', 0))
+
+
+class FakeNetlinkSocket(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+    def recv(self, bufsize):
+        return self.responses.pop(0) if self.responses else b''
+
+
+class TestNetlink(unittest.TestCase):
+
+    def dump(self, *responses):
+        sock = FakeNetlinkSocket(list(responses))
+        return list(netlink_dump(sock, 42, b'request', seq=7))
+
+    def test_request(self):
+        sock = FakeNetlinkSocket([NLMSG_DONE])
+        list(netlink_dump(sock, 42, b'request', seq=7))
+        self.assertEqual(sock.sent, [
+            (struct.pack('=IHHII', 23, 42, 0x301, 7, 0) + b'request',
+             (0, 0)),
+        ])
+
+    def test_dump(self):
+        self.assertEqual(
+            self.dump(nlmsg(16, b'one') + nlmsg(16, b'two'),
+                      nlmsg(1, b'') + NLMSG_DONE,
+                      nlmsg(16, b'ignored')),
+            [(16, b'one'), (16, b'two'), (1, b'')])
+
+    def test_connection_closed(self):
+        self.assertEqual(self.dump(nlmsg(16, b'one')), [(16, b'one')])
+
+    def test_error(self):
+        with self.assertRaises(OSError) as ctx:
+            self.dump(nlmsg(2, struct.pack('=i', -errno.EPERM) + b'\0' * 16))
+        self.assertEqual(ctx.exception.errno, errno.EPERM)
+
+    def test_malformed(self):
+        for reply in [
+            struct.pack('=IHHII', 0, 16, 2, 1, 0),  # would loop forever
+            nlmsg(16, b'one')[:-4],  # cut short
+            nlmsg(2, b''),  # truncated error
+        ]:
+            with self.assertRaises(OSError) as ctx:
+                self.dump(reply)
+            self.assertEqual(ctx.exception.errno, errno.EBADMSG)
+
+    def test_unpack_payload(self):
+        self.assertEqual(unpack_payload(NLMSGERR, b'\1\0\0\0\0'), (1, ))
+        with self.assertRaises(OSError):
+            unpack_payload(NLMSGERR, b'\1\0')
+
+    def test_netlink_socket(self):
+        with mock.patch('socket.socket') as sock:
+            self.assertIs(netlink_socket(0), sock.return_value)
+        sock.assert_called_once_with(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+
+    def test_no_af_netlink(self):
+        with mock.patch('socket.AF_NETLINK', create=True, new=None):
+            with self.assertRaises(OSError):
+                netlink_socket(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
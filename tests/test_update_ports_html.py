@@ -1,7 +1,13 @@
+import errno
 import getpass
 import os
+import shutil
+import socket
+import struct
 import sys
+import tempfile
 import textwrap
+import time
 import unittest
 from contextlib import closing
 from io import BytesIO, TextIOWrapper
@@ -9,18 +15,34 @@ from io import BytesIO, TextIOWrapper
 import mock
 
 from pov_server_page.update_ports_html import (
+    DataSource,
     NetStatTuple,
+    ProcessTable,
+    SourceStats,
+    decode_proc_net_address,
+    find_socket_owners,
+    fingerprint,
     format_arg,
+    format_stats,
     get_argv,
     get_html_cmdline,
     get_owner,
     get_port_mapping,
     get_program,
     main,
+    listening_sockets,
+    netlink_sockets,
     netstat,
     parse_services,
+    pipe,
+    proc_net_sockets,
+    read_proc_net,
+    render_html,
     render_row,
+    render_warnings,
     rpcinfo_dump,
+    run_sources,
+    sock_diag_dump,
     systemctl_list_sockets,
     username,
     wireguard_ports,
@@ -169,6 +191,74 @@ DEFAULT_COMMANDS = {
 }
 
 
+PROC_NET_SAMPLES = {
+    'tcp': (
+        "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+        "   0: 00000000:006F 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 15163 1 0000000000000000 100 0 0 10 0\n"
+        "   1: 0100007F:0019 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 21402 1 0000000000000000 100 0 0 10 0\n"
+        "   2: 0100007F:1E61 281E140A:9EB2 01 00000000:00000000 00:00000000 00000000  1000        0 77701 1 0000000000000000 20 4 30 10 -1\n"
+        "   3: 0100007F:1F40 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 30000 1 0000000000000000 100 0 0 10 0\n"
+    ),
+    'tcp6': (
+        "  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+        "   0: 00000000000000000000000000000000:0050 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 19955 1 0000000000000000 100 0 0 10 0\n"
+        "   1: 00000000000000000000000001000000:0277 00000000000000000000000000000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 18806 1 0000000000000000 100 0 0 10 0\n"
+    ),
+    'udp': (
+        "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops\n"
+        "  100: 0100007F:007B 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 16942 2 0000000000000000 0\n"
+        "  101: 0100007F:A5F1 0100007F:0035 01 00000000:00000000 00:00000000 00000000  1000        0 77777 2 0000000000000000 0\n"
+    ),
+    # no udp6 file: IPv6 disabled
+}
+
+
+def nlmsg(msgtype, payload, seq=1):
+    msg = struct.pack('=IHHII', 16 + len(payload), msgtype, 2, seq, 0) + payload
+    return msg + b'\0' * (-len(msg) % 4)
+
+
+def sock_diag_msg(family, sport, dport=0, ip='0.0.0.0', uid=0, inode=0,
+                  state=10):
+    src = socket.inet_pton(family, ip).ljust(16, b'\0')
+    payload = struct.pack('=BBBB', family, state, 0, 0)
+    payload += struct.pack('!HH', sport, dport) + src + b'\0' * 16
+    payload += b'\0' * 12 + struct.pack('=5I', 0, 0, 0, uid, inode)
+    # the kernel appends some attributes, which we ignore
+    payload += struct.pack('=HHI', 8, 4, 0)
+    return nlmsg(20, payload)
+
+
+NLMSG_DONE = nlmsg(3, struct.pack('=i', 0))
+
+
+def nlmsg_error(errno):
+    return nlmsg(2, struct.pack('=i', -errno) + b'\0' * 16)
+
+
+class FakeNetlinkSocket(object):
+
+    def __init__(self, responses):
+        # responses: {(family, ipproto): [chunk, ...]}
+        self.responses = responses
+        self.pending = []
+        self.closed = False
+
+    def sendto(self, data, address):
+        assert address == (0, 0)
+        length, msgtype, flags, seq, pid = struct.unpack_from('=IHHII', data)
+        assert length == len(data)
+        assert msgtype == 20
+        family, ipproto, ext, pad, states = struct.unpack_from('=BBBBI', data, 16)
+        self.pending = list(self.responses.get((family, ipproto), [NLMSG_DONE]))
+
+    def recv(self, bufsize):
+        return self.pending.pop(0) if self.pending else b''
+
+    def close(self):
+        self.closed = True
+
+
 SERVICES = """\
 # Network services, Internet style
 
@@ -204,6 +294,15 @@ def fake_open(filename, mode='r'):
         if bytes is not str and mode != 'rb':
             f = TextIOWrapper(f, encoding='UTF-8')
         return f
+    elif filename.startswith('/proc/') and filename.endswith('/comm'):
+        pid = int(filename[len('/proc/'):-len('/comm')])
+        if pid == 2:
+            return StringIO('kthreadd\n')
+        try:
+            argv0 = CMDLINES[pid].split(b'\0')[0].decode('UTF-8')
+        except KeyError:
+            raise IOError('no such file ekcetera')
+        return StringIO(argv0.rpartition('/')[-1][:15] + '\n')
     elif filename == '/etc/services':
         return closing(StringIO(SERVICES))
     else:
@@ -241,6 +340,241 @@ class TestNetstat(MockMixin, unittest.TestCase):
         self.assertEqual(list(netstat()), [])
 
 
+class FakeProcMixin(object):
+
+    def make_fake_proc(self, net=PROC_NET_SAMPLES, fds=None, comms=None):
+        proc = tempfile.mkdtemp(prefix='update-ports-test-')
+        self.addCleanup(shutil.rmtree, proc)
+        os.mkdir(os.path.join(proc, 'net'))
+        for name, contents in net.items():
+            with open(os.path.join(proc, 'net', name), 'w') as f:
+                f.write(contents)
+        for pid, targets in (fds or {}).items():
+            fddir = os.path.join(proc, str(pid), 'fd')
+            os.makedirs(fddir)
+            for fd, target in enumerate(targets):
+                os.symlink(target, os.path.join(fddir, str(fd)))
+        for pid, comm in (comms or {}).items():
+            with open(os.path.join(proc, str(pid), 'comm'), 'w') as f:
+                f.write(comm + '\n')
+        return proc
+
+
+class TestProcNet(FakeProcMixin, MockMixin, unittest.TestCase):
+
+    def test_decode_proc_net_address(self):
+        self.assertEqual(decode_proc_net_address('0100007F:0019'),
+                         ('127.0.0.1', 25))
+        self.assertEqual(decode_proc_net_address(
+            '00000000000000000000000001000000:0277'), ('::1', 631))
+        self.assertEqual(decode_proc_net_address(
+            '0000000000000000FFFF00000100007F:0050'), ('::ffff:127.0.0.1', 80))
+
+    def test_read_proc_net_tcp(self):
+        proc = self.make_fake_proc()
+        self.assertEqual([(s.ip, s.port, s.inode)
+                          for s in read_proc_net('tcp', proc)], [
+            ('0.0.0.0', 111, 15163),
+            ('127.0.0.1', 25, 21402),
+            ('127.0.0.1', 8000, 30000),
+        ])
+
+    def test_read_proc_net_udp(self):
+        proc = self.make_fake_proc()
+        self.assertEqual([(s.ip, s.port, s.inode)
+                          for s in read_proc_net('udp', proc)], [
+            ('127.0.0.1', 123, 16942),
+        ])
+
+    def test_read_proc_net_missing(self):
+        proc = self.make_fake_proc()
+        self.assertEqual(list(read_proc_net('udp6', proc)), [])
+
+    def test_read_proc_net_failure_handling(self):
+        proc = self.make_fake_proc(net={
+            'tcp': (
+                "  sl  local_address rem_address   st\n"
+                "   0: 00000000:006F 00000000:0000\n"
+                "   1: 00000000:xyzzy 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 15163\n"
+            ),
+        })
+        with self.assertLogs('pov_server_page.update_ports_html') as cm:
+            self.assertEqual(list(read_proc_net('tcp', proc)), [])
+        self.assertIn('Failed to parse', cm.output[0])
+
+    def test_find_socket_owners(self):
+        proc = self.make_fake_proc(fds={
+            1: ['/dev/null', 'socket:[30000]'],
+            540: ['socket:[15163]', 'socket:[99999]'],
+            541: ['socket:[15163]'],
+            600: ['pipe:[1234]'],
+        })
+        os.mkdir(os.path.join(proc, '700'))  # process with no fd access
+        self.assertEqual(find_socket_owners([15163, 30000, 21402, 0], proc),
+                         {15163: 540, 30000: 1})
+
+    def test_find_socket_owners_stops_early(self):
+        proc = self.make_fake_proc(fds={
+            540: ['socket:[15163]', 'socket:[15164]'],
+            541: ['socket:[15165]'],
+        })
+        listdir = self.patch('os.listdir', side_effect=os.listdir)
+        self.assertEqual(find_socket_owners([15163], proc), {15163: 540})
+        self.assertEqual(listdir.call_count, 2)
+
+    def test_find_socket_owners_no_proc(self):
+        self.assertEqual(find_socket_owners([1], '/nonexistent'), {})
+
+    def test_find_socket_owners_vanishing_fds(self):
+        proc = self.make_fake_proc(fds={540: ['socket:[15163]']})
+        self.patch('os.readlink', side_effect=OSError(2, 'No such file'))
+        self.assertEqual(find_socket_owners([15163], proc), {})
+
+    def test_proc_net_sockets(self):
+        proc = self.make_fake_proc(
+            fds={
+                1: ['socket:[30000]'],
+                540: ['socket:[15163]'],
+                541: ['socket:[16942]'],
+                824: ['socket:[19955]', 'socket:[18806]'],
+            },
+            comms={1: 'systemd', 540: 'rpcbind', 824: 'apache2'},
+        )
+        self.assertEqual(list(proc_net_sockets(proc)), [
+            NetStatTuple('tcp', '0.0.0.0', 111, 540, 'rpcbind', 0),
+            NetStatTuple('tcp', '127.0.0.1', 25, None, '-', 0),
+            NetStatTuple('tcp', '127.0.0.1', 8000, 1, 'systemd', 0),
+            NetStatTuple('tcp6', '::', 80, 824, 'apache2', 0),
+            NetStatTuple('tcp6', '::1', 631, 824, 'apache2', 0),
+            NetStatTuple('udp', '127.0.0.1', 123, 541, '-', 0),
+        ])
+
+    def test_listening_sockets_prefers_proc(self):
+        proc = self.make_fake_proc()
+        self.patch('pov_server_page.update_ports_html.PROC', proc)
+        self.patch('pov_server_page.update_ports_html.netlink_sockets',
+                   side_effect=OSError(errno.EPERM, 'Not allowed'))
+        self.patch('subprocess.Popen', FakePopen({}))
+        self.assertEqual(len(list(listening_sockets())), 6)
+
+    def test_listening_sockets_falls_back_to_netstat(self):
+        self.patch('pov_server_page.update_ports_html.PROC', '/nonexistent')
+        self.patch('pov_server_page.update_ports_html.netlink_sockets',
+                   side_effect=OSError(errno.EPERM, 'Not allowed'))
+        self.patch('subprocess.Popen', FakePopen())
+        self.assertEqual(list(listening_sockets())[0],
+                         NetStatTuple('tcp', '0.0.0.0', 111, 540, 'rpcbind'))
+
+
+class TestNetlink(FakeProcMixin, MockMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.responses = {
+            (socket.AF_INET, socket.IPPROTO_TCP): [
+                sock_diag_msg(socket.AF_INET, 111, inode=15163) +
+                sock_diag_msg(socket.AF_INET, 25, ip='127.0.0.1', uid=106,
+                              inode=21402),
+                nlmsg(1, b'') +  # NLMSG_NOOP
+                NLMSG_DONE,
+            ],
+            (socket.AF_INET6, socket.IPPROTO_TCP): [
+                sock_diag_msg(socket.AF_INET6, 80, ip='::', inode=19955) +
+                NLMSG_DONE,
+            ],
+            (socket.AF_INET, socket.IPPROTO_UDP): [
+                sock_diag_msg(socket.AF_INET, 123, ip='127.0.0.1', inode=16942,
+                              state=7) +
+                sock_diag_msg(socket.AF_INET, 42481, dport=53, ip='127.0.0.1',
+                              inode=77777, state=7) +
+                NLMSG_DONE,
+            ],
+            (socket.AF_INET6, socket.IPPROTO_UDP): [
+                nlmsg_error(errno.ENOENT),
+            ],
+        }
+        self.sock = FakeNetlinkSocket(self.responses)
+        self.patch('socket.socket', return_value=self.sock)
+
+    def test_sock_diag_dump(self):
+        self.assertEqual(
+            list(sock_diag_dump(self.sock, 'tcp', socket.AF_INET,
+                                socket.IPPROTO_TCP, 1 << 10)),
+            [
+                ('tcp', '0.0.0.0', 111, 0, 15163),
+                ('tcp', '127.0.0.1', 25, 106, 21402),
+            ])
+
+    def test_sock_diag_dump_skips_connected_udp(self):
+        self.assertEqual(
+            list(sock_diag_dump(self.sock, 'udp', socket.AF_INET,
+                                socket.IPPROTO_UDP, 1 << 7)),
+            [
+                ('udp', '127.0.0.1', 123, 0, 16942),
+            ])
+
+    def test_sock_diag_dump_error(self):
+        self.responses[socket.AF_INET, socket.IPPROTO_TCP] = [
+            nlmsg_error(errno.EPERM)]
+        with self.assertRaises(OSError):
+            list(sock_diag_dump(self.sock, 'tcp', socket.AF_INET,
+                                socket.IPPROTO_TCP, 1 << 10))
+
+    def test_sock_diag_dump_malformed(self):
+        for reply in [
+            struct.pack('=IHHII', 0, 20, 2, 1, 0),  # would loop forever
+            sock_diag_msg(socket.AF_INET, 111)[:-8],  # cut short
+            nlmsg(20, b'\0' * 8),  # truncated payload
+            nlmsg(2, b''),  # truncated error
+        ]:
+            self.responses[socket.AF_INET, socket.IPPROTO_TCP] = [reply]
+            with self.assertRaises(OSError):
+                list(sock_diag_dump(self.sock, 'tcp', socket.AF_INET,
+                                    socket.IPPROTO_TCP, 1 << 10))
+
+    def test_listening_sockets_malformed_netlink_reply(self):
+        proc = self.make_fake_proc()
+        self.patch('pov_server_page.update_ports_html.PROC', proc)
+        self.responses[socket.AF_INET, socket.IPPROTO_TCP] = [
+            struct.pack('=IHHII', 0, 20, 2, 1, 0)]
+        # falls back to /proc/net instead of hanging
+        self.assertEqual(list(listening_sockets()),
+                         list(proc_net_sockets(proc)))
+
+    def test_sock_diag_dump_connection_closed(self):
+        self.responses[socket.AF_INET, socket.IPPROTO_TCP] = []
+        self.assertEqual(
+            list(sock_diag_dump(self.sock, 'tcp', socket.AF_INET,
+                                socket.IPPROTO_TCP, 1 << 10)), [])
+
+    def test_netlink_sockets(self):
+        proc = self.make_fake_proc(fds={540: ['socket:[15163]']},
+                                   comms={540: 'rpcbind'})
+        self.assertEqual(list(netlink_sockets(proc)), [
+            NetStatTuple('tcp', '0.0.0.0', 111, 540, 'rpcbind', 0),
+            NetStatTuple('tcp', '127.0.0.1', 25, None, '-', 106),
+            NetStatTuple('tcp6', '::', 80, None, '-', 0),
+            NetStatTuple('udp', '127.0.0.1', 123, None, '-', 0),
+        ])
+        self.assertTrue(self.sock.closed)
+
+    def test_netlink_sockets_not_supported(self):
+        self.responses[socket.AF_INET, socket.IPPROTO_TCP] = [
+            nlmsg_error(errno.EINVAL)]
+        with self.assertRaises(OSError):
+            netlink_sockets('/nonexistent')
+        self.assertTrue(self.sock.closed)
+
+    def test_netlink_sockets_no_af_netlink(self):
+        self.patch('socket.AF_NETLINK', create=True, new=None)
+        with self.assertRaises(OSError):
+            netlink_sockets('/nonexistent')
+
+    def test_listening_sockets_prefers_netlink(self):
+        proc = self.make_fake_proc()
+        self.patch('pov_server_page.update_ports_html.PROC', proc)
+        self.assertEqual(len(list(listening_sockets())), 4)
+
+
 class TestRpcinfo(MockMixin, unittest.TestCase):
 
     def test_rpcinfo_dump_sockets_error_handling(self):
@@ -317,6 +651,58 @@ class TestProcHelpers(unittest.TestCase):
         self.assertEqual(username(None), '?')
 
 
+class TestProcessTable(MockMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.open = self.patch('pov_server_page.update_ports_html.open',
+                               side_effect=fake_open)
+        self.getpwuid = self.patch('pwd.getpwuid')
+        self.getpwuid.return_value.pw_name = 'root'
+
+    def test_reads_each_pid_once(self):
+        processes = ProcessTable([9000, 9000, 540])
+        self.assertEqual(len(processes), 2)
+        self.assertEqual(processes[9000].argv,
+                         ("/usr/bin/python2.7", "webserver.py", "--port=8080"))
+        self.assertEqual(processes[9000].comm, 'python2.7')
+        self.assertEqual(processes.program(9000), 'webserver.py')
+        self.assertEqual(processes.html_cmdline(9000),
+                         '/usr/bin/python2.7 <b>webserver.py</b> --port=8080')
+        # one cmdline and one comm per pid
+        self.assertEqual(self.open.call_count, 4)
+
+    def test_from_mapping(self):
+        processes = ProcessTable.from_mapping({
+            ('tcp', 22): [NetStatTuple('tcp', '0.0.0.0', 22, 824, 'sshd'),
+                          NetStatTuple('tcp6', '::', 22, 824, 'sshd')],
+            ('tcp', 111): [NetStatTuple('tcp', None, 111, None, 'portmapper')],
+        })
+        self.assertEqual(len(processes), 1)
+        self.assertEqual(processes[824].argv, ('/usr/sbin/sshd', '-D'))
+
+    def test_usernames_are_memoized(self):
+        processes = ProcessTable()
+        self.assertEqual(processes.username(0), 'root')
+        self.assertEqual(processes.username(0), 'root')
+        self.assertEqual(self.getpwuid.call_count, 1)
+
+    def test_owner(self):
+        processes = ProcessTable()
+        self.assertEqual(processes.owner(os.getpid()), 'root')
+        self.getpwuid.assert_called_once_with(os.getuid())
+
+    def test_kernel_thread(self):
+        processes = ProcessTable()
+        self.assertEqual(processes.program(2), 'kthreadd')
+        self.assertEqual(processes.html_cmdline(2), '[<b>kthreadd</b>]')
+
+    def test_process_is_gone(self):
+        processes = ProcessTable()
+        self.assertEqual(processes.program(8999), '-')
+        self.assertEqual(processes.html_cmdline(8999), '-')
+        self.assertEqual(processes[8999].comm, None)
+
+
 class TestFormattingHelpers(unittest.TestCase):
 
     def test_format_arg(self):
@@ -331,10 +717,85 @@ class TestFormattingHelpers(unittest.TestCase):
         self.assertEqual(format_arg("\b"), "'\\x08'")
 
 
+def slow_source():
+    script = 'print("one"); import sys, time; sys.stdout.flush(); time.sleep(30)'
+    with pipe(sys.executable, '-c', script) as f:
+        for line in f:
+            yield line.strip()
+
+
+class TestDataSources(MockMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.stderr = self.patch('sys.stderr', StringIO())
+
+    def test_run_sources(self):
+        stats = []
+        self.assertEqual(run_sources([
+            ('letters', lambda: iter('abc')),
+            ('numbers', lambda: [1, 2]),
+        ], stats=stats), [['a', 'b', 'c'], [1, 2]])
+        self.assertEqual([(s.name, s.count, s.timed_out) for s in stats],
+                         [('letters', 3, False), ('numbers', 2, False)])
+
+    def test_run_sources_error(self):
+        def broken():
+            raise OSError(errno.ENOENT, 'No such file or directory')
+        with self.assertRaises(OSError):
+            run_sources([('broken', broken)])
+
+    def test_run_sources_timeout(self):
+        stats = []
+        started = time.monotonic()
+        self.assertEqual(run_sources([('slow', slow_source)], timeout=1,
+                                     stats=stats),
+                         [['one']])
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual([(s.name, s.count, s.timed_out) for s in stats],
+                         [('slow', 1, True)])
+
+    def test_cancelled_source_kills_new_processes(self):
+        source = DataSource('slow', slow_source)
+        process = mock.Mock()
+        process.kill.side_effect = OSError(errno.ESRCH, 'No such process')
+        source.cancel()
+        source.add_process(process)
+        process.kill.assert_called_once_with()
+
+    def test_format_stats(self):
+        self.assertEqual(format_stats([
+            SourceStats('listening sockets', 12, 0.0123, False),
+            SourceStats('rpcinfo -p', 0, 30.0018, True),
+        ]), (
+            'listening sockets: 12 entries in 0.01s\n'
+            'rpcinfo -p: 0 entries in 30.00s (timed out)\n'
+        ))
+
+    def test_render_warnings(self):
+        self.assertEqual(render_warnings([
+            SourceStats('listening sockets', 12, 0.0123, False),
+            SourceStats('rpcinfo -p', 0, 30.0018, True),
+        ]), (
+            '<div class="alert alert-warning">\n'
+            '  <strong>Incomplete data:</strong> gave up on rpcinfo -p after 30\n'
+            '  seconds.\n'
+            '</div>\n'
+        ))
+
+    def test_render_html_default_hostname(self):
+        with mock.patch('pov_server_page.update_ports_html.get_fqdn',
+                        return_value='frog.example.com'):
+            html = render_html({})
+        self.assertIn('<title>Open TCP & UDP ports on frog.example.com</title>', html)
+
+
 class TestGetPortMapping(MockMixin, unittest.TestCase):
 
     def setUp(self):
         self.patch('subprocess.Popen', FakePopen())
+        self.patch('pov_server_page.update_ports_html.PROC', '/nonexistent')
+        self.patch('pov_server_page.update_ports_html.netlink_sockets',
+                   side_effect=OSError(errno.EPERM, 'Not allowed'))
         self.patch('pov_server_page.update_ports_html.open', fake_open)
 
     def test_systemd_integration(self):
@@ -344,6 +805,36 @@ class TestGetPortMapping(MockMixin, unittest.TestCase):
             NetStatTuple('tcp', '127.0.0.1', 8000, None, 'spinta.socket'),
         ])
 
+    def test_stats(self):
+        stats = []
+        get_port_mapping(stats=stats)
+        self.assertEqual([s.name for s in stats], [
+            'listening sockets', 'wg show', 'rpcinfo -p',
+            'systemctl list-sockets',
+        ])
+
+
+class TestFingerprint(MockMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = [
+            NetStatTuple('tcp', '0.0.0.0', 22, 824, 'sshd'),
+            NetStatTuple('tcp', '0.0.0.0', 22, None, '-'),
+        ]
+        self.patch('pov_server_page.update_ports_html.listening_sockets',
+                   lambda: list(self.sockets))
+
+    def test_fingerprint(self):
+        before = fingerprint()
+        self.sockets.reverse()
+        self.assertEqual(fingerprint(), before)
+        self.sockets.append(NetStatTuple('tcp', '0.0.0.0', 80, 900, 'nginx'))
+        self.assertNotEqual(fingerprint(), before)
+
+    def test_no_etc_services(self):
+        self.patch('os.stat', side_effect=OSError(2, 'No such file'))
+        self.assertIsNone(fingerprint()[-1])
+
 
 class TestParseServices(unittest.TestCase):
 
@@ -357,7 +848,12 @@ class TestWithFakeEnvironment(MockMixin, unittest.TestCase):
 
     def setUp(self):
         self.patch('subprocess.Popen', FakePopen())
+        self.patch('pov_server_page.update_ports_html.PROC', '/nonexistent')
+        self.patch('pov_server_page.update_ports_html.netlink_sockets',
+                   side_effect=OSError(errno.EPERM, 'Not allowed'))
         self.patch('pov_server_page.update_ports_html.open', fake_open)
+        self.patch('pov_server_page.update_ports_html.get_fqdn',
+                   return_value='localhost')
         self.stderr = self.patch('sys.stderr', StringIO())
 
     def run_main(self, *args):
@@ -374,6 +870,22 @@ class TestWithFakeEnvironment(MockMixin, unittest.TestCase):
     def test_main(self):
         self.run_main()
 
+    def test_main_verbose(self):
+        stdout = self.patch('sys.stdout', StringIO())
+        self.run_main('-v')
+        self.assertIn('listening sockets: ', stdout.getvalue())
+
+    def test_main_default_hostname(self):
+        self.patch('pov_server_page.update_ports_html.get_fqdn',
+                   return_value='frog.example.com')
+        render_file = self.patch(
+            'pov_server_page.update_ports_html.render_file')
+        self.run_main('-o', '/var/www/${hostname}/ports/index.html')
+        self.assertEqual(render_file.call_args[1]['output'],
+                         '/var/www/frog.example.com/ports/index.html')
+        self.assertEqual(render_file.call_args[1]['hostname'],
+                         'frog.example.com')
+
     def test_main_unexpected_arguments(self):
         with self.assertRaises(SystemExit):
             self.run_main('foo')
@@ -414,6 +926,19 @@ class TestWithFakeEnvironment(MockMixin, unittest.TestCase):
             </tr>
           '''))
 
+    def test_render_row_owner_from_socket_uid(self):
+        self.assertEqual(textwrap.dedent(render_row([
+            NetStatTuple('tcp', '127.0.0.1', 25, None, '-', 0)
+        ])), textwrap.dedent('''\
+            <tr class="system">
+              <td class="local" title="127.0.0.1">tcp</td>
+              <td class="local" title="">25</td>
+              <td class="text-nowrap">root</td>
+              <td class="text-nowrap local" title="">-</td>
+              <td><b>-</b></td>
+            </tr>
+          '''))
+
     def test_render_row_systemd_socket(self):
         self.assertEqual(textwrap.dedent(render_row([
             NetStatTuple('tcp', '127.0.0.1', 8000, 1, 'systemd'),
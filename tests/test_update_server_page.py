@@ -2,11 +2,13 @@
 import errno
 import getpass
 import grp
+import json
 import os
 import random
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import unittest
 
@@ -18,17 +20,34 @@ except ImportError:
 import mock
 import pytest
 
+from pov_server_page import disk_inventory, machine_summary
+from pov_server_page.du_history import SizeHistory
+from pov_server_page.du_scan import ScanError
+from pov_server_page.inotify import IN_CLOSE_WRITE, IN_Q_OVERFLOW, Event
+from pov_server_page.update_ports_html import SourceStats
 from pov_server_page.update_server_page import (
     CHANGELOG2HTML_SCRIPT,
     HTML_MARKER,
+    STATE_DIR,
     Builder,
+    Daemon,
     Error,
+    Facts,
+    RunCoordinator,
+    Watcher,
+    content_hash,
+    coordinated_build,
+    file_fingerprint,
+    lock_file,
     get_fqdn,
     main,
     mkdir_with_parents,
     newer,
     pipeline,
+    precompile,
     replace_file,
+    ssh_host_keys_fingerprint,
+    strip_volatile,
     symlink,
 )
 
@@ -181,6 +200,30 @@ class TestReplaceFile(FilesystemTests):
             self.assertEqual(f.read(), old_contents)
         self.assertFalse(rv)
 
+    def test_replace_file_ignores_volatile_changes(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        old_contents = (b'Contents (with @MARKER@), updated'
+                        b' <!-- volatile -->12:00<!-- /volatile -->')
+        with open(fn, 'wb') as f:
+            f.write(old_contents)
+        rv = replace_file(fn, b'@MARKER@', old_contents.replace(b'12:00', b'13:00'))
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), old_contents)
+        self.assertFalse(rv)
+
+    def test_replace_file_notices_nonvolatile_changes(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        old_contents = (b'Contents (with @MARKER@), updated'
+                        b' <!-- volatile -->12:00<!-- /volatile -->')
+        with open(fn, 'wb') as f:
+            f.write(old_contents)
+        new_contents = old_contents.replace(b'12:00', b'13:00').replace(
+            b'Contents', b'New contents')
+        rv = replace_file(fn, b'@MARKER@', new_contents)
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), new_contents)
+        self.assertTrue(rv)
+
     def test_replace_file_leaves_file_alone(self):
         fn = os.path.join(self.tmpdir, 'file.txt')
         old_contents = b'Old contents (without a marker)'
@@ -197,17 +240,98 @@ class TestReplaceFile(FilesystemTests):
             with self.assertRaises(IOError):
                 replace_file(fn, b'@MARKER@', b'New contents (with @MARKER@)')
 
+    def test_replace_file_no_marker(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        with open(fn, 'wb') as f:
+            f.write(b'Old contents')
+        self.assertTrue(replace_file(fn, b'', b'New contents'))
+
+    def test_replace_file_marker_not_at_top(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        with open(fn, 'wb') as f:
+            f.write(b'x' * 10000 + b'@MARKER@')
+        with self.assertRaises(Error):
+            replace_file(fn, b'@MARKER@', b'New contents (with @MARKER@)')
+
+    def test_replace_file_chunks(self):
+        fn = os.path.join(self.tmpdir, 'subdir', 'file.txt')
+        rv = replace_file(fn, b'@MARKER@', iter([b'New (with @MARKER@)', b' contents']))
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), b'New (with @MARKER@) contents')
+        self.assertTrue(rv)
+        rv = replace_file(fn, b'@MARKER@', iter([b'New (with @MARKER@) contents']))
+        self.assertFalse(rv)
+        self.assertEqual(os.listdir(os.path.dirname(fn)), ['file.txt'])
+
+    def test_replace_file_chunks_leaves_file_alone(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        old_contents = b'Old contents (without a marker)'
+        with open(fn, 'wb') as f:
+            f.write(old_contents)
+        with self.assertRaises(Error):
+            replace_file(fn, b'@MARKER@', [b'New contents (with @MARKER@)'])
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), old_contents)
+        self.assertEqual(os.listdir(self.tmpdir), ['file.txt'])
+
+    def test_replace_file_manifest(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        manifest = {}
+        replace_file(fn, b'@MARKER@', b'Contents (with @MARKER@)',
+                     manifest=manifest)
+        self.assertEqual(manifest[fn]['size'], 24)
+        self.assertEqual(manifest[fn]['sha256'],
+                         content_hash([b'Contents (with @MARKER@)']))
+        with mock.patch('pov_server_page.update_server_page.open', self.raise_ioerror):
+            # we don't need to read the file to know it's unchanged
+            rv = replace_file(fn, b'@MARKER@', b'Contents (with @MARKER@)',
+                              manifest=manifest)
+        self.assertFalse(rv)
+
+    def test_replace_file_stale_manifest(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        manifest = {}
+        replace_file(fn, b'@MARKER@', b'Contents (with @MARKER@)',
+                     manifest=manifest)
+        with open(fn, 'wb') as f:
+            f.write(b'Modified (with @MARKER@)')
+        os.utime(fn, ns=(0, 0))
+        rv = replace_file(fn, b'@MARKER@', b'Contents (with @MARKER@)',
+                          manifest=manifest)
+        self.assertTrue(rv)
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), b'Contents (with @MARKER@)')
+
+    def test_replace_file_stat_error(self):
+        fn = os.path.join(self.tmpdir, 'file.txt')
+        with mock.patch('os.stat', self.raise_oserror):
+            with self.assertRaises(OSError):
+                replace_file(fn, b'@MARKER@', b'New contents (with @MARKER@)')
+
+
+class TestStripVolatile(unittest.TestCase):
+
+    def test_strip_volatile(self):
+        text = (b'Updated <!-- volatile -->12:00<!-- /volatile -->,'
+                b' checked <!-- volatile -->13:00<!-- /volatile -->.'
+                b' <!-- volatile -->unterminated')
+        expected = (b'Updated <!-- volatile --><!-- /volatile -->,'
+                    b' checked <!-- volatile --><!-- /volatile -->.'
+                    b' <!-- volatile -->unterminated')
+        for size in range(1, len(text) + 1):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            with self.subTest(size=size):
+                self.assertEqual(b''.join(strip_volatile(chunks)), expected)
+
 
 class TestPipeline(FilesystemTests):
 
     def test_pipeline(self):
-        fn = os.path.join(self.tmpdir, 'outfile')
-        with open(fn, 'w') as f:
-            pipeline(['printf', '%s\n', 'aaa', 'aab', 'bbc'],
-                     ['grep', '^a'],
-                     ['sort', '-r'], stdout=f)
-        with open(fn, 'r') as f:
-            self.assertEqual(f.readlines(), ['aab\n', 'aaa\n'])
+        self.assertEqual(
+            b''.join(pipeline(['printf', '%s\n', 'aaa', 'aab', 'bbc'],
+                              ['grep', '^a'],
+                              ['sort', '-r'])),
+            b'aab\naaa\n')
 
 
 class BuilderTests(FilesystemTests):
@@ -269,6 +393,207 @@ class TestBuilders(BuilderTests):
         self.assertEqual(self.stdout.getvalue(),
                          "Created %s/subdir/index.html\n" % self.tmpdir)
 
+    def test_Ports(self):
+        def get_port_mapping(stats):
+            stats.append(SourceStats('rpcinfo -p', 2, 30.5, True))
+            return {}
+        self.patch('pov_server_page.update_ports_html.get_port_mapping',
+                   get_port_mapping)
+        pathname = os.path.join(self.tmpdir, 'ports', 'index.html')
+        Builder.Ports().build(pathname, self.builder)
+        with open(pathname, 'r') as f:
+            self.assertIn('gave up on rpcinfo -p after 30', f.read())
+        self.assertEqual(self.stdout.getvalue(),
+                         "rpcinfo -p: 2 entries in 30.50s (timed out)\n"
+                         "Created %s/ports/index.html\n" % self.tmpdir)
+
+
+class FakeSubBuilder(object):
+
+    def __init__(self):
+        self.value = 'v1'
+        self.builds = 0
+
+    def inputs(self, filename, builder):
+        return [self.value]
+
+    def build(self, filename, builder):
+        self.builds += 1
+        builder.replace_file(filename, HTML_MARKER, self.value.encode())
+
+
+class TestBuildState(BuilderTests):
+
+    def setUp(self):
+        super(TestBuildState, self).setUp()
+        self.builder.vars['MOTD_FILE'] = '/dev/null'
+        self.builder.file_readable_to = lambda f, u, g: True
+        self.subbuilder = FakeSubBuilder()
+        self.builder.build_list = [
+            ('/var/www/{HOSTNAME}/test.html', self.subbuilder),
+        ]
+        self.filename = os.path.join(self.tmpdir, 'var/www/frog.example.com/test.html')
+
+    def test_skips_unchanged(self):
+        self.builder.build()
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 1)
+        self.assertTrue(os.path.exists(self.builder.state_file))
+
+    def test_rebuilds_when_inputs_change(self):
+        self.builder.build()
+        self.subbuilder.value = 'v2'
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_rebuilds_missing_files(self):
+        self.builder.build()
+        os.unlink(self.filename)
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_rebuilds_modified_files(self):
+        self.builder.build()
+        with open(self.filename, 'ab') as f:
+            f.write(b'my local changes')
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+        with open(self.filename, 'rb') as f:
+            self.assertNotIn(b'my local changes', f.read())
+
+    def test_rebuilds_files_missing_from_manifest(self):
+        self.builder.build()
+        with open(self.builder.state_file) as f:
+            state = json.load(f)
+        state['manifest'] = {}
+        with open(self.builder.state_file, 'w') as f:
+            json.dump(state, f)
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_force(self):
+        self.builder.build()
+        self.builder.build(force=True)
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_no_inputs(self):
+        subbuilder = mock.Mock(spec=['build'])
+        self.builder.build_list = [
+            ('/var/www/{HOSTNAME}/test.html', subbuilder),
+        ]
+        self.builder.build()
+        self.builder.build()
+        self.assertEqual(subbuilder.build.call_count, 2)
+        self.assertFalse(os.path.exists(self.builder.state_file))
+
+    def test_corrupted_state_file(self):
+        self.builder.build()
+        with open(self.builder.state_file, 'w') as f:
+            f.write('{')
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_state_file_from_older_version(self):
+        self.builder.build()
+        with open(self.builder.state_file) as f:
+            state = json.load(f)
+        state['version'] = '2.0.0'
+        with open(self.builder.state_file, 'w') as f:
+            json.dump(state, f)
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_state_file_from_older_collector_version(self):
+        self.builder.build()
+        self.patch('pov_server_page.machine_summary.__version__', '0.1.0')
+        self.builder.build()
+        self.assertEqual(self.subbuilder.builds, 2)
+
+    def test_manifest(self):
+        self.builder.build()
+        with open(self.builder.state_file) as f:
+            state = json.load(f)
+        self.assertEqual(list(state['manifest']), [self.filename])
+
+    def test_var_inputs_ignore_timestamp(self):
+        self.builder.vars['TIMESTAMP'] = 'now'
+        inputs = self.builder.var_inputs()
+        self.builder.vars['TIMESTAMP'] = 'later'
+        self.assertEqual(self.builder.var_inputs(), inputs)
+        self.builder.vars['foo'] = 'three'
+        self.assertNotEqual(self.builder.var_inputs(), inputs)
+
+    def test_Template_inputs(self):
+        template = Builder.Template('index.html.in', depends=[lambda builder: 42])
+        inputs = template.inputs(self.filename, self.builder)
+        self.assertEqual(inputs[0][0], os.path.join(self.builder.template_dir,
+                                                    'index.html.in'))
+        self.assertEqual(inputs[-1], 42)
+
+    def test_Ports_inputs(self):
+        self.patch('pov_server_page.update_ports_html.fingerprint',
+                   return_value=['sockets'])
+        self.assertEqual(Builder.Ports().inputs(self.filename, self.builder),
+                         ['frog.example.com', ['sockets']])
+
+    def test_MachineSummary_inputs(self):
+        self.patch('pov_server_page.machine_summary.fingerprint',
+                   return_value=['summary'])
+        self.assertEqual(
+            Builder.MachineSummary().inputs(self.filename, self.builder),
+            ['summary'])
+
+    def test_DiskInventory_inputs(self):
+        self.patch('pov_server_page.disk_inventory.fingerprint',
+                   return_value=['disks'])
+        self.assertEqual(
+            Builder.DiskInventory().inputs(self.filename, self.builder),
+            ['disks'])
+
+    def test_info_html_shares_fingerprints(self):
+        ms = self.patch('pov_server_page.machine_summary.fingerprint',
+                        return_value=['summary'])
+        di = self.patch('pov_server_page.disk_inventory.fingerprint',
+                        return_value=['disks'])
+        for filename, subbuilder in Builder.build_list:
+            if '/info/' in filename:
+                self.builder.get_fingerprint(filename, subbuilder)
+        self.assertEqual(ms.call_count, 1)
+        self.assertEqual(di.call_count, 1)
+
+
+class TestFacts(unittest.TestCase):
+
+    def test_collected_once(self):
+        facts = Facts()
+        with mock.patch('pov_server_page.machine_summary.get_summary') as gs:
+            self.assertIs(facts.machine_summary, facts.machine_summary)
+        self.assertEqual(gs.call_count, 1)
+
+    def test_disk_info_shared(self):
+        facts = Facts()
+        self.assertIs(facts.disk_info, facts.disk_info)
+
+
+class TestFingerprints(FilesystemTests):
+
+    def test_file_fingerprint(self):
+        filename = os.path.join(self.tmpdir, 'file.txt')
+        self.assertIsNone(file_fingerprint(filename))
+        with open(filename, 'w') as f:
+            f.write('hello')
+        before = file_fingerprint(filename)
+        os.chmod(filename, 0o600)
+        self.assertNotEqual(file_fingerprint(filename), before)
+
+    def test_ssh_host_keys_fingerprint(self):
+        filename = os.path.join(self.tmpdir, 'ssh_host_rsa_key.pub')
+        with open(filename, 'w') as f:
+            f.write('ssh-rsa AAAA root@frog\n')
+        self.patch('glob.glob', return_value=[filename])
+        self.assertEqual(ssh_host_keys_fingerprint(),
+                         [file_fingerprint(filename)])
+
 
 class TestDiskUsageBuilderHelpers(unittest.TestCase):
 
@@ -483,8 +808,10 @@ class TestDiskUsageBuilder(BuilderTests):
 
     @mock.patch('time.strftime', lambda fmt: '2015-11-01')
     @mock.patch('pov_server_page.update_server_page.pipeline')
+    @mock.patch('pov_server_page.du_scan.DuScan')
     @mock.patch('os.path.exists')
-    def test_build_fresh(self, mock_exists, mock_pipeline):
+    def test_build_fresh(self, mock_exists, mock_DuScan, mock_pipeline):
+        mock_DuScan.return_value.run.return_value = dict(elapsed=42)
         mock_exists.return_value = False
         self.builder.vars['DISK_USAGE_LIST'] = ['/frog']
         self.builder.vars['DISK_USAGE_DELETE_OLD'] = False
@@ -494,15 +821,53 @@ class TestDiskUsageBuilder(BuilderTests):
             "Created /var/www/frog.example.com/du/index.html\n"
             "Created /var/www/frog.example.com/du/webtreemap\n"
             "Creating /var/www/frog.example.com/du/frog/du-2015-11-01.gz\n"
-            "Creating /var/www/frog.example.com/du/frog/du.js\n"
+            "Created /var/www/frog.example.com/du/frog/du.js\n"
             "Created /var/www/frog.example.com/du/frog/index.html\n"
         )
-        self.assertEqual(mock_pipeline.call_count, 2)
+        mock_DuScan.assert_called_once_with(
+            '/frog', os.path.join(self.tmpdir, 'du/frog/du-2015-11-01.gz'),
+            command_prefix=['nice', '-n', '10'], previous=None)
+        self.assertEqual(mock_pipeline.call_count, 1)
 
     @mock.patch('time.strftime', lambda fmt: '2015-11-01')
     @mock.patch('pov_server_page.update_server_page.pipeline')
+    @mock.patch('pov_server_page.du_scan.DuScan')
+    def test_build_du_js(self, mock_DuScan, mock_pipeline):
+        mock_DuScan.return_value.run.return_value = dict(
+            elapsed=42, throttle=dict(paused=7))
+        mock_pipeline.return_value = iter([b'var kb = ', b'{};'])
+        self.builder.vars['DISK_USAGE_LIST'] = ['/frog']
+        self.builder.vars['DISK_USAGE_DELETE_OLD'] = False
+        Builder.DiskUsage().build(os.path.join(self.tmpdir, 'du'), self.builder)
+        du_file = os.path.join(self.tmpdir, 'du/frog/du-2015-11-01.gz')
+        mock_pipeline.assert_called_once_with(
+            ['zcat', du_file], [mock.ANY])
+        with open(os.path.join(self.tmpdir, 'du/frog/du.js')) as f:
+            self.assertEqual(f.read(),
+                             'var kb = {};\n'
+                             'var last_updated = "2015-11-01";\n'
+                             'var duration = "42";\n'
+                             'var paused = "7";\n')
+
+    @mock.patch('time.strftime', lambda fmt: '2015-11-01')
+    @mock.patch('pov_server_page.update_server_page.pipeline')
+    @mock.patch('pov_server_page.du_scan.DuScan')
+    def test_build_scan_failed(self, mock_DuScan, mock_pipeline):
+        mock_DuScan.return_value.run.side_effect = ScanError('du died')
+        self.builder.vars['DISK_USAGE_LIST'] = ['/frog']
+        self.builder.vars['DISK_USAGE_DELETE_OLD'] = False
+        with mock.patch('sys.stderr', StringIO()) as stderr:
+            Builder.DiskUsage().build(os.path.join(self.tmpdir, 'du'), self.builder)
+        self.assertEqual(stderr.getvalue(), 'du died\n')
+        self.assertNotIn('du.js', self.stdout.getvalue())
+        self.assertEqual(mock_pipeline.call_count, 0)
+
+    @mock.patch('time.strftime', lambda fmt: '2015-11-01')
+    @mock.patch('pov_server_page.update_server_page.pipeline')
+    @mock.patch('pov_server_page.du_scan.DuScan')
     @mock.patch('os.path.exists', lambda what: what == '/usr/bin/ionice')
-    def test_build_fresh_ionice(self, mock_pipeline):
+    def test_build_fresh_ionice(self, mock_DuScan, mock_pipeline):
+        mock_DuScan.return_value.run.return_value = dict(elapsed=42)
         self.builder.vars['DISK_USAGE_LIST'] = ['/frog']
         self.builder.vars['DISK_USAGE_DELETE_OLD'] = False
         Builder.DiskUsage().build(os.path.join(self.tmpdir, 'du'), self.builder)
@@ -511,10 +876,59 @@ class TestDiskUsageBuilder(BuilderTests):
             "Created /var/www/frog.example.com/du/index.html\n"
             "Created /var/www/frog.example.com/du/webtreemap\n"
             "Creating /var/www/frog.example.com/du/frog/du-2015-11-01.gz\n"
-            "Creating /var/www/frog.example.com/du/frog/du.js\n"
+            "Created /var/www/frog.example.com/du/frog/du.js\n"
             "Created /var/www/frog.example.com/du/frog/index.html\n"
         )
-        self.assertEqual(mock_pipeline.call_count, 2)
+        mock_DuScan.assert_called_once_with(
+            '/frog', os.path.join(self.tmpdir, 'du/frog/du-2015-11-01.gz'),
+            command_prefix=['nice', '-n', '10', 'ionice', '-c3'],
+            previous=None)
+        self.assertEqual(mock_pipeline.call_count, 1)
+
+    @mock.patch('time.strftime', lambda fmt: '2015-11-02')
+    @mock.patch('pov_server_page.update_server_page.pipeline')
+    @mock.patch('pov_server_page.du_scan.DuScan')
+    def test_build_top_lists(self, mock_DuScan, mock_pipeline):
+        datadir = os.path.join(self.tmpdir, 'du', 'frog')
+        os.makedirs(datadir)
+        with open(os.path.join(datadir, 'du-2015-11-01.gz'), 'wb'):
+            pass
+
+        def run(verbose):
+            output = mock_DuScan.call_args[0][1]
+            with open(output, 'wb'):
+                pass
+            with open(output[:-len('.gz')] + '.json', 'w') as f:
+                json.dump(metadata, f)
+            return metadata
+
+        metadata = dict(elapsed=42, largest_files=[[2048, '/frog/<big>.iso']],
+                        largest_dirs=[[1024, '/frog/a dir']])
+        mock_DuScan.return_value.run.side_effect = run
+        self.builder.vars['DISK_USAGE_LIST'] = ['/frog']
+        self.builder.vars['DISK_USAGE_DELETE_OLD'] = False
+        Builder.DiskUsage().build(os.path.join(self.tmpdir, 'du'), self.builder)
+        self.assertEqual(mock_DuScan.call_args[1]['previous'],
+                         os.path.join(datadir, 'du-2015-11-01.gz'))
+        with open(os.path.join(datadir, 'index.html')) as f:
+            html = f.read()
+        self.assertIn('<h4>Largest files</h4>', html)
+        self.assertIn('<td class="size">2.0 MiB</td><td>/frog/&lt;big&gt;.iso</td>', html)
+        self.assertIn('<td class="size">1.0 MiB</td><td>'
+                      '<a href="../history/frog/frog/a%20dir?format=html">'
+                      '/frog/a dir</a></td>', html)
+        self.assertNotIn('Fastest growing', html)
+        self.assertEqual(SizeHistory(datadir).dates(),
+                         ['2015-11-01', '2015-11-02'])
+
+    def test_delete_old_files_and_metadata(self):
+        for fn in ['du-2015-11-02.gz', 'du-2015-11-02.json',
+                   'du-2015-11-03.gz', 'du-2015-11-03.json',
+                   'du-2015-11-04.gz']:
+            with open(os.path.join(self.tmpdir, fn), 'w'):
+                pass
+        Builder.DiskUsage().delete_old_files(self.tmpdir, keep_daily=1, keep_monthly=0, keep_yearly=0)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['du-2015-11-04.gz'])
 
     @mock.patch('os.unlink')
     @mock.patch('glob.glob')
@@ -533,6 +947,55 @@ class TestBuilderConstruction(unittest.TestCase):
         cp = Builder.ConfigParser()
         Builder.from_config(cp) # should not raise
 
+    def test_Builder_hostname_default(self):
+        with mock.patch('pov_server_page.update_server_page.get_fqdn',
+                        return_value='frog.example.com') as get_fqdn:
+            builder = Builder({'HOSTNAME': 'toad.example.com'})
+            self.assertEqual(builder.vars['HOSTNAME'], 'toad.example.com')
+            self.assertEqual(get_fqdn.call_count, 0)
+            builder = Builder()
+            self.assertEqual(builder.vars['HOSTNAME'], 'frog.example.com')
+
+    def test_Builder_cache_dir_not_writable(self):
+        builder = Builder(cache_dir='/nonexistent/cache')
+        self.assertIsNone(builder.lookup.module_directory)
+        self.assertIsNone(builder.html_lookup.module_directory)
+
+
+class TestPrecompile(FilesystemTests):
+
+    def setUp(self):
+        super(TestPrecompile, self).setUp()
+        self.stdout = self.patch('sys.stdout', StringIO())
+
+    def test_precompile(self):
+        stale = os.path.join(self.tmpdir, 'html', 'index.html.in.py')
+        os.makedirs(os.path.dirname(stale))
+        with open(stale, 'w') as f:
+            f.write('stale')
+        precompile(cache_dir=self.tmpdir, verbose=True)
+        self.assertIn('Compiling index.html.in\n', self.stdout.getvalue())
+        with open(stale) as f:
+            self.assertIn('_magic_number', f.read())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'text', 'apache.conf.in.py')))
+        self.assertNotEqual(
+            os.listdir(os.path.join(self.tmpdir, 'changelog2html')), [])
+        self.assertNotEqual(
+            os.listdir(os.path.join(self.tmpdir, 'dudiff2html')), [])
+
+    def test_precompiled_templates_are_used(self):
+        precompile(cache_dir=self.tmpdir)
+        builder = Builder({'HOSTNAME': 'frog.example.com'},
+                          cache_dir=self.tmpdir)
+        template = builder.get_template('ssh.html.in')
+        self.assertEqual(template.module.__file__,
+                         os.path.join(self.tmpdir, 'html', 'ssh.html.in.py'))
+
+    def test_no_cache_dir(self):
+        with self.assertRaises(Error):
+            precompile(cache_dir=None)
+
 
 class TestBuilderParseHelpers(unittest.TestCase):
 
@@ -719,6 +1182,155 @@ class TestBuilderFileReadability(unittest.TestCase):
         self.assertFalse(can_execute('/root', 1000, 100))
 
 
+class FakeDiskUsage(Builder.DiskUsage):
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.builds = []
+
+    def build(self, filename, builder):
+        # the build phase is over, so a quick run could happen now
+        self.builds.append((builder.quick, self.runs.busy('build')))
+
+
+class TestRunCoordinator(FilesystemTests):
+
+    def setUp(self):
+        super(TestRunCoordinator, self).setUp()
+        self.runs = RunCoordinator(os.path.join(self.tmpdir, 'state'))
+        # flock() locks belong to open files, so a second coordinator in
+        # the same process behaves like another process
+        self.other = RunCoordinator(os.path.join(self.tmpdir, 'state'))
+
+    def test_lock_file(self):
+        filename = os.path.join(self.tmpdir, 'subdir', 'test.lock')
+        with lock_file(filename):
+            self.assertIsNone(lock_file(filename, blocking=False))
+        with lock_file(filename, blocking=False) as f:
+            self.assertIsNotNone(f)
+
+    def test_acquire_release(self):
+        self.patch('time.time', return_value=1500000000)
+        self.assertTrue(self.runs.acquire('du'))
+        self.assertFalse(self.other.acquire('du'))
+        self.assertTrue(self.other.busy('du'))
+        self.assertFalse(self.other.busy('build'))
+        self.assertEqual(self.other.load_state(), {
+            'du': {'start': 1500000000, 'end': None, 'pid': os.getpid()},
+        })
+        self.runs.release('du')
+        self.assertFalse(self.other.busy('du'))
+        self.assertEqual(self.other.load_state()['du']['end'], 1500000000)
+
+    def test_corrupted_state_file(self):
+        os.makedirs(self.runs.state_dir)
+        with open(self.runs.state_file, 'w') as f:
+            f.write('[]')
+        self.assertEqual(self.runs.load_state(), {})
+
+
+class TestCoordinatedBuild(BuilderTests):
+
+    def setUp(self):
+        super(TestCoordinatedBuild, self).setUp()
+        self.builder.vars['MOTD_FILE'] = '/dev/null'
+        self.builder.file_readable_to = lambda f, u, g: True
+        self.runs = RunCoordinator(os.path.join(self.tmpdir, 'state'))
+        self.other = RunCoordinator(os.path.join(self.tmpdir, 'state'))
+        self.subbuilder = FakeSubBuilder()
+        self.du = FakeDiskUsage(self.other)
+        self.builder.build_list = [
+            ('/var/www/{HOSTNAME}/test.html', self.subbuilder),
+            ('/var/www/{HOSTNAME}/du', self.du),
+        ]
+
+    def test_full_run(self):
+        self.assertTrue(coordinated_build(self.builder, self.runs))
+        self.assertEqual(self.subbuilder.builds, 1)
+        self.assertEqual(self.du.builds, [(False, False)])
+        self.assertEqual(sorted(self.runs.load_state()), ['build', 'du'])
+        self.assertFalse(self.other.busy('du'))
+
+    def test_quick_run(self):
+        self.assertTrue(coordinated_build(self.builder, self.runs, quick=True))
+        self.assertEqual(self.subbuilder.builds, 1)
+        self.assertEqual(self.du.builds, [(True, True)])
+        self.assertEqual(list(self.runs.load_state()), ['build'])
+
+    def test_full_run_already_in_progress(self):
+        self.other.acquire('du')
+        self.assertFalse(coordinated_build(self.builder, self.runs,
+                                           verbose=True))
+        self.assertEqual(self.subbuilder.builds, 0)
+        self.assertEqual(self.stdout.getvalue(),
+                         "Another full run is in progress, skipping.\n")
+
+    def test_quick_run_during_build_phase(self):
+        self.other.acquire('build')
+        self.assertFalse(coordinated_build(self.builder, self.runs,
+                                           verbose=True, quick=True))
+        self.assertEqual(self.subbuilder.builds, 0)
+        self.assertEqual(self.stdout.getvalue(),
+                         "Another run is in progress, skipping.\n")
+        self.assertFalse(self.runs.busy('du'))
+
+    def test_quick_run_during_du_phase(self):
+        self.other.acquire('du')
+        self.assertTrue(coordinated_build(self.builder, self.runs,
+                                          verbose=True, quick=True))
+        self.assertEqual(self.subbuilder.builds, 1)
+        self.assertEqual(self.du.builds, [])
+        self.assertIn("Disk usage scan in progress, not touching disk usage"
+                      " pages.\n", self.stdout.getvalue())
+
+    def test_full_run_computes_everything_once(self):
+        self.builder._compute_derived = mock.Mock(
+            wraps=self.builder._compute_derived)
+        self.builder.save_build_state = mock.Mock(
+            wraps=self.builder.save_build_state)
+        self.assertTrue(coordinated_build(self.builder, self.runs))
+        self.assertEqual(self.builder._compute_derived.call_count, 1)
+        self.assertEqual(self.builder.save_build_state.call_count, 1)
+        fingerprints, manifest = self.builder.load_build_state()
+        self.assertEqual(sorted(os.path.basename(fn) for fn in fingerprints),
+                         ['test.html'])
+
+    def test_quick_run_only(self):
+        self.assertTrue(coordinated_build(
+            self.builder, self.runs, quick=True,
+            only={'/var/www/{HOSTNAME}/du'}))
+        self.assertEqual(self.subbuilder.builds, 0)
+        self.assertEqual(self.du.builds, [(True, True)])
+
+    def test_quick_run_only_during_du_phase(self):
+        self.other.acquire('du')
+        self.assertTrue(coordinated_build(
+            self.builder, self.runs, quick=True,
+            only={'/var/www/{HOSTNAME}/du'}))
+        self.assertEqual(self.subbuilder.builds, 0)
+        self.assertEqual(self.du.builds, [])
+
+    def test_concurrent_runs_merge_build_state(self):
+        other_builder = Builder({'HOSTNAME': 'frog.example.com'},
+                                destdir=self.tmpdir)
+        other_builder.build_list = [
+            ('/var/www/{HOSTNAME}/other.html', FakeSubBuilder()),
+        ]
+        other_builder.vars['MOTD_FILE'] = '/dev/null'
+        other_builder.file_readable_to = lambda f, u, g: True
+        self.builder.build_list[1:] = []
+        # other_builder loaded the state before self.builder saved it
+        stale = [({}, {})]
+        real_load_build_state = other_builder.load_build_state
+        other_builder.load_build_state = (
+            lambda: stale.pop() if stale else real_load_build_state())
+        self.builder.build()
+        other_builder.build()
+        fingerprints, manifest = self.builder.load_build_state()
+        self.assertEqual(sorted(os.path.basename(fn) for fn in fingerprints),
+                         ['other.html', 'test.html'])
+
+
 class TestBuilderWithFilesystem(BuilderTests):
 
     maxDiff = None
@@ -735,13 +1347,19 @@ class TestBuilderWithFilesystem(BuilderTests):
         with open(fn, 'rb') as f:
             self.assertEqual(f.read(), b'@MARKER@\ncontent')
 
+    def test_replace_file_chunks_with_implicit_marker(self):
+        fn = os.path.join(self.tmpdir, 'subdir', 'file.txt')
+        self.builder.replace_file(fn, b'@MARKER@', iter([b'con', b'tent']))
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), b'@MARKER@\ncontent')
+
     def test_replace_file_verbose(self):
         fn = os.path.join(self.tmpdir, 'subdir', 'file.txt')
         self.builder.replace_file(fn, b'@MARKER@', b'content')
         self.assertEqual(self.stdout.getvalue(),
                          "Created %s/subdir/file.txt\n" % self.tmpdir)
 
-    @mock.patch('pov_server_page.update_server_page.replace_file', lambda d, m, n: True)
+    @mock.patch('pov_server_page.update_server_page.replace_file', lambda d, m, n, manifest: True)
     def test_replace_file_apache_reload(self):
         self.builder.replace_file('/etc/apache2/test.conf', b'@MARKER@', b'content')
         self.assertTrue(self.builder.needs_apache_reload)
@@ -774,11 +1392,319 @@ class TestBuilderWithFilesystem(BuilderTests):
         with open(fn, 'r') as f:
             self.assertIn('<Location /foo>', f.read())
 
+    def test_build_collects_facts_once(self):
+        self.builder.vars['MOTD_FILE'] = '/dev/null'
+        self.builder.file_readable_to = lambda f, u, g: True
+        self.builder.build_list = [
+            entry for entry in self.builder.build_list
+            if '/info/' in entry[0]]
+        self.patch('pov_server_page.machine_summary.get_interfaces',
+                   return_value=([], [('192.0.2.1', 'eth0')]))
+        gs = self.patch('pov_server_page.machine_summary.get_summary',
+                        wraps=machine_summary.get_summary)
+        ldi = self.patch('pov_server_page.disk_inventory.LinuxDiskInfo',
+                         wraps=disk_inventory.LinuxDiskInfo)
+        self.builder.build()
+        self.assertEqual(gs.call_count, 1)
+        self.assertEqual(ldi.call_count, 1)
+        fn = os.path.join(self.tmpdir, 'var/www/frog.example.com/info/index.html')
+        with open(fn, 'r') as f:
+            self.assertIn('192.0.2.1 (eth0)', f.read())
+
+    def test_build_only(self):
+        self.builder.vars['MOTD_FILE'] = '/dev/null'
+        self.builder.file_readable_to = lambda f, u, g: True
+        self.builder.build(verbose=True, quick=True, only={
+            '/var/www/{HOSTNAME}/ssh/index.html',
+        })
+        self.assertMultiLineEqual(
+            self.stdout.getvalue().replace(self.tmpdir, ''),
+            "Created /var/www/frog.example.com/ssh/index.html\n"
+        )
+
+    def test_get_watch_list(self):
+        self.builder.vars['MOTD_FILE'] = '/etc/motd'
+        watch_list = dict(self.builder.get_watch_list())
+        self.assertEqual(watch_list['/etc/services'],
+                         ['/var/www/{HOSTNAME}/ports/index.html'])
+        self.assertIn('/var/www/{HOSTNAME}/info/index.html',
+                      watch_list['/etc/motd'])
+        self.assertEqual(
+            watch_list[os.path.join(self.builder.template_dir, 'du-page.html.in')],
+            ['/var/www/{HOSTNAME}/du'])
+
     def test_check(self):
         self.builder.needs_apache_reload = True
         self.builder.check()
 
 
+class FakeInotify(object):
+
+    def __init__(self, events=()):
+        self.watches = []
+        self.events = list(events)
+        self.timeouts = []
+        self.closed = False
+
+    def add_watch(self, path):
+        if not os.path.exists(path):
+            raise OSError(errno.ENOENT, 'No such file or directory', path)
+        self.watches.append(path)
+
+    def read(self, timeout=None):
+        self.timeouts.append(timeout)
+        return self.events.pop(0) if self.events else []
+
+    def close(self):
+        self.closed = True
+
+
+class TestWatcher(FilesystemTests):
+
+    def setUp(self):
+        super(TestWatcher, self).setUp()
+        self.etc = os.path.join(self.tmpdir, 'etc')
+        self.run = os.path.join(self.tmpdir, 'run')
+        os.makedirs(self.etc)
+        os.makedirs(self.run)
+        os.symlink(os.path.join(self.run, 'motd.dynamic'),
+                   os.path.join(self.etc, 'motd'))
+        self.inotify = FakeInotify()
+        self.watcher = Watcher([
+            (os.path.join(self.etc, 'motd'), ['index.html']),
+            (os.path.join(self.etc, 'services'), ['ports']),
+            (self.run, ['ports']),
+            (os.path.join(self.tmpdir, 'nosuchdir', 'file'), ['other']),
+        ], self.inotify)
+
+    def event(self, dirname, name=''):
+        return Event(dirname, IN_CLOSE_WRITE, 0, name)
+
+    def test_watches(self):
+        self.assertEqual(self.inotify.watches, [self.etc, self.run])
+
+    def test_affected(self):
+        self.assertEqual(self.watcher.affected([
+            self.event(self.etc, 'motd'),
+        ]), {'index.html'})
+        self.assertEqual(self.watcher.affected([
+            self.event(self.etc, 'hostname'),
+        ]), set())
+        self.assertEqual(self.watcher.affected([
+            self.event(self.run, 'motd.dynamic'),
+        ]), {'index.html', 'ports'})
+
+    def test_affected_overflow(self):
+        self.assertEqual(self.watcher.affected([
+            Event(None, IN_Q_OVERFLOW, 0, ''),
+        ]), {'index.html', 'ports', 'other'})
+
+    def test_wait_timeout(self):
+        self.assertEqual(self.watcher.wait(60, 2), set())
+        self.assertEqual(self.inotify.timeouts, [60])
+
+    def test_wait_debounces(self):
+        self.inotify.events = [
+            [self.event(self.etc, 'services')],
+            [self.event(self.etc, 'motd')],
+        ]
+        self.assertEqual(self.watcher.wait(60, 2), {'index.html', 'ports'})
+        self.assertEqual(self.inotify.timeouts, [60, 2, 2])
+
+    def test_close(self):
+        self.watcher.close()
+        self.assertTrue(self.inotify.closed)
+
+    def test_real_inotify(self):
+        watcher = Watcher([(os.path.join(self.etc, 'services'), ['ports'])])
+        self.addCleanup(watcher.close)
+        with open(os.path.join(self.etc, 'services'), 'w') as f:
+            f.write('http 80/tcp\n')
+        self.assertEqual(watcher.wait(1, 0), {'ports'})
+
+
+class TestDaemon(FilesystemTests):
+
+    def setUp(self):
+        super(TestDaemon, self).setUp()
+        self.stdout = self.patch('sys.stdout', StringIO())
+        self.stderr = self.patch('sys.stderr', StringIO())
+        self.build = self.patch(
+            'pov_server_page.update_server_page.coordinated_build',
+            return_value=True)
+        self.check = self.patch('pov_server_page.update_server_page.Builder.check',
+                                autospec=True)
+        self.config_file = os.path.join(self.tmpdir, 'config')
+        self.write_config('enabled = 1\n')
+
+    def write_config(self, text, mtime=None):
+        with open(self.config_file, 'w') as f:
+            f.write('[pov-server-page]\n' + text)
+        if mtime is not None:
+            os.utime(self.config_file, (mtime, mtime))
+
+    def step(self, daemon, now):
+        daemon.step(now)
+        if daemon.full_run is not None:
+            daemon.full_run.join()
+
+    def at(self, day, hour, minute=0):
+        return time.mktime((2025, 5, day, hour, minute, 0, 0, 0, -1))
+
+    def builds(self):
+        result = [call[1].get('quick') for call in self.build.call_args_list]
+        self.build.reset_mock()
+        return ['quick' if quick else 'full' for quick in result]
+
+    def test_schedule(self):
+        daemon = Daemon(self.config_file, destdir=self.tmpdir)
+        self.step(daemon, self.at(7, 5, 30))
+        self.assertEqual(self.builds(), ['quick'])
+        self.step(daemon, self.at(7, 6, 0))
+        self.assertEqual(self.builds(), ['full'])
+        self.step(daemon, self.at(7, 6, 1))
+        self.assertEqual(self.builds(), [])
+        self.step(daemon, self.at(7, 7, 0))
+        self.assertEqual(self.builds(), ['quick'])
+        self.step(daemon, self.at(8, 0, 0))
+        self.assertEqual(self.builds(), ['quick'])
+        self.step(daemon, self.at(8, 6, 0))
+        self.assertEqual(self.builds(), ['full'])
+
+    def test_quick(self):
+        daemon = Daemon(self.config_file, quick=True)
+        self.step(daemon, self.at(7, 12))
+        self.assertEqual(self.builds(), ['quick'])
+
+    def test_checks(self):
+        daemon = Daemon(self.config_file, checks=True)
+        self.step(daemon, self.at(7, 12))
+        self.assertEqual(self.check.call_count, 1)
+        self.step(daemon, self.at(7, 13))
+        self.assertEqual(self.builds(), ['full', 'quick'])
+        self.assertEqual(self.check.call_count, 2)
+
+    def test_config_change(self):
+        daemon = Daemon(self.config_file)
+        self.step(daemon, self.at(7, 12))
+        self.assertEqual(self.builds(), ['full'])
+        builder = daemon.builder
+        self.write_config('enabled = 1\nhostname = example.com\n',
+                          mtime=self.at(7, 12, 5))
+        self.step(daemon, self.at(7, 12, 5))
+        self.assertEqual(self.builds(), ['quick'])
+        self.assertEqual(daemon.builder.vars['HOSTNAME'], 'example.com')
+        self.assertIsNot(daemon.builder, builder)
+        self.assertIs(daemon.builder.lookup, builder.lookup)
+        self.assertIs(daemon.builder.html_lookup, builder.html_lookup)
+
+    def test_disabled(self):
+        self.write_config('enabled = 0\n')
+        daemon = Daemon(self.config_file, verbose=True)
+        daemon.step()
+        self.assertEqual(self.builds(), [])
+        self.assertEqual(self.stdout.getvalue(),
+                         "Disabled in the config file, waiting.\n")
+
+    def test_missing_config_file(self):
+        daemon = Daemon(os.path.join(self.tmpdir, 'nosuchfile'))
+        with self.assertRaises(Error):
+            daemon.step()
+        self.assertIsNone(daemon.get_config_mtime())
+
+    def test_watch(self):
+        watchers = []
+
+        def make_watcher(watch_list):
+            watcher = mock.Mock(watch_list=watch_list)
+            watcher.wait.return_value = {'/etc/services'}
+            watchers.append(watcher)
+            return watcher
+
+        self.patch('pov_server_page.update_server_page.Watcher', make_watcher)
+        daemon = Daemon(self.config_file, watch=True)
+        self.step(daemon, self.at(7, 12))
+        self.assertEqual(self.builds(), ['full'])
+        self.assertEqual(len(watchers), 1)
+        self.assertIn((self.config_file, []), watchers[0].watch_list)
+        daemon.wait()
+        watchers[0].wait.assert_called_once_with(60, 2)
+        self.step(daemon, self.at(7, 12, 1))
+        self.assertEqual(self.build.call_args[1]['only'], {'/etc/services'})
+        self.assertEqual(self.builds(), ['quick'])
+        self.step(daemon, self.at(7, 12, 2))
+        self.assertEqual(self.builds(), [])
+        self.write_config('enabled = 1\n', mtime=self.at(7, 12, 3))
+        self.step(daemon, self.at(7, 12, 3))
+        self.assertEqual(len(watchers), 2)
+        watchers[0].close.assert_called_once_with()
+
+    def test_changes_during_another_run(self):
+        daemon = Daemon(self.config_file, destdir=self.tmpdir)
+        self.step(daemon, self.at(7, 12))
+        self.assertEqual(self.builds(), ['full'])
+        self.assertEqual(daemon.runs.state_dir, self.tmpdir + STATE_DIR)
+        daemon.changed = {'/etc/services'}
+        self.build.return_value = False
+        self.step(daemon, self.at(7, 12, 1))
+        self.assertEqual(self.builds(), ['quick'])
+        self.assertEqual(daemon.changed, {'/etc/services'})
+        self.build.return_value = True
+        self.step(daemon, self.at(7, 12, 2))
+        self.assertEqual(self.builds(), ['quick'])
+        self.assertEqual(daemon.changed, set())
+
+    def test_quick_builds_during_full_build(self):
+        started = threading.Event()
+        finish = threading.Event()
+
+        def coordinated_build(builder, runs, **kw):
+            if not kw.get('quick'):
+                started.set()
+                finish.wait(10)
+            return True
+
+        self.build.side_effect = coordinated_build
+        daemon = Daemon(self.config_file, destdir=self.tmpdir)
+        daemon.step(self.at(7, 12))
+        started.wait(10)
+        daemon.changed = {'/etc/services'}
+        daemon.step(self.at(7, 12, 1))
+        finish.set()
+        daemon.full_run.join()
+        (builder, runs), kw = self.build.call_args_list[0]
+        self.assertEqual(self.builds(), ['full', 'quick'])
+        self.assertIsNot(builder, daemon.builder)
+        self.assertIs(builder.lookup, daemon.builder.lookup)
+        self.assertIsNot(runs, daemon.runs)
+        self.assertEqual(runs.state_dir, daemon.runs.state_dir)
+
+    def test_full_build_survives_errors(self):
+        daemon = Daemon(self.config_file)
+        self.build.side_effect = Error('oops')
+        self.step(daemon, self.at(7, 12))
+        self.build.side_effect = ValueError('bug')
+        self.step(daemon, self.at(8, 12))
+        self.assertIn('oops\n', self.stderr.getvalue())
+        self.assertIn('ValueError: bug', self.stderr.getvalue())
+
+    def test_wait_without_watch(self):
+        sleep = self.patch('time.sleep')
+        Daemon(self.config_file).wait()
+        sleep.assert_called_once_with(60)
+
+    def test_run_survives_errors(self):
+        daemon = Daemon(self.config_file)
+        daemon.step = mock.Mock(
+            side_effect=[Error('oops'), ValueError('bug'), None])
+        self.patch('time.sleep', side_effect=[None, None, KeyboardInterrupt])
+        with self.assertRaises(KeyboardInterrupt):
+            daemon.run()
+        self.assertEqual(daemon.step.call_count, 3)
+        self.assertIn('oops\n', self.stderr.getvalue())
+        self.assertIn('ValueError: bug', self.stderr.getvalue())
+
+
 class TestMain(FilesystemTests):
 
     def setUp(self):
@@ -811,9 +1737,39 @@ class TestMain(FilesystemTests):
         self.assertEqual(self.stdout.getvalue(),
                          "Disabled in the config file, quitting.\n")
 
+    def test_main_daemon(self):
+        run = self.patch('pov_server_page.update_server_page.Daemon.run',
+                         autospec=True)
+        self.run_main('--daemon', '--interval=600', 'enabled=true')
+        daemon = run.call_args[0][0]
+        self.assertEqual(daemon.config_file, self.config_file)
+        self.assertEqual(daemon.overrides, ['enabled=true'])
+        self.assertEqual(daemon.interval, 600)
+
     def test_main_smoke_test(self):
         self.run_main('-c', '/dev/null', '-v', 'enabled=true')
 
+    def test_main_precompile(self):
+        precompile = self.patch(
+            'pov_server_page.update_server_page.precompile')
+        e = self.run_main('--precompile')
+        self.assertIsNone(e)
+        precompile.assert_called_once_with(verbose=None)
+
+    def test_main_precompile_no_cache_dir(self):
+        self.patch('pov_server_page.update_server_page.precompile',
+                   side_effect=Error("No template cache directory configured"))
+        e = self.run_main('--precompile')
+        self.assertEqual(str(e), "No template cache directory configured")
+
+    def test_main_force(self):
+        self.run_main('-c', '/dev/null', 'enabled=true')
+        self.run_main('-c', '/dev/null', '-v', 'enabled=true')
+        # the ports page was up to date, so we didn't collect the data
+        self.assertNotIn('listening sockets:', self.stdout.getvalue())
+        self.run_main('-c', '/dev/null', '-v', '--force', 'enabled=true')
+        self.assertIn('listening sockets:', self.stdout.getvalue())
+
     def test_main_error_handling(self):
         dirname = os.path.join(self.tmpdir, 'var/www', get_fqdn())
         os.makedirs(dirname)
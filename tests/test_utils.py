@@ -0,0 +1,85 @@
+import linecache
+import os
+import shutil
+import tempfile
+import unittest
+
+import mako.template
+import mock
+
+from pov_server_page.utils import compile_template, mako_error_handler
+
+
+class TestCompileTemplate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='pov-server-page-test-')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def compile(self, text='Hello ${name}!', **kw):
+        kw.setdefault('uri', 'hello.html')
+        kw.setdefault('cache_dir', self.cache_dir)
+        return compile_template(text, strict_undefined=True, **kw)
+
+    def test_no_cache_dir(self):
+        template = self.compile(cache_dir=None)
+        self.assertEqual(template.render(name='world'), 'Hello world!')
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_cache_miss(self):
+        template = self.compile()
+        self.assertEqual(template.render(name='world'), 'Hello world!')
+        [filename] = os.listdir(self.cache_dir)
+        self.assertTrue(filename.startswith('hello_html-'))
+        self.assertTrue(filename.endswith('.py'))
+
+    def test_cache_hit(self):
+        self.compile()
+        template = self.compile()
+        self.assertIsInstance(template, mako.template.ModuleTemplate)
+        self.assertEqual(template.render(name='world'), 'Hello world!')
+
+    def test_source_changed(self):
+        self.compile()
+        template = self.compile('Bye ${name}!')
+        self.assertNotIsInstance(template, mako.template.ModuleTemplate)
+        self.assertEqual(template.render(name='world'), 'Bye world!')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_options_changed(self):
+        self.compile()
+        template = self.compile(default_filters=['h'])
+        self.assertNotIsInstance(template, mako.template.ModuleTemplate)
+        self.assertEqual(template.render(name='<world>'), 'Hello &lt;world&gt;!')
+
+    def test_corrupted_cache(self):
+        self.compile()
+        [filename] = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, filename), 'w') as f:
+            f.write('this is not valid Python!')
+        with mock.patch('pov_server_page.utils.log') as log:
+            template = self.compile()
+        self.assertIn('Ignoring broken compiled template', log.warning.call_args[0][0])
+        self.assertNotIsInstance(template, mako.template.ModuleTemplate)
+        self.assertEqual(template.render(name='world'), 'Hello world!')
+        template = self.compile()
+        self.assertIsInstance(template, mako.template.ModuleTemplate)
+
+    def test_cache_dir_not_writable(self):
+        with mock.patch('os.makedirs', side_effect=OSError('permission denied')):
+            template = self.compile()
+        self.assertEqual(template.render(name='world'), 'Hello world!')
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_error_handler_shows_template_source(self):
+        self.compile('${1/0}')
+        template = self.compile('${1/0}', error_handler=mako_error_handler)
+        self.assertIsInstance(template, mako.template.ModuleTemplate)
+        with self.assertRaises(ZeroDivisionError):
+            template.render()
+        # mako_error_handler annotates the compiled module source
+        [filename] = os.listdir(self.cache_dir)
+        filename = os.path.join(self.cache_dir, filename)
+        lines = linecache.getlines(filename)
+        self.assertIn('# hello.html line 1 in render_body:', ''.join(lines))